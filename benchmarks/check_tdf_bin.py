@@ -0,0 +1,64 @@
+from bin.extract import open_run, close_run
+from bin.tdf_source import TdfFrameSource
+from bin.tdf_bin import TdfBinReader
+
+import numpy as np
+import argparse
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input',
+                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--frames',
+                        help='Only check the first N frames. 0 = all frames. Default = 0',
+                        default=0,
+                        type=int)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# check that every scan of each frame decoded from analysis.tdf_bin w/ NumPy has the same TOF indices and intensities
+# as the scan read through the TDF-SDK w/ tims_read_scans_v2
+# synthetic plates are encoded w/ the same layout assumptions as bin.tdf_bin, so this check is only meaningful when run
+# on a .d file acquired w/ timsControl and read w/ the Bruker TDF-SDK
+# returns the IDs of frames whose peaks differ
+def get_mismatched_frames(dll, tdf_data, num_frames=0):
+    frame_source = TdfFrameSource(dll, tdf_data)
+    reader = TdfBinReader(tdf_data)
+    frames_df = tdf_data.analysis['Frames']
+    if num_frames > 0:
+        frames_df = frames_df.head(num_frames)
+    mismatched_frames = []
+    for frame, num_scans in zip(frames_df['Id'].tolist(), frames_df['NumScans'].tolist()):
+        sdk_peaks = frame_source.read_scans(int(frame), 0, int(num_scans))
+        numpy_peaks = reader.read_frame(int(frame))
+        if not all([np.array_equal(i, j) for i, j in zip(sdk_peaks, numpy_peaks)]):
+            mismatched_frames.append(int(frame))
+    return mismatched_frames
+
+
+def run():
+    # Parse arguments
+    args = get_args()
+
+    # Load TDF data
+    dll, tdf_data = open_run(args['input'])
+    try:
+        num_frames = tdf_data.analysis['Frames'].shape[0] if args['frames'] <= 0 else \
+            min(args['frames'], tdf_data.analysis['Frames'].shape[0])
+        mismatched_frames = get_mismatched_frames(dll, tdf_data, args['frames'])
+    finally:
+        close_run(dll, tdf_data)
+    print(str(num_frames - len(mismatched_frames)) + ' of ' + str(num_frames) + ' frames decoded w/ NumPy match the '
+          'TDF-SDK.')
+    if mismatched_frames:
+        raise Exception('Frames decoded w/ NumPy differ from the TDF-SDK: ' +
+                        ', '.join([str(i) for i in mismatched_frames]))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,34 @@
+# synthetic stand-in for pyTDFSDK.classes.TdfData
+from pyTDFSDK.tims import open_runs, tims_close
+
+import os
+import itertools
+import sqlite3
+import pandas as pd
+
+# handles given to opened runs
+handles = itertools.count(1)
+
+
+class TdfData(object):
+    def __init__(self, bruker_d_folder_name, tdf_sdk, use_recalibrated_state=False):
+        self.source_file = bruker_d_folder_name
+        self.tdf_sdk = tdf_sdk
+        self.handle = next(handles)
+        self.analysis = {}
+        conn = sqlite3.connect(os.path.join(bruker_d_folder_name, 'analysis.tdf'))
+        try:
+            tables = [i[0] for i in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+            for table in tables:
+                self.analysis[table] = pd.read_sql_query('SELECT * FROM ' + table, conn)
+        finally:
+            conn.close()
+        frames_df = self.analysis['Frames']
+        frame_ids = frames_df['Id'].tolist()
+        open_runs[self.handle] = {'tdf_bin': os.path.join(bruker_d_folder_name, 'analysis.tdf_bin'),
+                                  'tims_id': dict(zip(frame_ids, frames_df['TimsId'].tolist())),
+                                  'num_scans': dict(zip(frame_ids, frames_df['NumScans'].tolist())),
+                                  't1': dict(zip(frame_ids, frames_df['T1'].tolist()))}
+
+    def close(self):
+        tims_close(self.tdf_sdk, self.handle)
@@ -0,0 +1,3 @@
+# synthetic stand-in for pyTDFSDK.init_tdf_sdk; no Bruker library is loaded
+def init_tdf_sdk_api(bruker_api_file_name=''):
+    return 'synthetic_tdf_sdk'
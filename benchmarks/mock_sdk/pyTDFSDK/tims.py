@@ -0,0 +1,95 @@
+# synthetic stand-in for the pyTDFSDK.tims functions used by timstof_targeted_3d_maldi_analysis
+# peaks are read from synthetic plates written by benchmarks.synthetic_plate, which stores frames in analysis.tdf_bin
+# using the zstd compressed layout that bin.tdf_bin assumes for timsControl (TimsCompressionType 2), so synthetic plates
+# cannot show whether that layout matches real data (see benchmarks.check_tdf_bin); m/z and 1/K0 calibration use fixed
+# synthetic models w/ a per-frame temperature drift so that m/z calibration differs between frames like real data
+import numpy as np
+
+# zstandard is only required to read synthetic plates
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# sqrt(m/z) = MZ_INTERCEPT + MZ_SLOPE * TOF index * (1 + MZ_TEMPERATURE_COEFFICIENT * (T1 - REFERENCE_TEMPERATURE))
+MZ_INTERCEPT = 10.0
+MZ_SLOPE = 1.12e-4
+MZ_TEMPERATURE_COEFFICIENT = 2e-6
+REFERENCE_TEMPERATURE = 25.0
+# 1/K0 decreases linearly from OOK0_MAX at scan 0 to OOK0_MIN at the last scan
+OOK0_MAX = 1.9
+OOK0_MIN = 0.6
+
+# runs opened by pyTDFSDK.classes.TdfData, keyed by handle
+open_runs = {}
+
+
+# get the m/z drift factor of a frame
+def get_mz_drift(handle, frame_id):
+    return 1 + MZ_TEMPERATURE_COEFFICIENT * (open_runs[handle]['t1'][frame_id] - REFERENCE_TEMPERATURE)
+
+
+# get the 1/K0 width of a single scan in a frame
+def get_scan_width(handle, frame_id):
+    return (OOK0_MAX - OOK0_MIN) / open_runs[handle]['num_scans'][frame_id]
+
+
+# decode a frame blob from analysis.tdf_bin into per-scan peak counts, TOF indices, and intensities
+# the blob is a uint32 blob size and uint32 number of scans followed by a zstd compressed, byte shuffled uint32 array:
+# the number of scans, twice the peak count of each scan except the last, then interleaved TOF index deltas (w/ TOF
+# indices stored 1-based and restarting at 0 in each scan) and intensities
+def decode_frame_blob(blob):
+    num_scans = int(np.frombuffer(blob[4:8], dtype=np.uint32)[0])
+    data = np.frombuffer(zstandard.ZstdDecompressor().decompress(bytes(blob[8:])), dtype=np.uint8)
+    data = np.ascontiguousarray(data.reshape(4, -1).T).view(np.uint32).ravel()
+    peak_data = data[num_scans:]
+    scan_counts = np.zeros(num_scans, dtype=np.int64)
+    scan_counts[:-1] = data[1:num_scans] // 2
+    scan_counts[-1] = peak_data.size // 2 - scan_counts[:-1].sum()
+    tof_deltas = peak_data[0::2].astype(np.int64)
+    intensities = peak_data[1::2].copy()
+    scan_starts = np.repeat(np.cumsum(scan_counts) - scan_counts, scan_counts)
+    cumulative = np.cumsum(tof_deltas)
+    tof_indices = cumulative - np.concatenate(([0], cumulative))[scan_starts] - 1
+    return scan_counts, tof_indices.astype(np.uint32), intensities
+
+
+def tims_read_scans_v2(tdf_sdk, handle, frame_id, scan_begin, scan_end):
+    run = open_runs[handle]
+    offset = run['tims_id'][frame_id]
+    with open(run['tdf_bin'], 'rb') as tdf_bin_file:
+        tdf_bin_file.seek(offset)
+        blob_size = int(np.frombuffer(tdf_bin_file.read(4), dtype=np.uint32)[0])
+        tdf_bin_file.seek(offset)
+        blob = tdf_bin_file.read(blob_size)
+    scan_counts, tof_indices, intensities = decode_frame_blob(blob)
+    scan_offsets = np.concatenate(([0], np.cumsum(scan_counts)))
+    scan_end = min(scan_end, scan_counts.size)
+    return [[tof_indices[scan_offsets[i]:scan_offsets[i + 1]], intensities[scan_offsets[i]:scan_offsets[i + 1]]]
+            for i in range(scan_begin, scan_end)]
+
+
+def tims_index_to_mz(tdf_sdk, handle, frame_id, indices):
+    indices = np.asarray(indices, dtype=np.float64)
+    return (MZ_INTERCEPT + MZ_SLOPE * indices * get_mz_drift(handle, frame_id)) ** 2
+
+
+def tims_mz_to_index(tdf_sdk, handle, frame_id, mzs):
+    mzs = np.asarray(mzs, dtype=np.float64)
+    return (np.sqrt(mzs) - MZ_INTERCEPT) / (MZ_SLOPE * get_mz_drift(handle, frame_id))
+
+
+def tims_scannum_to_oneoverk0(tdf_sdk, handle, frame_id, scan_nums):
+    scan_nums = np.asarray(list(scan_nums), dtype=np.float64)
+    return OOK0_MAX - scan_nums * get_scan_width(handle, frame_id)
+
+
+def tims_oneoverk0_to_scannum(tdf_sdk, handle, frame_id, mobilities):
+    mobilities = np.asarray(list(mobilities), dtype=np.float64)
+    return (OOK0_MAX - mobilities) / get_scan_width(handle, frame_id)
+
+
+def tims_close(tdf_sdk, handle):
+    open_runs.pop(handle, None)
+    return 0
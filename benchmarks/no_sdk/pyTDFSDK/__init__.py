@@ -0,0 +1,2 @@
+# stand-in for a machine w/o the Bruker TDF-SDK: importing pyTDFSDK fails as it would if it were not installed
+raise ImportError('No module named pyTDFSDK')
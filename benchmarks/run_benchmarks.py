@@ -0,0 +1,274 @@
+from benchmarks.synthetic_plate import get_synthetic_features, make_synthetic_plate, get_synthetic_plate_parameters
+
+import os
+import sys
+import json
+import time
+import subprocess
+import pandas as pd
+import argparse
+
+
+# folder containing the synthetic pyTDFSDK package used in place of the Bruker TDF-SDK
+MOCK_SDK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_sdk')
+# folder containing a pyTDFSDK package that fails to import, used to check entry points that must run w/o the TDF-SDK
+NO_SDK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'no_sdk')
+# root of the repository; entry points are run as modules from here
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# benchmarked entry points and the modules they run
+ENTRY_POINTS = {'get_feature_intensities': 'bin.run',
+                'get_batch_feature_intensities': 'bin.run_batch',
+                'get_feature_map': 'bin.run_batch_map'}
+# columns identifying a row in the long layout output
+ROW_KEY_COLUMNS = ['Frame', 'Spot', 'mz', 'mz_tolerance', 'ook0', 'ook0_tol']
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir',
+                        help='Path to folder in which to write synthetic plates, entry point output, and the benchmark '
+                             'report. Synthetic plates are reused if they were written w/ the same parameters.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--spots',
+                        help='One or more plate sizes to benchmark: 96, 384, and/or 1536. Default = 96 384',
+                        default=[96, 384],
+                        nargs='+',
+                        type=int)
+    parser.add_argument('--num_scans',
+                        help='Number of TIMS scans per frame. Default = 918',
+                        default=918,
+                        type=int)
+    parser.add_argument('--peaks_per_scan',
+                        help='Mean number of noise peaks per scan. Default = 5',
+                        default=5.0,
+                        type=float)
+    parser.add_argument('--num_features',
+                        help='Number of features in the feature list. Default = 10',
+                        default=10,
+                        type=int)
+    parser.add_argument('--entry_points',
+                        help='One or more entry points to benchmark. Default = all',
+                        default=list(ENTRY_POINTS.keys()),
+                        choices=list(ENTRY_POINTS.keys()),
+                        nargs='+',
+                        type=str)
+    parser.add_argument('--jobs',
+                        help='One or more values of --jobs to benchmark each entry point w/. Default = 1',
+                        default=[1],
+                        nargs='+',
+                        type=int)
+    parser.add_argument('--readers',
+                        help='One or more frame readers to benchmark each entry point w/: "sdk" and/or "numpy". '
+                             'Default = sdk',
+                        default=['sdk'],
+                        choices=['sdk', 'numpy'],
+                        nargs='+',
+                        type=str)
+    parser.add_argument('--decode_threads',
+                        help='Number of threads used to decode frames w/ the numpy frame reader. Default = 1',
+                        default=1,
+                        type=int)
+    parser.add_argument('--reference_frames',
+                        help='Number of frames of each plate checked against the reference implementation. The '
+                             'reference implementation processes each feature separately and is slow on large '
+                             'plates. 0 = skip the check. Default = 48',
+                        default=48,
+                        type=int)
+    parser.add_argument('--report',
+                        help='Path of the JSON benchmark report. Default = benchmark_report.json in workdir.',
+                        default='',
+                        type=str)
+    parser.add_argument('--seed',
+                        help='Random seed used to generate synthetic plates. Default = 0',
+                        default=0,
+                        type=int)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# run a module in a subprocess w/ the synthetic TDF-SDK (or w/ sdk_dir = NO_SDK_DIR, w/o any TDF-SDK) and return its
+# wall time in seconds and peak RSS in MB
+# peak RSS is the largest resident set size of the process or any worker process it started (Linux only)
+def run_module(module_args, log_path, sdk_dir=MOCK_SDK_DIR):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([sdk_dir, REPO_DIR] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env
+                                                                   else []))
+    with open(log_path, 'w') as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-m'] + [str(i) for i in module_args],
+                                   cwd=REPO_DIR,
+                                   env=env,
+                                   stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            pid, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = rusage.ru_maxrss / 1024
+        else:
+            process.wait()
+            peak_rss = None
+        seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise Exception(module_args[0] + ' failed w/ exit code ' + str(process.returncode) + '. See ' + log_path)
+    return seconds, peak_rss
+
+
+# get the command line arguments used to run an entry point on a synthetic plate
+def get_entry_point_args(entry_point, plate_path, feature_path, feature_df, outdir, outfile, jobs, reader='sdk',
+                         decode_threads=1):
+    module_args = [ENTRY_POINTS[entry_point], '--input', plate_path, '--outdir', outdir, '--outfile', outfile]
+    if entry_point == 'get_feature_intensities':
+        for column, arg in [('mz', '--mz'), ('mz_tol', '--mz_tol'), ('ook0', '--ook0'), ('ook0_tol', '--ook0_tol')]:
+            module_args += [arg] + feature_df[column].tolist()
+    else:
+        module_args += ['--feature_list', feature_path]
+    if entry_point == 'get_feature_map':
+        # synthetic feature lists have an internal standard followed by a numerator/denominator isomer pair
+        module_args += ['--numerator_ook0', feature_df['ook0'][1],
+                        '--denominator_ook0', feature_df['ook0'][2],
+                        '--IS_mz', feature_df['mz'][0]]
+    return module_args + ['--jobs', jobs, '--reader', reader, '--decode_threads', decode_threads]
+
+
+# get the command line arguments used to run get_feature_map on an intensity table written by get_feature_map
+def get_intensity_table_args(table_path, feature_df, outdir):
+    return [ENTRY_POINTS['get_feature_map'], '--intensity_table', table_path, '--outdir', outdir,
+            '--numerator_ook0', feature_df['ook0'][1],
+            '--denominator_ook0', feature_df['ook0'][2],
+            '--IS_mz', feature_df['mz'][0]]
+
+
+# check whether two ratio tables written by get_feature_map are the same
+def check_ratio_tables(output_path, expected_path):
+    return bool(pd.read_csv(output_path).equals(pd.read_csv(expected_path)))
+
+
+# check whether every reference row is in an entry point's output w/ the same intensity
+def check_output(output_path, reference_df):
+    output_df = pd.read_csv(output_path)
+    output_df = output_df[output_df['Frame'].isin(reference_df['Frame'])]
+    merged = reference_df.merge(output_df, on=ROW_KEY_COLUMNS, how='outer', suffixes=('_reference', ''),
+                                indicator=True)
+    return bool((merged['_merge'] == 'both').all() and (merged['intensity'] == merged['intensity_reference']).all())
+
+
+# get a benchmark result row
+def get_result(entry_point, spots, jobs, reader, num_frames, num_features, seconds, peak_rss, matches_reference):
+    return {'entry_point': entry_point,
+            'spots': spots,
+            'jobs': jobs,
+            'reader': reader,
+            'frames': num_frames,
+            'features': num_features,
+            'seconds': round(seconds, 3),
+            'frames_per_second': round(num_frames / seconds, 2),
+            # number of feature intensities (one feature in one spot) extracted per second
+            'features_per_second': round(num_frames * num_features / seconds, 2),
+            'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+            'matches_reference': matches_reference}
+
+
+# generate synthetic plates, run each entry point on them, and report throughput, memory use, and whether the output
+# matches the reference implementation
+def run():
+    # Parse arguments
+    args = get_args()
+
+    if not os.path.isdir(args['workdir']):
+        os.makedirs(args['workdir'])
+    if args['report'] == '':
+        args['report'] = os.path.join(args['workdir'], 'benchmark_report.json')
+
+    feature_df = get_synthetic_features(args['num_features'], args['seed'])
+    feature_path = os.path.join(args['workdir'], 'synthetic_features.csv')
+    feature_df.to_csv(feature_path, index=False)
+    feature_df = pd.read_csv(feature_path)
+
+    results = []
+    for spots in args['spots']:
+        plate_path = os.path.join(args['workdir'], 'synthetic_' + str(spots) + '.d')
+        plate_parameters = json.loads(json.dumps({'spots': spots,
+                                                  'num_scans': args['num_scans'],
+                                                  'peaks_per_scan': args['peaks_per_scan'],
+                                                  'seed': args['seed'],
+                                                  'features': feature_df.to_dict(orient='list')}))
+        if get_synthetic_plate_parameters(plate_path) != plate_parameters:
+            print('Writing synthetic ' + str(spots) + ' spot plate...')
+            make_synthetic_plate(plate_path, feature_df, spots, args['num_scans'], args['peaks_per_scan'],
+                                 args['seed'])
+        outdir = os.path.join(args['workdir'], 'output_' + str(spots))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        reference_df = None
+        if args['reference_frames'] > 0:
+            num_reference_frames = min(args['reference_frames'], spots)
+            print('Running reference implementation on ' + str(num_reference_frames) + ' frame(s) of the ' +
+                  str(spots) + ' spot plate...')
+            seconds, peak_rss = run_module(['benchmarks.reference', '--input', plate_path, '--outdir', outdir,
+                                            '--outfile', 'reference.csv', '--feature_list', feature_path,
+                                            '--frames', num_reference_frames],
+                                           os.path.join(outdir, 'reference.log'))
+            reference_df = pd.read_csv(os.path.join(outdir, 'reference.csv'))
+            results.append(get_result('reference', spots, 1, 'sdk', num_reference_frames, len(feature_df), seconds,
+                                      peak_rss, True))
+
+        for entry_point in args['entry_points']:
+            for jobs in args['jobs']:
+                for reader in args['readers']:
+                    print('Running ' + entry_point + ' w/ --jobs ' + str(jobs) + ' and the ' + reader +
+                          ' frame reader on the ' + str(spots) + ' spot plate...')
+                    name = entry_point + '_jobs' + str(jobs) + '_' + reader
+                    entry_point_outdir = os.path.join(outdir, name)
+                    if not os.path.isdir(entry_point_outdir):
+                        os.makedirs(entry_point_outdir)
+                    seconds, peak_rss = run_module(get_entry_point_args(entry_point,
+                                                                        plate_path,
+                                                                        feature_path,
+                                                                        feature_df,
+                                                                        entry_point_outdir,
+                                                                        name + '.csv',
+                                                                        jobs,
+                                                                        reader,
+                                                                        args['decode_threads']),
+                                                   os.path.join(outdir, name + '.log'))
+                    if reference_df is not None:
+                        matches_reference = check_output(os.path.join(entry_point_outdir, name + '.csv'),
+                                                         reference_df)
+                    else:
+                        matches_reference = None
+                    results.append(get_result(entry_point, spots, jobs, reader, spots, len(feature_df), seconds,
+                                              peak_rss, matches_reference))
+
+                    if entry_point == 'get_feature_map':
+                        # ratios recalculated from the intensity table w/o the TDF-SDK must match those calculated
+                        # while extracting
+                        print('Running get_feature_map w/ --intensity_table w/o the TDF-SDK on the ' + str(spots) +
+                              ' spot plate...')
+                        table_outdir = os.path.join(outdir, name + '_intensity_table')
+                        if not os.path.isdir(table_outdir):
+                            os.makedirs(table_outdir)
+                        seconds, peak_rss = run_module(get_intensity_table_args(os.path.join(entry_point_outdir,
+                                                                                             name + '.csv'),
+                                                                                feature_df,
+                                                                                table_outdir),
+                                                       os.path.join(outdir, name + '_intensity_table.log'),
+                                                       NO_SDK_DIR)
+                        matches_reference = check_ratio_tables(os.path.join(table_outdir, 'modified_outfile.csv'),
+                                                               os.path.join(entry_point_outdir,
+                                                                            'modified_outfile.csv'))
+                        results.append(get_result('get_feature_map_intensity_table', spots, 1, 'none', spots,
+                                                  len(feature_df), seconds, peak_rss, matches_reference))
+
+    with open(args['report'], 'w') as report_file:
+        json.dump({'parameters': args, 'results': results}, report_file, indent=4)
+    print(pd.DataFrame(results).to_string(index=False))
+    print('Benchmark report written to ' + args['report'])
+    if any([i['matches_reference'] is False for i in results]):
+        raise Exception('Entry point output does not match the reference implementation.')
+
+
+if __name__ == "__main__":
+    run()
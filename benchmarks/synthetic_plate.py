@@ -0,0 +1,243 @@
+from benchmarks.mock_sdk.pyTDFSDK.tims import MZ_INTERCEPT, MZ_SLOPE, OOK0_MAX, OOK0_MIN, REFERENCE_TEMPERATURE
+
+import os
+import json
+import string
+import sqlite3
+import numpy as np
+import pandas as pd
+import argparse
+
+# zstandard is only required to write synthetic plates
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# number of rows and columns of each supported plate format
+PLATE_FORMATS = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+# TOF index range of noise peaks
+TOF_INDEX_RANGE = (20000, 380000)
+# number of peaks per scan and standard deviation in scans and TOF indices of each analyte in each spot
+ANALYTE_PEAKS_PER_SCAN = 4
+ANALYTE_SCAN_SIGMA = 6.0
+ANALYTE_TOF_SIGMA = 3.0
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outdir',
+                        help='Path to folder in which to write the synthetic .d file and feature list.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--spots',
+                        help='Number of spots on the synthetic plate: 96, 384, or 1536. Default = 96',
+                        default=96,
+                        choices=sorted(PLATE_FORMATS.keys()),
+                        type=int)
+    parser.add_argument('--num_scans',
+                        help='Number of TIMS scans per frame. Default = 918',
+                        default=918,
+                        type=int)
+    parser.add_argument('--peaks_per_scan',
+                        help='Mean number of noise peaks per scan. Default = 5',
+                        default=5.0,
+                        type=float)
+    parser.add_argument('--num_features',
+                        help='Number of analytes on the plate and features in the feature list. Default = 10',
+                        default=10,
+                        type=int)
+    parser.add_argument('--seed',
+                        help='Random seed. Default = 0',
+                        default=0,
+                        type=int)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# get the spot names of a plate in acquisition order (A1, A2, ..., B1, ...); rows after Z are named AA, AB, etc.
+def get_spot_names(num_spots):
+    num_rows, num_columns = PLATE_FORMATS[num_spots]
+    rows = list(string.ascii_uppercase) + ['A' + i for i in string.ascii_uppercase]
+    return [rows[i] + str(j + 1) for i in range(num_rows) for j in range(num_columns)]
+
+
+# get a synthetic feature list
+# the first feature is an internal standard, and the second and third features are isomers w/ the same m/z and
+# different 1/K0 values that can be used as the numerator and denominator of get_feature_map
+def get_synthetic_features(num_features, seed=0):
+    rng = np.random.default_rng(seed)
+    num_features = max(num_features, 3)
+    mz = np.round(rng.uniform(300, 2000, num_features), 4)
+    ook0 = np.round(rng.uniform(OOK0_MIN + 0.2, OOK0_MAX - 0.2, num_features), 3)
+    mz[2] = mz[1]
+    ook0[2] = np.round(ook0[1] + 0.1 if ook0[1] + 0.1 < OOK0_MAX - 0.2 else ook0[1] - 0.1, 3)
+    return pd.DataFrame({'mz': mz,
+                         'mz_tol': np.full(num_features, 0.05),
+                         'ook0': ook0,
+                         'ook0_tol': np.full(num_features, 0.05)})
+
+
+# encode the peaks of a frame as a TimsCompressionType 2 blob in the layout assumed by bin.tdf_bin (see
+# pyTDFSDK.tims.decode_frame_blob in the mock TDF-SDK)
+def encode_frame_blob(scan_counts, tof_indices, intensities):
+    num_scans = scan_counts.size
+    # TOF indices are stored 1-based as deltas that restart at 0 in each scan
+    scan_starts = np.cumsum(scan_counts) - scan_counts
+    tof_deltas = tof_indices.astype(np.int64) + 1
+    previous = np.concatenate(([0], tof_deltas[:-1]))
+    previous[scan_starts[scan_counts > 0]] = 0
+    tof_deltas = tof_deltas - previous
+    data = np.zeros(num_scans + 2 * tof_indices.size, dtype=np.uint32)
+    data[0] = num_scans
+    data[1:num_scans] = scan_counts[:-1] * 2
+    data[num_scans::2] = tof_deltas
+    data[num_scans + 1::2] = intensities
+    # byte shuffle: the first bytes of every value are stored first, then the second bytes, etc.
+    shuffled = np.ascontiguousarray(data.view(np.uint8).reshape(-1, 4).T).tobytes()
+    compressed = zstandard.ZstdCompressor(level=1).compress(shuffled)
+    return np.array([len(compressed) + 8, num_scans], dtype=np.uint32).tobytes() + compressed
+
+
+# generate the peaks of a single frame: uniformly distributed noise peaks plus a peak cluster for each analyte whose
+# abundance varies across the plate
+# returns per-scan peak counts and TOF indices (sorted within each scan) and intensities
+def get_synthetic_frame(rng, num_scans, peaks_per_scan, analyte_scans, analyte_tof_indices, analyte_abundances):
+    num_noise_peaks = rng.poisson(peaks_per_scan * num_scans)
+    scans = [rng.integers(0, num_scans, num_noise_peaks)]
+    tof_indices = [rng.integers(TOF_INDEX_RANGE[0], TOF_INDEX_RANGE[1], num_noise_peaks)]
+    intensities = [rng.integers(10, 500, num_noise_peaks)]
+    num_analyte_peaks = int(ANALYTE_PEAKS_PER_SCAN * ANALYTE_SCAN_SIGMA * 4)
+    for scan, tof_index, abundance in zip(analyte_scans, analyte_tof_indices, analyte_abundances):
+        scans.append(np.round(rng.normal(scan, ANALYTE_SCAN_SIGMA, num_analyte_peaks)).astype(np.int64))
+        tof_indices.append(np.round(rng.normal(tof_index, ANALYTE_TOF_SIGMA, num_analyte_peaks)).astype(np.int64))
+        intensities.append(rng.poisson(abundance, num_analyte_peaks) + 1)
+    scans = np.concatenate(scans)
+    tof_indices = np.concatenate(tof_indices)
+    intensities = np.concatenate(intensities)
+    within_range = (scans >= 0) & (scans < num_scans) & (tof_indices >= 0)
+    scans = scans[within_range]
+    tof_indices = tof_indices[within_range]
+    intensities = intensities[within_range]
+
+    # peaks at the same scan and TOF index are merged
+    keys, inverse = np.unique(scans * (TOF_INDEX_RANGE[1] * 2) + tof_indices, return_inverse=True)
+    merged_intensities = np.zeros(keys.size, dtype=np.int64)
+    np.add.at(merged_intensities, inverse.ravel(), intensities)
+    scans = keys // (TOF_INDEX_RANGE[1] * 2)
+    return np.bincount(scans, minlength=num_scans), keys % (TOF_INDEX_RANGE[1] * 2), merged_intensities
+
+
+# write a synthetic MALDI AutoXecute .d run w/ one frame per spot containing the analytes in feature_df
+# the analysis.tdf tables used by the extraction scripts (Frames, MaldiFrameInfo, GlobalMetadata) are written w/ frames
+# stored in analysis.tdf_bin in the timsControl zstd compressed layout
+def make_synthetic_plate(path, feature_df, num_spots=96, num_scans=918, peaks_per_scan=5.0, seed=0):
+    if zstandard is None:
+        raise Exception('zstandard is required to write synthetic plates. Install it w/ "pip install zstandard".')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    rng = np.random.default_rng(seed)
+    spot_names = get_spot_names(num_spots)
+    num_rows, num_columns = PLATE_FORMATS[num_spots]
+
+    # analyte positions are computed w/ the reference calibration
+    analyte_tof_indices = (np.sqrt(feature_df['mz'].values) - MZ_INTERCEPT) / MZ_SLOPE
+    analyte_scans = (OOK0_MAX - feature_df['ook0'].values) / ((OOK0_MAX - OOK0_MIN) / num_scans)
+    # each analyte has a gradient across the plate in a random direction
+    analyte_gradients = rng.uniform(-1, 1, (len(feature_df), 2))
+
+    frames = []
+    maldi_frame_info = []
+    offset = 0
+    with open(os.path.join(path, 'analysis.tdf_bin'), 'wb') as tdf_bin_file:
+        for frame, spot_name in enumerate(spot_names, start=1):
+            row, column = divmod(frame - 1, num_columns)
+            position = np.array([row / max(num_rows - 1, 1), column / max(num_columns - 1, 1)])
+            analyte_abundances = 200 * (1.5 + analyte_gradients @ (position - 0.5))
+            scan_counts, tof_indices, intensities = get_synthetic_frame(rng,
+                                                                        num_scans,
+                                                                        peaks_per_scan,
+                                                                        analyte_scans,
+                                                                        analyte_tof_indices,
+                                                                        analyte_abundances)
+            blob = encode_frame_blob(scan_counts, tof_indices, intensities)
+            tdf_bin_file.write(blob)
+            frames.append({'Id': frame,
+                           'Time': frame * 0.5,
+                           'Polarity': '+',
+                           'ScanMode': 20,
+                           'MsMsType': 0,
+                           'TimsId': offset,
+                           'MaxIntensity': int(intensities.max()) if intensities.size else 0,
+                           'SummedIntensities': int(intensities.sum()),
+                           'NumScans': num_scans,
+                           'NumPeaks': int(tof_indices.size),
+                           'MzCalibration': 1,
+                           'T1': REFERENCE_TEMPERATURE + rng.normal(0, 0.5),
+                           'T2': REFERENCE_TEMPERATURE,
+                           'TimsCalibration': 1,
+                           'PropertyGroup': 1,
+                           'AccumulationTime': 100.0,
+                           'RampTime': 100.0})
+            maldi_frame_info.append({'Frame': frame,
+                                     'Chip': 0,
+                                     'SpotName': spot_name,
+                                     'RegionNumber': 0,
+                                     'XIndexPos': column,
+                                     'YIndexPos': row})
+            offset += len(blob)
+
+    tdf_path = os.path.join(path, 'analysis.tdf')
+    if os.path.isfile(tdf_path):
+        os.remove(tdf_path)
+    conn = sqlite3.connect(tdf_path)
+    try:
+        pd.DataFrame(frames).to_sql('Frames', conn, index=False)
+        pd.DataFrame(maldi_frame_info).to_sql('MaldiFrameInfo', conn, index=False)
+        pd.DataFrame({'Key': ['SchemaType', 'TimsCompressionType', 'ClosedProperly', 'SyntheticPlate'],
+                      'Value': ['TDF', '2', '1', json.dumps({'spots': num_spots,
+                                                             'num_scans': num_scans,
+                                                             'peaks_per_scan': peaks_per_scan,
+                                                             'seed': seed,
+                                                             'features': feature_df.to_dict(orient='list')})]
+                      }).to_sql('GlobalMetadata', conn, index=False)
+    finally:
+        conn.close()
+
+
+# get the parameters a synthetic plate was written w/, or None if the path is not a synthetic plate
+def get_synthetic_plate_parameters(path):
+    tdf_path = os.path.join(path, 'analysis.tdf')
+    if not os.path.isfile(tdf_path) or not os.path.isfile(os.path.join(path, 'analysis.tdf_bin')):
+        return None
+    conn = sqlite3.connect(tdf_path)
+    try:
+        value = conn.execute("SELECT Value FROM GlobalMetadata WHERE Key = 'SyntheticPlate'").fetchone()
+    except sqlite3.DatabaseError:
+        value = None
+    finally:
+        conn.close()
+    return json.loads(value[0]) if value is not None else None
+
+
+# write a synthetic plate and its feature list from the command line
+def run():
+    # Parse arguments
+    args = get_args()
+
+    feature_df = get_synthetic_features(args['num_features'], args['seed'])
+    if not os.path.isdir(args['outdir']):
+        os.makedirs(args['outdir'])
+    feature_df.to_csv(os.path.join(args['outdir'], 'synthetic_features.csv'), index=False)
+    make_synthetic_plate(os.path.join(args['outdir'], 'synthetic_' + str(args['spots']) + '.d'),
+                         feature_df,
+                         args['spots'],
+                         args['num_scans'],
+                         args['peaks_per_scan'],
+                         args['seed'])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,187 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import argparse
+import numpy as np
+
+
+# size of each block of analysis.tdf_bin sampled for the run fingerprint
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+# number of evenly spaced blocks of analysis.tdf_bin sampled for the run fingerprint
+FINGERPRINT_NUM_BLOCKS = 16
+# file that marks a folder as a run folder created by the cache; folders w/o it are never modified by the cache
+RUN_MARKER = 'run.json'
+# suffix of temporary files written while an entry is being stored
+TEMP_SUFFIX = '.tmp.npz'
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir',
+                        help='Path to the feature intensity cache folder.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--input',
+                        help='One or more Bruker .d files whose cached feature intensities are removed. All cached '
+                             'feature intensities are removed if none are specified.',
+                        default=[],
+                        nargs='+',
+                        type=str)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# get a content fingerprint for a .d run
+# analysis.tdf is hashed in full; analysis.tdf_bin is too large to hash on every run, so its size and a fixed set of
+# evenly spaced blocks (including the first and last block) are hashed instead
+# peak stores are fingerprinted by their description file, which includes the fingerprint of the source .d run
+def get_run_fingerprint(input_path):
+    fingerprint = hashlib.sha256()
+    if os.path.isfile(os.path.join(input_path, 'peak_store.json')):
+        with open(os.path.join(input_path, 'peak_store.json'), 'rb') as store_file:
+            fingerprint.update(store_file.read())
+        return fingerprint.hexdigest()
+    with open(os.path.join(input_path, 'analysis.tdf'), 'rb') as tdf_file:
+        for block in iter(lambda: tdf_file.read(FINGERPRINT_BLOCK_SIZE), b''):
+            fingerprint.update(block)
+    tdf_bin_size = os.path.getsize(os.path.join(input_path, 'analysis.tdf_bin'))
+    fingerprint.update(str(tdf_bin_size).encode())
+    with open(os.path.join(input_path, 'analysis.tdf_bin'), 'rb') as tdf_bin_file:
+        last_offset = max(tdf_bin_size - FINGERPRINT_BLOCK_SIZE, 0)
+        for offset in sorted(set(np.linspace(0, last_offset, FINGERPRINT_NUM_BLOCKS).astype(np.int64).tolist())):
+            tdf_bin_file.seek(offset)
+            fingerprint.update(tdf_bin_file.read(FINGERPRINT_BLOCK_SIZE))
+    return fingerprint.hexdigest()
+
+
+# get the cache key for a feature window; float.hex() keeps the exact m/z, 1/K0, and tolerance values
+def get_feature_key(feature):
+    key = '|'.join([float(feature[i]).hex() for i in ['mz', 'mz_tol', 'ook0', 'ook0_tol']])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# persistent on-disk cache of per-frame feature intensities
+# entries are stored as <cache_dir>/<run key>/<feature key>.npz, where the run key is derived from the absolute .d
+# path and its content fingerprint and the feature key from the exact mz, mz_tol, ook0, and ook0_tol values
+# the least recently used entries are evicted when the cache grows beyond max_size bytes
+class ResultCache(object):
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.run_dirs = {}
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    # get the path of each run folder created by the cache and the .d run it was created for
+    # only folders named w/ a run key that contain a run.json marker are returned, so other folders in cache_dir are
+    # never modified
+    def iter_run_dirs(self):
+        for run_dir in os.scandir(self.cache_dir):
+            if not run_dir.is_dir(follow_symlinks=False) or len(run_dir.name) != 64 or \
+                    any([i not in '0123456789abcdef' for i in run_dir.name]):
+                continue
+            try:
+                with open(os.path.join(run_dir.path, RUN_MARKER), 'r') as run_file:
+                    cached_input_path = json.load(run_file)['input']
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            yield run_dir.path, cached_input_path
+
+    # get the cache folder for a .d run, computing the run fingerprint once per run
+    def get_run_dir(self, input_path):
+        input_path = os.path.abspath(input_path)
+        if input_path not in self.run_dirs:
+            fingerprint = get_run_fingerprint(input_path)
+            run_key = hashlib.sha256((input_path + '|' + fingerprint).encode()).hexdigest()
+            run_dir = os.path.join(self.cache_dir, run_key)
+            if not os.path.isdir(run_dir):
+                os.makedirs(run_dir)
+                with open(os.path.join(run_dir, RUN_MARKER), 'w') as run_file:
+                    json.dump({'input': input_path, 'fingerprint': fingerprint}, run_file)
+            self.run_dirs[input_path] = run_dir
+        return self.run_dirs[input_path]
+
+    # get cached intensities for a feature in each of the given frames, or None if not cached
+    def get(self, input_path, feature, frames):
+        entry = os.path.join(self.get_run_dir(input_path), get_feature_key(feature) + '.npz')
+        if not os.path.isfile(entry):
+            return None
+        try:
+            with np.load(entry) as cached:
+                cached_frames = cached['frames']
+                intensities = cached['intensities']
+        except (OSError, ValueError, KeyError):
+            return None
+        if cached_frames.tolist() != list(frames):
+            return None
+        # mark entry as recently used for eviction
+        os.utime(entry)
+        return intensities.tolist()
+
+    # store intensities for a feature in each of the given frames
+    def put(self, input_path, feature, frames, intensities):
+        entry = os.path.join(self.get_run_dir(input_path), get_feature_key(feature) + '.npz')
+        # write to a temporary file first so an interrupted write never leaves a partial entry behind; each writer
+        # gets its own temporary file so processes sharing a cache folder never write to the same file
+        temp_fd, temp_entry = tempfile.mkstemp(suffix=TEMP_SUFFIX, dir=os.path.dirname(entry))
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                np.savez(temp_file,
+                         frames=np.array(frames, dtype=np.int64),
+                         intensities=np.array(intensities, dtype=np.int64))
+            os.replace(temp_entry, entry)
+        except BaseException:
+            if os.path.exists(temp_entry):
+                os.remove(temp_entry)
+            raise
+
+    # remove the least recently used entries until the cache is no larger than max_size bytes
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for run_dir, cached_input_path in self.iter_run_dirs():
+            for entry in os.scandir(run_dir):
+                # temporary files may still be being written by another process
+                if entry.is_file(follow_symlinks=False) and entry.name.endswith('.npz') and \
+                        not entry.name.endswith(TEMP_SUFFIX):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        cache_size = sum([i[1] for i in entries])
+        for mtime, size, path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            os.remove(path)
+            cache_size -= size
+
+    # remove cached entries for the given .d run, or the entire cache if no run is given
+    # entries are matched by absolute path so that stale entries from previous versions of the run are also removed
+    # only run folders created by the cache are removed; other files and folders in cache_dir are left untouched
+    def invalidate(self, input_path=None):
+        if input_path is not None:
+            input_path = os.path.abspath(input_path)
+        for run_dir, cached_input_path in list(self.iter_run_dirs()):
+            if input_path is not None and cached_input_path != input_path:
+                continue
+            shutil.rmtree(run_dir)
+        self.run_dirs = {}
+
+
+# remove cached feature intensities from the command line
+def run():
+    # Parse arguments
+    args = get_args()
+
+    cache = ResultCache(args['cache_dir'])
+    if args['input']:
+        for input_path in args['input']:
+            cache.invalidate(input_path)
+    else:
+        cache.invalidate()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,311 @@
+from bin.metadata import FrameMetadataIndex
+from bin.feature_index import FeatureIndex
+from bin.tdf_source import TdfFrameSource, check_tdf_sdk
+from bin.tdf_bin import FRAME_READERS, TdfBinFrameSource, check_tdf_bin_reader
+from bin.peak_store import is_peak_store, PeakStore, PeakStoreFrameSource
+from bin.profiler import get_profiler, set_profiler, Profiler
+from bin.feature_profiles import get_frame_profiles
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+# maximum number of frames processed between writes when streaming results
+FRAME_CHUNK_SIZE = 64
+
+
+# build a list of feature dicts from parallel lists of m/z, 1/K0, and tolerance values
+def get_feature_list(mz_list, mz_tol_list, ook0_list, ook0_tol_list):
+    return [{'mz': mz, 'mz_tol': mz_tol, 'ook0': ook0, 'ook0_tol': ook0_tol}
+            for mz, mz_tol, ook0, ook0_tol in zip(mz_list, mz_tol_list, ook0_list, ook0_tol_list)]
+
+
+# build a list of feature dicts from a feature list DataFrame w/ "mz", "mz_tol", "ook0", and "ook0_tol" columns
+def get_feature_list_from_df(feature_df):
+    return [{'mz': row['mz'], 'mz_tol': row['mz_tol'], 'ook0': row['ook0'], 'ook0_tol': row['ook0_tol']}
+            for index, row in feature_df.iterrows()]
+
+
+# get the summed intensity of every feature in a FeatureIndex in a single frame
+# if frame_profiles is a list, the mobilogram and m/z profile of every feature in the frame (see get_frame_profiles())
+# are appended to it from the same peaks
+def get_frame_intensities(frame_source, frame, mobility_calibration, feature_index, frame_profiles=None):
+    profiler = get_profiler()
+    with profiler.stage('scan_windows'):
+        scan_windows = feature_index.get_scan_windows(mobility_calibration)
+    if not scan_windows['valid'].any():
+        if frame_profiles is not None:
+            frame_profiles.append(get_frame_profiles(frame_source, frame, mobility_calibration, scan_windows, None,
+                                                     np.zeros(0, dtype=np.int64), None, None))
+        return [0] * len(feature_index)
+
+    # Read the union of all feature scan ranges from the current frame once
+    with profiler.stage('read_scans'):
+        scan_offsets, tof_indices, intensity_array = frame_source.read_scans(frame,
+                                                                             scan_windows['union_scan_begin'],
+                                                                             scan_windows['union_scan_end'])
+    # peaks are decoded as a uint32 TOF index and a uint32 intensity
+    profiler.count('peaks', tof_indices.size)
+    profiler.count('bytes', tof_indices.size * 8)
+    if scan_offsets[-1] == 0:
+        if frame_profiles is not None:
+            frame_profiles.append(get_frame_profiles(frame_source, frame, mobility_calibration, scan_windows,
+                                                     scan_offsets, tof_indices, intensity_array, None))
+        return [0] * len(feature_index)
+
+    with profiler.stage('tof_ranges'):
+        tof_ranges = frame_source.get_tof_ranges(frame, feature_index.features)
+    with profiler.stage('feature_filter'):
+        feature_intensities = feature_index.get_intensities(scan_windows,
+                                                            scan_offsets,
+                                                            tof_indices,
+                                                            intensity_array,
+                                                            tof_ranges).tolist()
+    if frame_profiles is not None:
+        with profiler.stage('feature_profiles'):
+            frame_profiles.append(get_frame_profiles(frame_source, frame, mobility_calibration, scan_windows,
+                                                     scan_offsets, tof_indices, intensity_array, tof_ranges))
+    return feature_intensities
+
+
+# get the summed intensity of every feature in each of the given frames
+# if frame_profiles is a list, the feature profiles of each frame are appended to it (see get_frame_intensities())
+def get_frames_intensities(frame_source, frames, frame_metadata, features, frame_profiles=None):
+    # features are compiled into a FeatureIndex once so that scan windows are shared by frames w/ the same calibration
+    feature_index = FeatureIndex(features)
+    profiler = get_profiler()
+    frame_source.prefetch(frames)
+    frame_intensities = []
+    for frame in frames:
+        frame_start = profiler.start_frame()
+        with profiler.stage('mobility_calibration'):
+            mobility_calibration = frame_source.get_mobility_calibration(frame,
+                                                                         frame_metadata.num_scans[frame],
+                                                                         frame_metadata.tims_calibration[frame])
+        frame_intensities.append(get_frame_intensities(frame_source,
+                                                       frame,
+                                                       mobility_calibration,
+                                                       feature_index,
+                                                       frame_profiles))
+        profiler.end_frame(frame, frame_start)
+    return frame_intensities
+
+
+# open a .d run through the TDF-SDK, or a peak store exported from one w/o loading the TDF-SDK
+# pyTDFSDK is only imported when a .d run is opened so that peak stores can be queried w/o it
+def open_run(input_path):
+    with get_profiler().stage('open_run'):
+        if is_peak_store(input_path):
+            return None, PeakStore(input_path)
+        check_tdf_sdk()
+        # functions for initializing TDF-SDK are found in the pyTDFSDK package
+        from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
+        from pyTDFSDK.classes import TdfData
+        dll = init_tdf_sdk_api()
+        return dll, TdfData(input_path, dll)
+
+
+# close a run opened w/ open_run(); peak stores do not hold a TDF-SDK handle
+def close_run(dll, tdf_data):
+    if not isinstance(tdf_data, PeakStore):
+        from pyTDFSDK.tims import tims_close
+        tims_close(dll, tdf_data.handle)
+
+
+# build the FrameMetadataIndex of an opened run
+def get_frame_metadata(tdf_data):
+    with get_profiler().stage('frame_metadata'):
+        return FrameMetadataIndex(tdf_data)
+
+
+# frame reader used to read peaks from .d runs in this process (see bin.tdf_bin.FRAME_READERS) and the number of threads
+# used to decode frames w/ the numpy frame reader
+frame_reader = {'reader': 'sdk', 'threads': 1}
+
+
+# set the frame reader used to read peaks from .d runs in this process
+def set_frame_reader(reader, threads=1):
+    if reader not in FRAME_READERS:
+        raise Exception('Frame reader must be one of: ' + ', '.join(FRAME_READERS))
+    if reader == 'numpy':
+        check_tdf_bin_reader()
+    frame_reader['reader'] = reader
+    frame_reader['threads'] = max(1, int(threads))
+
+
+# get the frame source used to read peaks and calibration from an opened run
+def get_frame_source(dll, tdf_data):
+    if isinstance(tdf_data, PeakStore):
+        return PeakStoreFrameSource(tdf_data)
+    if frame_reader['reader'] == 'numpy':
+        return TdfBinFrameSource(dll, tdf_data, frame_reader['threads'])
+    return TdfFrameSource(dll, tdf_data)
+
+
+# frame source and frame metadata opened once by each worker process
+worker_data = {}
+
+
+# open the run w/ its own TDF-SDK handle (if needed) in each worker process
+# if profile is True, stages are profiled in the worker and sent back to the main process w/ each chunk
+# reader and threads set the frame reader of the worker (see set_frame_reader())
+def init_worker(input_path, profile=False, reader='sdk', threads=1):
+    if profile:
+        set_profiler(Profiler())
+    set_frame_reader(reader, threads)
+    dll, tdf_data = open_run(input_path)
+    worker_data['frame_source'] = get_frame_source(dll, tdf_data)
+    worker_data['frame_metadata'] = get_frame_metadata(tdf_data)
+
+
+# get the summed intensity of every feature for a chunk of frames in a worker process, the stages profiled in the
+# worker since the previous chunk (None if profiling is off), and the feature profiles of each frame if
+# feature_profiles is True (None otherwise)
+def get_frames_intensities_worker(frames, features, feature_profiles=False):
+    frame_profiles = [] if feature_profiles else None
+    frame_intensities = get_frames_intensities(worker_data['frame_source'],
+                                               frames,
+                                               worker_data['frame_metadata'],
+                                               features,
+                                               frame_profiles)
+    return frame_intensities, get_profiler().pop(), frame_profiles
+
+
+# split frames into contiguous chunks; several chunks per job keep workers busy when frames differ in cost, and chunks
+# are capped at FRAME_CHUNK_SIZE frames so results can be streamed to a writer as frames complete
+def get_frame_chunks(frames, jobs):
+    chunk_size = min(FRAME_CHUNK_SIZE, max(1, int(np.ceil(len(frames) / (jobs * 4)))))
+    return [frames[i:i + chunk_size] for i in range(0, len(frames), chunk_size)]
+
+
+# yield the summed intensity of every feature for each chunk of frames, in frame order
+# if jobs > 1, chunks are processed by a pool of worker processes that each open their own TDF-SDK handle or peak
+# store; chunks are yielded in frame order so results match a serial run
+# if a FeatureProfileWriter is given, the feature profiles of each chunk are added to it before the chunk is yielded
+def iter_frame_intensities(frame_source, frames, frame_metadata, features, jobs=1, feature_profiles=None):
+    frame_chunks = get_frame_chunks(frames, jobs)
+    if jobs > 1 and len(frame_chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(frame_chunks)),
+                                 initializer=init_worker,
+                                 initargs=(frame_source.source_file,
+                                           get_profiler().enabled,
+                                           frame_reader['reader'],
+                                           frame_reader['threads'])) as executor:
+            chunk_intensities = executor.map(get_frames_intensities_worker,
+                                             frame_chunks,
+                                             [features] * len(frame_chunks),
+                                             [feature_profiles is not None] * len(frame_chunks))
+            for frame_chunk, (frame_intensities, worker_profile, frame_profiles) in zip(frame_chunks,
+                                                                                        chunk_intensities):
+                get_profiler().merge(worker_profile)
+                if feature_profiles is not None:
+                    feature_profiles.add(frame_chunk, frame_profiles)
+                yield frame_chunk, frame_intensities
+    else:
+        for frame_chunk in frame_chunks:
+            frame_profiles = [] if feature_profiles is not None else None
+            frame_intensities = get_frames_intensities(frame_source, frame_chunk, frame_metadata, features,
+                                                       frame_profiles)
+            if feature_profiles is not None:
+                feature_profiles.add(frame_chunk, frame_profiles)
+            yield frame_chunk, frame_intensities
+
+
+# yield the summed intensity of each feature for each chunk of frames, in frame order
+# tdf_data can be a TdfData object (w/ dll from init_tdf_sdk_api()) or a PeakStore (w/ dll = None)
+# each frame is read once for all features; frames are split across worker processes if jobs > 1
+# if a ResultCache is given, only features that are not already cached for this run are extracted, and newly extracted
+# features are added to the cache once every frame has been processed
+# if a FeatureProfileWriter is given, the feature profiles of every frame are added to it; every feature is then
+# extracted from the run since cached intensities have no profiles, but the cache is still updated
+def iter_feature_intensities(dll, tdf_data, features, frame_metadata, jobs=1, cache=None, feature_profiles=None):
+    frame_source = get_frame_source(dll, tdf_data)
+    # MaldiFrameInfo table in analysis.tdf SQL database tells which frame is associated with each spot
+    frames = frame_metadata.frames
+
+    if cache is not None and feature_profiles is None:
+        with get_profiler().stage('cache'):
+            cached_intensities = [cache.get(tdf_data.source_file, feature, frames) for feature in features]
+    else:
+        cached_intensities = [None] * len(features)
+    uncached = [i for i, intensities in enumerate(cached_intensities) if intensities is None]
+    uncached_features = [features[i] for i in uncached]
+    uncached_intensities = np.zeros((len(frames), len(uncached)), dtype=np.int64) if cache is not None else None
+
+    if uncached:
+        chunks = iter_frame_intensities(frame_source, frames, frame_metadata, uncached_features, jobs,
+                                        feature_profiles)
+    else:
+        chunks = ((frame_chunk, [[] for frame in frame_chunk]) for frame_chunk in get_frame_chunks(frames, 1))
+    position = 0
+    for frame_chunk, chunk_intensities in chunks:
+        frame_intensities = []
+        for intensities in chunk_intensities:
+            merged_intensities = [i[position] if i is not None else 0 for i in cached_intensities]
+            for j, i in enumerate(uncached):
+                merged_intensities[i] = intensities[j]
+            if uncached_intensities is not None:
+                uncached_intensities[position] = intensities
+            frame_intensities.append(merged_intensities)
+            position += 1
+        yield frame_chunk, frame_intensities
+
+    if cache is not None and uncached:
+        with get_profiler().stage('cache'):
+            for j, i in enumerate(uncached):
+                cache.put(tdf_data.source_file, features[i], frames, uncached_intensities[:, j].tolist())
+            cache.evict()
+
+
+# convert per-feature intensities into one row per feature per frame
+# rows are returned in feature-major order (all frames for the first feature, then all frames for the second feature,
+# etc.)
+def get_list_of_scan_dicts(frames, frame_metadata, features, feature_intensities):
+    list_of_scan_dicts = []
+    for feature, intensities in zip(features, feature_intensities):
+        for frame, intensity in zip(frames, intensities):
+            list_of_scan_dicts.append({'Frame': frame,
+                                       'Spot': frame_metadata.spot_name[frame],
+                                       'mz': feature['mz'],
+                                       'mz_tolerance': feature['mz_tol'],
+                                       'ook0': feature['ook0'],
+                                       'ook0_tol': feature['ook0_tol'],
+                                       'intensity': intensity})
+    return list_of_scan_dicts
+
+
+# extract the summed intensity of each feature from each MALDI spot and return them as a list of row dicts
+def extract_feature_intensities(dll, tdf_data, features, frame_metadata=None, jobs=1, cache=None):
+    if frame_metadata is None:
+        frame_metadata = get_frame_metadata(tdf_data)
+    frame_intensities = []
+    for frame_chunk, chunk_intensities in iter_feature_intensities(dll, tdf_data, features, frame_metadata, jobs,
+                                                                   cache):
+        frame_intensities += chunk_intensities
+    with get_profiler().stage('rows'):
+        feature_intensities = [[intensities[i] for intensities in frame_intensities] for i in range(len(features))]
+        return get_list_of_scan_dicts(frame_metadata.frames, frame_metadata, features, feature_intensities)
+
+
+# extract the summed intensity of each feature from each MALDI spot and stream them to a FeatureIntensityWriter
+# results are written as each chunk of frames completes so memory use does not grow w/ plate size
+# if a FeatureProfileWriter is given, the feature profiles of every frame are written to it in the same pass
+def write_feature_intensities(dll, tdf_data, features, writer, frame_metadata=None, jobs=1, cache=None,
+                              feature_profiles=None):
+    if frame_metadata is None:
+        frame_metadata = get_frame_metadata(tdf_data)
+    profiler = get_profiler()
+    try:
+        for frame_chunk, chunk_intensities in iter_feature_intensities(dll, tdf_data, features, frame_metadata, jobs,
+                                                                       cache, feature_profiles):
+            with profiler.stage('write'):
+                writer.write(frame_chunk, chunk_intensities)
+        with profiler.stage('write'):
+            writer.close()
+            if feature_profiles is not None:
+                feature_profiles.close()
+    finally:
+        # temporary files written next to the output are removed if extraction fails or is interrupted
+        writer.abort()
+        if feature_profiles is not None:
+            feature_profiles.abort()
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+# sorted interval index over the m/z and 1/K0 windows of a feature list
+# each feature's 1/K0 window is compiled into its scan range once per TIMS calibration, and the scan ranges of all
+# features are flattened into a list of (feature, scan) windows sorted by scan and m/z; in each frame, peaks are sorted
+# by (scan, TOF index) and every window's intensity is found w/ two binary searches into the cumulative peak
+# intensities, so the work per frame scales w/ the number of peaks instead of the number of peaks times the number of
+# features
+class FeatureIndex(object):
+    def __init__(self, features):
+        self.features = features
+        self.mz = np.array([feature['mz'] for feature in features], dtype=np.float64)
+        self.mz_tol = np.array([feature['mz_tol'] for feature in features], dtype=np.float64)
+        self.ook0 = np.array([feature['ook0'] for feature in features], dtype=np.float64)
+        self.ook0_tol = np.array([feature['ook0_tol'] for feature in features], dtype=np.float64)
+        self.scan_windows = {}
+
+    def __len__(self):
+        return len(self.features)
+
+    # get the scan range [scan_begin, scan_end) of each feature and its (feature, scan) windows for a
+    # MobilityCalibration, cached per calibration
+    # returns a dict w/:
+    #     valid: whether any scan is within the 1/K0 tolerance of each feature
+    #     scan_begin, scan_end: the scan range of each feature, and the union of all scan ranges
+    #     lower_features, lower_scans: the feature and scan (relative to the union scan_begin) of each window, sorted by
+    #                                  scan and the lower m/z edge of the feature
+    #     upper_features, upper_scans: the same windows sorted by scan and the upper m/z edge of the feature
+    # TOF index increases w/ m/z, so the binary searches for each window edge are done in (nearly) sorted key order
+    def get_scan_windows(self, mobility_calibration):
+        if mobility_calibration not in self.scan_windows:
+            scan_begin, scan_end, valid = mobility_calibration.get_scan_ranges(self.ook0, self.ook0_tol)
+            scan_windows = {'valid': valid, 'scan_begin': scan_begin, 'scan_end': scan_end}
+            if valid.any():
+                scan_windows['union_scan_begin'] = int(scan_begin[valid].min())
+                scan_windows['union_scan_end'] = int(scan_end[valid].max())
+            num_scans = np.where(valid, np.maximum(scan_end - scan_begin, 0), 0)
+            window_offsets = np.zeros(len(self.features) + 1, dtype=np.int64)
+            window_offsets[1:] = np.cumsum(num_scans)
+            window_features = np.repeat(np.arange(len(self.features), dtype=np.int64), num_scans)
+            # scan of each window = scan_begin of its feature + position of the window within the feature
+            window_scans = scan_begin[window_features] + np.arange(window_offsets[-1], dtype=np.int64) - \
+                window_offsets[window_features]
+            if window_scans.size != 0:
+                window_scans -= scan_windows['union_scan_begin']
+            for edge, edge_mz in [('lower', self.mz - self.mz_tol), ('upper', self.mz + self.mz_tol)]:
+                order = np.lexsort((edge_mz[window_features], window_scans))
+                scan_windows[edge + '_features'] = window_features[order]
+                scan_windows[edge + '_scans'] = window_scans[order]
+            self.scan_windows[mobility_calibration] = scan_windows
+        return self.scan_windows[mobility_calibration]
+
+    # get the summed intensity of every feature from peaks read from the union scan range of a frame
+    # tof_ranges[i] is the TOF index range [tof_begin, tof_end] of the ith feature in the frame
+    def get_intensities(self, scan_windows, scan_offsets, tof_indices, intensities, tof_ranges):
+        feature_intensities = np.zeros(len(self.features), dtype=np.int64)
+        if scan_windows['lower_features'].size == 0 or tof_indices.size == 0:
+            return feature_intensities
+        tof_ranges = np.array(tof_ranges, dtype=np.int64).reshape(len(self.features), 2)
+
+        # (scan, TOF index) key of each peak; the scale is larger than any TOF index so keys never overlap across scans
+        key_scale = int(max(tof_indices.max(), tof_ranges.max(), 0)) + 2
+        peak_keys = np.repeat(np.arange(scan_offsets.size - 1, dtype=np.int64), np.diff(scan_offsets)) * key_scale + \
+            tof_indices
+        # peaks within a scan are normally already sorted by TOF index
+        if np.any(peak_keys[1:] < peak_keys[:-1]):
+            order = np.argsort(peak_keys, kind='stable')
+            peak_keys = peak_keys[order]
+            intensities = intensities[order]
+        cumulative_intensities = np.zeros(intensities.size + 1, dtype=np.int64)
+        cumulative_intensities[1:] = np.cumsum(intensities)
+
+        # Sum intensities of peaks whose m/z value is within tolerance of each feature in each scan of its window
+        # the intensity of a window is the cumulative intensity at its upper edge minus that at its lower edge, so the
+        # upper and lower edges of all windows can be accumulated per feature independently
+        lower_features = scan_windows['lower_features']
+        upper_features = scan_windows['upper_features']
+        lower = np.searchsorted(peak_keys,
+                                scan_windows['lower_scans'] * key_scale + tof_ranges[lower_features, 0],
+                                side='left')
+        upper = np.searchsorted(peak_keys,
+                                scan_windows['upper_scans'] * key_scale + tof_ranges[upper_features, 1],
+                                side='right')
+        np.add.at(feature_intensities, upper_features, cumulative_intensities[upper])
+        np.subtract.at(feature_intensities, lower_features, cumulative_intensities[lower])
+        # this summed intensity is the intensity of mz +/- mz_tol at ook0 +/- ook0_tol
+        feature_intensities[tof_ranges[:, 1] < tof_ranges[:, 0]] = 0
+        return feature_intensities
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import pandas as pd
+import seaborn as sns
+# figures are drawn w/o pyplot so that no GUI backend is needed and rendering never blocks
+from matplotlib.figure import Figure
+
+
+# supported heatmap image formats
+IMAGE_FORMATS = ['png', 'pdf', 'svg']
+# ratio table columns w/ the summed intensity of the features matched to each role
+ROLE_COLUMNS = ['numerator_intensity', 'denominator_intensity', 'IS_intensity']
+
+
+# read a long layout feature intensity table written as CSV, Parquet, or Feather
+def read_intensity_table(path):
+    extension = os.path.splitext(path)[-1].lower()
+    if extension == '.parquet':
+        table = pd.read_parquet(path)
+    elif extension == '.feather':
+        table = pd.read_feather(path)
+    else:
+        table = pd.read_csv(path)
+    if 'intensity' not in table.columns:
+        raise Exception(path + ' is not a long layout feature intensity table.')
+    return table
+
+
+# read one or more feature intensity tables into a single table w/ a "Run" column
+# tables from get_plate_feature_intensities already have a "Run" column; other tables are named after their file
+def read_intensity_tables(paths):
+    tables = []
+    for path in paths:
+        table = read_intensity_table(path)
+        if 'Run' not in table.columns:
+            table.insert(0, 'Run', os.path.splitext(os.path.split(path)[-1])[0])
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+# get the table of numerator, denominator, and internal standard intensities and ratios for each spot of each run
+# features are matched to the numerator and denominator by 1/K0 and to the internal standard by m/z within a
+# tolerance, and the intensities of all features matched to a role in a spot are summed in a single pivot
+def get_ratio_table(results, numerator_ook0, denominator_ook0, IS_mz, ook0_match_tol=0.0005, mz_match_tol=0.0005):
+    spot_columns = ['Run', 'Frame', 'Spot']
+    ratio_table = results[spot_columns].drop_duplicates().reset_index(drop=True)
+    # Split the 'Spot' column into two new columns 'index' and 'integer'
+    ratio_table[['index', 'integer']] = ratio_table['Spot'].str.extract(r'([A-Za-z]+)(\d+)', expand=True)
+
+    roles = {'numerator_intensity': (results['ook0'] - numerator_ook0).abs() <= ook0_match_tol,
+             'denominator_intensity': (results['ook0'] - denominator_ook0).abs() <= ook0_match_tol,
+             'IS_intensity': (results['mz'] - IS_mz).abs() <= mz_match_tol}
+    role_intensities = pd.concat([results.loc[mask, spot_columns + ['intensity']].assign(role=role)
+                                  for role, mask in roles.items()])
+    if not role_intensities.empty:
+        role_pivot = role_intensities.pivot_table(index=spot_columns,
+                                                  columns='role',
+                                                  values='intensity',
+                                                  aggfunc='sum').reset_index()
+        ratio_table = ratio_table.merge(role_pivot, on=spot_columns, how='left')
+    ratio_table = ratio_table.reindex(columns=spot_columns + ['index', 'integer'] + ROLE_COLUMNS)
+    # spots w/o a feature matched to a role have an intensity of 0 for that role
+    ratio_table[ROLE_COLUMNS] = ratio_table[ROLE_COLUMNS].fillna(0).astype(float)
+
+    # Calculate the ratio based on 'numerator_intensity' and 'denominator_intensity'
+    ratio_table['ratio'] = ratio_table['numerator_intensity'] / ratio_table['denominator_intensity']
+    # normalize to internal standard
+    ratio_table['n_ratio'] = ratio_table['ratio'] / ratio_table['IS_intensity']
+    return ratio_table.sort_values(['Run', 'Frame'], kind='stable').reset_index(drop=True)
+
+
+# get the mean normalized ratio of each spot of a run as a plate layout table w/ rows (e.g. A, B, ..., AA) and columns
+# (1, 2, ...) in plate order
+def get_heatmap_data(ratio_table):
+    heatmap_data = ratio_table.groupby(['index', 'integer'])['n_ratio'].mean().unstack()
+    heatmap_data = heatmap_data.reindex(index=sorted(heatmap_data.index, key=lambda i: (len(i), i)),
+                                        columns=sorted(heatmap_data.columns, key=int))
+    heatmap_data.index.name = 'index'
+    heatmap_data.columns.name = 'integer'
+    return heatmap_data.astype(float)
+
+
+# draw a heatmap of normalized ratios on a matplotlib Axes
+def plot_heatmap(ax, heatmap_data, title, vmin=None, vmax=None, cbar=True):
+    # ratios w/ a denominator or internal standard intensity of 0 are left blank
+    sns.heatmap(heatmap_data.replace([np.inf, -np.inf], np.nan),
+                ax=ax,
+                annot=False,
+                cmap='viridis',
+                vmin=vmin,
+                vmax=vmax,
+                cbar=cbar,
+                cbar_kws={'label': 'Normalized Ratio'} if cbar else None)
+    ax.set_title(title)
+    ax.set_xlabel('Integer')
+    ax.set_ylabel('Index')
+
+
+# save a heatmap of the normalized ratios of a single run
+def save_heatmap(heatmap_data, path, title='Heatmap of Mean Ratio Values'):
+    figure = Figure(figsize=(10, 8), constrained_layout=True)
+    plot_heatmap(figure.subplots(), heatmap_data, title)
+    figure.savefig(path)
+
+
+# save the heatmaps of several runs as a single montage w/ a shared color scale
+def save_heatmap_montage(heatmaps, path):
+    num_columns = int(np.ceil(np.sqrt(len(heatmaps))))
+    num_rows = int(np.ceil(len(heatmaps) / num_columns))
+    figure = Figure(figsize=(6 * num_columns, 5 * num_rows), constrained_layout=True)
+    axes = figure.subplots(num_rows, num_columns, squeeze=False).ravel()
+    values = np.concatenate([i.values.ravel() for i in heatmaps.values()])
+    values = values[np.isfinite(values)]
+    vmin = values.min() if values.size != 0 else None
+    vmax = values.max() if values.size != 0 else None
+    for ax, (run_name, heatmap_data) in zip(axes, heatmaps.items()):
+        plot_heatmap(ax, heatmap_data, str(run_name), vmin, vmax, cbar=False)
+    for ax in axes[len(heatmaps):]:
+        ax.set_visible(False)
+    figure.colorbar(axes[0].collections[0], ax=axes[:len(heatmaps)].tolist(), label='Normalized Ratio')
+    figure.savefig(path)
+
+
+# write the heatmap data table and heatmap image of each run to outdir, and a montage of all runs if there is more than
+# one run
+# files are named heatmap_data.csv and heatmap.<image_format> for a single run, or prefixed w/ the run name otherwise
+def write_heatmaps(ratio_table, outdir, image_format='png'):
+    if image_format not in IMAGE_FORMATS:
+        raise Exception('Image format must be one of: ' + ', '.join(IMAGE_FORMATS))
+    run_names = list(dict.fromkeys(ratio_table['Run'].tolist()))
+    heatmaps = {}
+    for run_name in run_names:
+        heatmap_data = get_heatmap_data(ratio_table[ratio_table['Run'] == run_name])
+        prefix = str(run_name) + '_' if len(run_names) > 1 else ''
+        heatmap_data.to_csv(os.path.join(outdir, prefix + 'heatmap_data.csv'))
+        save_heatmap(heatmap_data,
+                     os.path.join(outdir, prefix + 'heatmap.' + image_format),
+                     'Heatmap of Mean Ratio Values' + (' (' + str(run_name) + ')' if len(run_names) > 1 else ''))
+        heatmaps[run_name] = heatmap_data
+    if len(heatmaps) > 1:
+        save_heatmap_montage(heatmaps, os.path.join(outdir, 'heatmap_montage.' + image_format))
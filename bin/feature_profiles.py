@@ -0,0 +1,363 @@
+from bin.tdf_source import MobilityCalibration
+
+import os
+import shutil
+import zipfile
+import tempfile
+import numpy as np
+import pandas as pd
+import argparse
+
+
+# suffix of the feature profile file written next to an output file
+FEATURE_PROFILES_SUFFIX = '_feature_profiles.npz'
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input',
+                        help='Feature profile file (.npz) written w/ --feature_profiles.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--outdir',
+                        help='Path to folder in which to write output file. Default = same as input path.',
+                        default='',
+                        type=str)
+    parser.add_argument('--outfile',
+                        help='User defined filename for output file. Default = input file name w/ a .csv extension.',
+                        default='',
+                        type=str)
+    parser.add_argument('--ook0_tol',
+                        help='1/K0 tolerance applied to every feature. Must not be wider than the 1/K0 tolerance '
+                             'each feature was extracted w/. Default = 1/K0 tolerance of each feature.',
+                        default=None,
+                        type=float)
+    parser.add_argument('--mz_tol',
+                        help='m/z tolerance applied to every feature. Must not be wider than the m/z tolerance each '
+                             'feature was extracted w/. Default = m/z tolerance of each feature.',
+                        default=None,
+                        type=float)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# get the default path of the feature profile file for an output file
+def get_feature_profiles_path(outfile):
+    return os.path.splitext(outfile)[0] + FEATURE_PROFILES_SUFFIX
+
+
+# get the mobilogram and m/z profile of every feature in a single frame from the peaks read for get_intensities()
+# the mobilogram of a feature is the summed intensity of its m/z window in each scan of its scan range (one bin per
+# scan), and its m/z profile is the summed intensity of its scan range at each TOF index w/ a peak in its m/z window
+# (one bin per TOF index, stored sparsely w/ the m/z value of each TOF index); both sum to the feature's intensity
+# tof_ranges is None if no peaks were read, in which case every mobilogram is empty
+# returns a dict of flat arrays w/ the mobilograms and m/z profiles of all features concatenated in feature order
+def get_frame_profiles(frame_source, frame, mobility_calibration, scan_windows, scan_offsets, tof_indices, intensities,
+                       tof_ranges):
+    valid = scan_windows['valid']
+    scan_begin = np.where(valid, scan_windows['scan_begin'], 0).astype(np.int64)
+    mobilogram_lengths = np.where(valid, np.maximum(scan_windows['scan_end'] - scan_begin, 0), 0).astype(np.int64)
+    mobilogram_offsets = np.zeros(valid.size + 1, dtype=np.int64)
+    mobilogram_offsets[1:] = np.cumsum(mobilogram_lengths)
+    mobilograms = np.zeros(mobilogram_offsets[-1], dtype=np.int64)
+    mz_lengths = np.zeros(valid.size, dtype=np.int64)
+    mz_tof_indices = []
+    mz_intensities = []
+
+    if tof_ranges is not None and tof_indices.size != 0:
+        union_scan_begin = scan_windows['union_scan_begin']
+        peak_scans = np.repeat(np.arange(scan_offsets.size - 1, dtype=np.int64) + union_scan_begin,
+                               np.diff(scan_offsets))
+        for i, (tof_begin, tof_end) in enumerate(tof_ranges):
+            if mobilogram_lengths[i] == 0 or tof_end < tof_begin:
+                continue
+            # peaks in scans [scan_begin, scan_end) of the feature w/ TOF index in [tof_begin, tof_end]
+            peak_begin = scan_offsets[scan_begin[i] - union_scan_begin]
+            peak_end = scan_offsets[scan_begin[i] + mobilogram_lengths[i] - union_scan_begin]
+            feature_tof_indices = tof_indices[peak_begin:peak_end]
+            within = (feature_tof_indices >= tof_begin) & (feature_tof_indices <= tof_end)
+            if not within.any():
+                continue
+            feature_intensities = intensities[peak_begin:peak_end][within]
+            mobilograms[mobilogram_offsets[i]:mobilogram_offsets[i + 1]] = \
+                np.bincount(peak_scans[peak_begin:peak_end][within] - scan_begin[i],
+                            weights=feature_intensities,
+                            minlength=mobilogram_lengths[i])
+            feature_tof_indices, tof_positions = np.unique(feature_tof_indices[within], return_inverse=True)
+            mz_tof_indices.append(feature_tof_indices)
+            mz_intensities.append(np.bincount(tof_positions, weights=feature_intensities).astype(np.int64))
+            mz_lengths[i] = feature_tof_indices.size
+
+    mz_tof_indices = np.concatenate(mz_tof_indices) if mz_tof_indices else np.zeros(0, dtype=np.int64)
+    mz_values = frame_source.index_to_mz(frame, mz_tof_indices) if mz_tof_indices.size != 0 \
+        else np.zeros(0, dtype=np.float64)
+    return {'scan_ook0': mobility_calibration.scan_ook0,
+            'scan_scannums': mobility_calibration.scan_scannums,
+            'scan_begin': scan_begin,
+            'mobilogram_lengths': mobilogram_lengths,
+            'mobilograms': mobilograms,
+            'mz_lengths': mz_lengths,
+            'mz_tof_indices': mz_tof_indices,
+            'mz_values': np.asarray(mz_values, dtype=np.float64),
+            'mz_intensities': np.concatenate(mz_intensities) if mz_intensities else np.zeros(0, dtype=np.int64)}
+
+
+# arrays of get_frame_profiles() that are appended to raw binary files as frames complete, and their data types
+# scan_begin, mobilogram_lengths, and mz_lengths have one value per feature per frame; the others are ragged
+PROFILE_COLUMNS = {'scan_begin': np.int64,
+                   'mobilogram_lengths': np.int64,
+                   'mz_lengths': np.int64,
+                   'mobilograms': np.int64,
+                   'mz_tof_indices': np.int64,
+                   'mz_values': np.float64,
+                   'mz_intensities': np.int64}
+# number of bytes copied at once from a spilled array into the .npz file
+SPILL_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+# open a new .npy array in an .npz file and write its header
+def open_npz_array(npz_file, name, dtype, shape):
+    npy_file = npz_file.open(name + '.npy', 'w', force_zip64=True)
+    np.lib.format.write_array_header_2_0(npy_file, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                    'fortran_order': False,
+                                                    'shape': tuple(shape)})
+    return npy_file
+
+
+# writer for the per-feature mobilograms and m/z profiles of a run, saved as a single compressed .npz file
+# add() is called w/ the frame profiles of each chunk of completed frames; profiles are appended to raw binary files in
+# a temporary folder next to the output file as they are added, and are copied block by block into the .npz file in
+# close(), so memory use does not grow w/ plate size
+# the file contains, for F frames (in the order they were added, i.e. frame ID order) and K features:
+#     frames, spots: frame ID and spot name of each frame
+#     features: (K, 4) array of mz, mz_tol, ook0, and ook0_tol of each feature
+#     frame_calibration: index of the 1/K0 calibration of each frame
+#     calibration_offsets, calibration_ook0, calibration_scannums: 1/K0 value of each scan number and the scan number
+#                                                                  it maps back to, for calibration c in
+#                                                                  [calibration_offsets[c], calibration_offsets[c + 1])
+#     mobilogram_scan_begin: (F, K) array w/ the first scan of each mobilogram
+#     mobilogram_offsets, mobilogram_intensities: mobilogram of feature k in frame f in
+#                                                 mobilogram_intensities[mobilogram_offsets[f * K + k]:
+#                                                                        mobilogram_offsets[f * K + k + 1]]
+#     mz_profile_offsets, mz_profile_tof_indices, mz_profile_mz, mz_profile_intensities: m/z profile of feature k in
+#                                                                                       frame f, indexed the same way
+class FeatureProfileWriter(object):
+    def __init__(self, path, features, frame_metadata):
+        self.path = path
+        self.features = features
+        self.frame_metadata = frame_metadata
+        self.frames = []
+        self.calibration_keys = {}
+        self.calibration_ook0 = []
+        self.calibration_scannums = []
+        self.frame_calibration = []
+        self.spill_dir = tempfile.mkdtemp(suffix='_feature_profiles', dir=os.path.dirname(os.path.abspath(path)))
+        self.column_files = {i: open(os.path.join(self.spill_dir, i + '.bin'), 'wb') for i in PROFILE_COLUMNS}
+        self.column_lengths = dict.fromkeys(PROFILE_COLUMNS, 0)
+
+    # add the frame profiles of a chunk of frames; chunk_profiles[i] is the result of get_frame_profiles() for frames[i]
+    def add(self, frames, chunk_profiles):
+        for frame, frame_profiles in zip(frames, chunk_profiles):
+            self.frames.append(frame)
+            for i, dtype in PROFILE_COLUMNS.items():
+                values = np.asarray(frame_profiles[i], dtype=dtype)
+                self.column_files[i].write(values.tobytes())
+                self.column_lengths[i] += values.size
+
+            # frames w/ the same TIMS calibration and number of scans share a 1/K0 calibration
+            key = (self.frame_metadata.tims_calibration[frame], self.frame_metadata.num_scans[frame])
+            if key not in self.calibration_keys:
+                self.calibration_keys[key] = len(self.calibration_keys)
+                self.calibration_ook0.append(np.asarray(frame_profiles['scan_ook0'], dtype=np.float64))
+                self.calibration_scannums.append(np.asarray(frame_profiles['scan_scannums'], dtype=np.int64))
+            self.frame_calibration.append(self.calibration_keys[key])
+
+    # copy a spilled array into the .npz file w/ the given shape
+    def write_column(self, npz_file, name, column, shape):
+        with open_npz_array(npz_file, name, PROFILE_COLUMNS[column], shape) as npy_file, \
+                open(os.path.join(self.spill_dir, column + '.bin'), 'rb') as column_file:
+            shutil.copyfileobj(column_file, npy_file, SPILL_BLOCK_SIZE)
+
+    # write the offsets of a ragged array into the .npz file from its spilled lengths
+    def write_offsets(self, npz_file, name, lengths_column):
+        block_size = SPILL_BLOCK_SIZE // 8
+        with open_npz_array(npz_file, name, np.int64, (self.column_lengths[lengths_column] + 1,)) as npy_file, \
+                open(os.path.join(self.spill_dir, lengths_column + '.bin'), 'rb') as lengths_file:
+            offset = np.zeros(1, dtype=np.int64)
+            npy_file.write(offset.tobytes())
+            for block in iter(lambda: lengths_file.read(block_size * 8), b''):
+                offsets = offset[-1] + np.cumsum(np.frombuffer(block, dtype=np.int64))
+                npy_file.write(offsets.tobytes())
+                offset = offsets[-1:]
+
+    # write the profiles of every frame added so far to the .npz file and remove the spilled arrays
+    def close(self):
+        try:
+            for column_file in self.column_files.values():
+                column_file.close()
+            num_frames = len(self.frames)
+            num_features = len(self.features)
+            calibration_offsets = np.zeros(len(self.calibration_ook0) + 1, dtype=np.int64)
+            calibration_offsets[1:] = np.cumsum([i.size for i in self.calibration_ook0])
+            arrays = {'frames': np.array(self.frames, dtype=np.int64),
+                      'spots': np.array([str(self.frame_metadata.spot_name[i]) for i in self.frames], dtype=str),
+                      'features': np.array([[i['mz'], i['mz_tol'], i['ook0'], i['ook0_tol']] for i in self.features],
+                                           dtype=np.float64).reshape(num_features, 4),
+                      'frame_calibration': np.array(self.frame_calibration, dtype=np.int64),
+                      'calibration_offsets': calibration_offsets,
+                      'calibration_ook0': np.concatenate(self.calibration_ook0 + [np.zeros(0, dtype=np.float64)]),
+                      'calibration_scannums': np.concatenate(self.calibration_scannums +
+                                                             [np.zeros(0, dtype=np.int64)])}
+            # same layout as np.savez_compressed, but spilled arrays are streamed into the file
+            with zipfile.ZipFile(self.path, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npz_file:
+                for name, array in arrays.items():
+                    with npz_file.open(name + '.npy', 'w', force_zip64=True) as npy_file:
+                        np.lib.format.write_array(npy_file, array, allow_pickle=False)
+                self.write_column(npz_file, 'mobilogram_scan_begin', 'scan_begin', (num_frames, num_features))
+                self.write_offsets(npz_file, 'mobilogram_offsets', 'mobilogram_lengths')
+                self.write_column(npz_file, 'mobilogram_intensities', 'mobilograms',
+                                  (self.column_lengths['mobilograms'],))
+                self.write_offsets(npz_file, 'mz_profile_offsets', 'mz_lengths')
+                self.write_column(npz_file, 'mz_profile_tof_indices', 'mz_tof_indices',
+                                  (self.column_lengths['mz_tof_indices'],))
+                self.write_column(npz_file, 'mz_profile_mz', 'mz_values', (self.column_lengths['mz_values'],))
+                self.write_column(npz_file, 'mz_profile_intensities', 'mz_intensities',
+                                  (self.column_lengths['mz_intensities'],))
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    # remove the spilled arrays w/o writing the .npz file, e.g. if extraction failed
+    # does nothing if the writer was already closed
+    def abort(self):
+        for column_file in self.column_files.values():
+            column_file.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+# per-feature mobilograms and m/z profiles read from a file written by FeatureProfileWriter
+# the summed intensity of each feature can be recomputed for a narrower 1/K0 or m/z window w/o reading the run again:
+# the mobilogram keeps the full m/z window of each scan and the m/z profile keeps the full 1/K0 window of each TOF
+# index, so one window can be narrowed at a time
+class FeatureProfiles(object):
+    def __init__(self, path):
+        with np.load(path) as profile_file:
+            self.data = {i: profile_file[i] for i in profile_file.files}
+        self.frames = self.data['frames'].tolist()
+        self.spots = self.data['spots'].tolist()
+        self.features = [{'mz': mz, 'mz_tol': mz_tol, 'ook0': ook0, 'ook0_tol': ook0_tol}
+                         for mz, mz_tol, ook0, ook0_tol in self.data['features'].tolist()]
+        self.frame_positions = dict(zip(self.frames, range(len(self.frames))))
+        offsets = self.data['calibration_offsets']
+        self.mobility_calibrations = [MobilityCalibration(self.data['calibration_ook0'][offsets[i]:offsets[i + 1]],
+                                                          self.data['calibration_scannums'][offsets[i]:offsets[i + 1]])
+                                      for i in range(offsets.size - 1)]
+
+    # get the scan numbers, 1/K0 values, and summed intensities of the mobilogram of the ith feature in a frame
+    def get_mobilogram(self, frame, i):
+        position = self.frame_positions[frame]
+        j = position * len(self.features) + i
+        intensities = self.data['mobilogram_intensities'][self.data['mobilogram_offsets'][j]:
+                                                          self.data['mobilogram_offsets'][j + 1]]
+        scans = self.data['mobilogram_scan_begin'][position, i] + np.arange(intensities.size, dtype=np.int64)
+        scan_ook0 = self.mobility_calibrations[self.data['frame_calibration'][position]].scan_ook0
+        return scans, scan_ook0[np.minimum(scans, scan_ook0.size - 1)], intensities
+
+    # get the TOF indices, m/z values, and summed intensities of the m/z profile of the ith feature in a frame
+    def get_mz_profile(self, frame, i):
+        j = self.frame_positions[frame] * len(self.features) + i
+        begin = self.data['mz_profile_offsets'][j]
+        end = self.data['mz_profile_offsets'][j + 1]
+        return (self.data['mz_profile_tof_indices'][begin:end],
+                self.data['mz_profile_mz'][begin:end],
+                self.data['mz_profile_intensities'][begin:end])
+
+    # get the (F, K) array of the summed intensity of each feature (columns) in each frame (rows) w/ the given 1/K0 or
+    # m/z tolerance (a single value or one value per feature) instead of the tolerance it was extracted w/
+    # tolerances can only be narrowed, and only one of ook0_tol and mz_tol can be narrowed at a time
+    def get_intensities(self, ook0_tol=None, mz_tol=None):
+        num_features = len(self.features)
+        features = self.data['features']
+        if ook0_tol is not None and mz_tol is not None:
+            raise Exception('Feature profiles can only be used to narrow either the 1/K0 or the m/z tolerance, not '
+                            'both.')
+        if ook0_tol is not None:
+            ook0_tol = np.broadcast_to(np.asarray(ook0_tol, dtype=np.float64), (num_features,))
+            if np.any(ook0_tol > features[:, 3]):
+                raise Exception('1/K0 tolerance cannot be wider than the 1/K0 tolerance features were extracted w/.')
+        if mz_tol is not None:
+            mz_tol = np.broadcast_to(np.asarray(mz_tol, dtype=np.float64), (num_features,))
+            if np.any(mz_tol > features[:, 1]):
+                raise Exception('m/z tolerance cannot be wider than the m/z tolerance features were extracted w/.')
+
+        if mz_tol is not None:
+            # sum the m/z profile bins whose m/z value is within the new m/z window
+            mz_offsets = self.data['mz_profile_offsets']
+            profile_features = np.repeat(np.arange(len(self.frames) * num_features, dtype=np.int64),
+                                         np.diff(mz_offsets))
+            feature_mz = features[profile_features % num_features, 0] if num_features else np.zeros(0)
+            profile_mz = self.data['mz_profile_mz']
+            within = (profile_mz >= feature_mz - mz_tol[profile_features % num_features]) & \
+                (profile_mz <= feature_mz + mz_tol[profile_features % num_features])
+            intensities = np.zeros(len(self.frames) * num_features, dtype=np.int64)
+            np.add.at(intensities, profile_features[within], self.data['mz_profile_intensities'][within])
+            return intensities.reshape(len(self.frames), num_features)
+
+        # sum the mobilogram bins whose scan is within the new scan range of each feature
+        mobilogram_offsets = self.data['mobilogram_offsets']
+        cumulative_intensities = np.zeros(self.data['mobilogram_intensities'].size + 1, dtype=np.int64)
+        cumulative_intensities[1:] = np.cumsum(self.data['mobilogram_intensities'])
+        lengths = np.diff(mobilogram_offsets).reshape(len(self.frames), num_features)
+        scan_begin = self.data['mobilogram_scan_begin']
+        new_scan_begin = scan_begin.copy()
+        new_scan_end = scan_begin + lengths
+        if ook0_tol is not None:
+            for i, mobility_calibration in enumerate(self.mobility_calibrations):
+                calibration_frames = self.data['frame_calibration'] == i
+                begin, end, valid = mobility_calibration.get_scan_ranges(features[:, 2], ook0_tol)
+                new_scan_begin[calibration_frames] = np.where(valid, begin, 0)
+                new_scan_end[calibration_frames] = np.where(valid, end, 0)
+        begin = mobilogram_offsets[:-1].reshape(len(self.frames), num_features) + \
+            np.clip(new_scan_begin - scan_begin, 0, lengths)
+        end = mobilogram_offsets[:-1].reshape(len(self.frames), num_features) + \
+            np.clip(new_scan_end - scan_begin, 0, lengths)
+        return cumulative_intensities[np.maximum(begin, end)] - cumulative_intensities[begin]
+
+    # get the summed intensities from get_intensities() as long layout rows (one row per feature per frame, in
+    # feature-major order) w/ the tolerances they were computed w/
+    def get_intensity_table(self, ook0_tol=None, mz_tol=None):
+        intensities = self.get_intensities(ook0_tol, mz_tol)
+        num_features = len(self.features)
+        features = self.data['features']
+        mz_tol = features[:, 1] if mz_tol is None else np.broadcast_to(np.asarray(mz_tol, dtype=np.float64),
+                                                                       (num_features,))
+        ook0_tol = features[:, 3] if ook0_tol is None else np.broadcast_to(np.asarray(ook0_tol, dtype=np.float64),
+                                                                           (num_features,))
+        return pd.DataFrame({'Frame': np.tile(self.frames, num_features),
+                             'Spot': np.tile(np.array(self.spots, dtype=object), num_features),
+                             'mz': np.repeat(features[:, 0], len(self.frames)),
+                             'mz_tolerance': np.repeat(mz_tol, len(self.frames)),
+                             'ook0': np.repeat(features[:, 2], len(self.frames)),
+                             'ook0_tol': np.repeat(ook0_tol, len(self.frames)),
+                             'intensity': intensities.T.ravel()})
+
+
+def run():
+    # Parse arguments
+    args = get_args()
+
+    # Set output directory to default if not specified.
+    if args['outdir'] == '':
+        args['outdir'] = os.path.split(args['input'])[0]
+
+    if args['outfile'] == '':
+        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + '.csv'
+
+    feature_profiles = FeatureProfiles(args['input'])
+    feature_profiles.get_intensity_table(args['ook0_tol'], args['mz_tol']).to_csv(os.path.join(args['outdir'],
+                                                                                               args['outfile']),
+                                                                                  index=False)
+
+
+if __name__ == "__main__":
+    run()
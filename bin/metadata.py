@@ -0,0 +1,24 @@
+# frame/spot metadata index for a MALDI AutoXecute run
+# built once per run from the Frames and MaldiFrameInfo tables in analysis.tdf so that per-frame lookups are O(1)
+# dict lookups instead of a full DataFrame column scan for every frame
+class FrameMetadataIndex(object):
+    def __init__(self, tdf_data):
+        frames_df = tdf_data.analysis['Frames']
+        maldiframeinfo_df = tdf_data.analysis['MaldiFrameInfo']
+
+        # frame ID -> Frames table values
+        frame_ids = [int(i) for i in frames_df['Id'].tolist()]
+        self.num_scans = dict(zip(frame_ids, [int(i) for i in frames_df['NumScans'].tolist()]))
+        self.tims_calibration = dict(zip(frame_ids, frames_df['TimsCalibration'].tolist()))
+        self.mz_calibration = dict(zip(frame_ids, frames_df['MzCalibration'].tolist()))
+
+        # frame ID -> MaldiFrameInfo table values
+        maldi_frame_ids = [int(i) for i in maldiframeinfo_df['Frame'].tolist()]
+        self.spot_name = dict(zip(maldi_frame_ids, maldiframeinfo_df['SpotName'].tolist()))
+
+        # Each frame == one spectrum from a MALDI spot
+        # only frames listed in MaldiFrameInfo that are also present in Frames are processed, in frame ID order
+        self.frames = sorted([i for i in set(maldi_frame_ids) if i in self.num_scans])
+
+    def __len__(self):
+        return len(self.frames)
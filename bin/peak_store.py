@@ -0,0 +1,252 @@
+from bin.metadata import FrameMetadataIndex
+from bin.tdf_source import MobilityCalibration, TdfFrameSource
+from bin.cache import get_run_fingerprint
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import argparse
+
+
+# file that describes a peak store; a folder is only treated as a peak store once this file has been written
+PEAK_STORE_FILE = 'peak_store.json'
+# per-peak and per-TOF index columns stored as raw binary files that are memory-mapped when the store is opened
+PEAK_STORE_COLUMNS = ['scans', 'tof_indices', 'intensities', 'mz_tof_indices', 'mz_values']
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input',
+                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--outdir',
+                        help='Path to folder in which to write the peak store. Default = same as input path.',
+                        default='',
+                        type=str)
+    parser.add_argument('--outfile',
+                        help='User defined folder name for the peak store. Will use the ".d" directory name w/ a '
+                             '".peaks" extension if none is specified.',
+                        default='',
+                        type=str)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# check whether a path is a peak store written by export_peak_store()
+def is_peak_store(input_path):
+    return os.path.isfile(os.path.join(input_path, PEAK_STORE_FILE))
+
+
+# export every peak in every MALDI frame of a .d run to a columnar peak store that can be memory-mapped
+# the store contains:
+#     - per-peak scan number, TOF index, and intensity columns, w/ peaks from each frame stored contiguously in scan
+#       order and located through a frame offset index
+#     - the unique TOF indices of each frame and their m/z values, replacing the TDF-SDK m/z calibration
+#     - the scan -> 1/K0 -> scan number arrays for each TIMS calibration, replacing the TDF-SDK mobility calibration
+#     - the Frames and MaldiFrameInfo tables from analysis.tdf
+def export_peak_store(dll, tdf_data, store_path, frame_metadata=None):
+    if frame_metadata is None:
+        frame_metadata = FrameMetadataIndex(tdf_data)
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    frame_source = TdfFrameSource(dll, tdf_data)
+    frames = frame_metadata.frames
+    scan_dtype = np.uint16 if max([frame_metadata.num_scans[i] for i in frames] + [0]) <= np.iinfo(np.uint16).max \
+        else np.uint32
+    dtypes = {'scans': scan_dtype,
+              'tof_indices': np.uint32,
+              'intensities': np.uint32,
+              'mz_tof_indices': np.uint32,
+              'mz_values': np.float64}
+
+    peak_offsets = [0]
+    mz_offsets = [0]
+    mobility_keys = {}
+    frame_mobility = []
+    mobility_offsets = [0]
+    mobility_ook0 = []
+    mobility_scannums = []
+    # columns are streamed to disk one frame at a time so memory use does not grow w/ plate size
+    column_files = {i: open(os.path.join(store_path, i + '.bin'), 'wb') for i in PEAK_STORE_COLUMNS}
+    try:
+        for frame in frames:
+            num_scans = frame_metadata.num_scans[frame]
+            scan_offsets, tof_indices, intensities = frame_source.read_scans(frame, 0, num_scans)
+            scans = np.repeat(np.arange(num_scans), np.diff(scan_offsets))
+            column_files['scans'].write(scans.astype(dtypes['scans']).tobytes())
+            column_files['tof_indices'].write(tof_indices.astype(dtypes['tof_indices']).tobytes())
+            column_files['intensities'].write(intensities.astype(dtypes['intensities']).tobytes())
+            peak_offsets.append(peak_offsets[-1] + tof_indices.size)
+
+            # m/z calibration depends on the frame, so the m/z value of each unique TOF index is stored per frame
+            mz_tof_indices = np.unique(tof_indices)
+            if mz_tof_indices.size != 0:
+                mz_values = frame_source.index_to_mz(frame, mz_tof_indices)
+            else:
+                mz_values = np.zeros(0, dtype=np.float64)
+            column_files['mz_tof_indices'].write(mz_tof_indices.astype(dtypes['mz_tof_indices']).tobytes())
+            column_files['mz_values'].write(np.asarray(mz_values).astype(dtypes['mz_values']).tobytes())
+            mz_offsets.append(mz_offsets[-1] + mz_tof_indices.size)
+
+            # mobility calibration arrays are stored once per TIMS calibration
+            key = (frame_metadata.tims_calibration[frame], num_scans)
+            if key not in mobility_keys:
+                ook0_array, scannum_array = frame_source.get_mobility_arrays(frame, num_scans)
+                mobility_keys[key] = len(mobility_keys)
+                mobility_ook0.append(ook0_array)
+                mobility_scannums.append(scannum_array)
+                mobility_offsets.append(mobility_offsets[-1] + ook0_array.size)
+            frame_mobility.append(mobility_keys[key])
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+
+    np.save(os.path.join(store_path, 'frames.npy'), np.array(frames, dtype=np.int64))
+    np.save(os.path.join(store_path, 'peak_offsets.npy'), np.array(peak_offsets, dtype=np.int64))
+    np.save(os.path.join(store_path, 'mz_offsets.npy'), np.array(mz_offsets, dtype=np.int64))
+    np.save(os.path.join(store_path, 'frame_mobility.npy'), np.array(frame_mobility, dtype=np.int64))
+    np.save(os.path.join(store_path, 'mobility_offsets.npy'), np.array(mobility_offsets, dtype=np.int64))
+    np.save(os.path.join(store_path, 'mobility_ook0.npy'),
+            np.concatenate(mobility_ook0) if mobility_ook0 else np.zeros(0, dtype=np.float64))
+    np.save(os.path.join(store_path, 'mobility_scannums.npy'),
+            np.concatenate(mobility_scannums) if mobility_scannums else np.zeros(0, dtype=np.int64))
+    tdf_data.analysis['Frames'].to_csv(os.path.join(store_path, 'Frames.csv'), index=False)
+    tdf_data.analysis['MaldiFrameInfo'].to_csv(os.path.join(store_path, 'MaldiFrameInfo.csv'), index=False)
+
+    # written last so that an interrupted export is never mistaken for a complete peak store
+    with open(os.path.join(store_path, PEAK_STORE_FILE), 'w') as store_file:
+        json.dump({'version': 1,
+                   'source': os.path.abspath(tdf_data.source_file),
+                   'fingerprint': get_run_fingerprint(tdf_data.source_file),
+                   'frames': len(frames),
+                   'columns': {i: {'dtype': np.dtype(dtypes[i]).name,
+                                   'length': peak_offsets[-1] if i in ['scans', 'tof_indices', 'intensities']
+                                   else mz_offsets[-1]}
+                               for i in PEAK_STORE_COLUMNS}},
+                  store_file,
+                  indent=4)
+
+
+# memory-mapped peak store written by export_peak_store()
+# provides the same analysis tables as TdfData so it can be used w/ FrameMetadataIndex and extract_feature_intensities
+class PeakStore(object):
+    def __init__(self, store_path):
+        self.source_file = store_path
+        with open(os.path.join(store_path, PEAK_STORE_FILE), 'r') as store_file:
+            self.info = json.load(store_file)
+        self.analysis = {'Frames': pd.read_csv(os.path.join(store_path, 'Frames.csv')),
+                         'MaldiFrameInfo': pd.read_csv(os.path.join(store_path, 'MaldiFrameInfo.csv'),
+                                                       dtype={'SpotName': str},
+                                                       keep_default_na=False)}
+
+        frames = np.load(os.path.join(store_path, 'frames.npy'))
+        self.frame_index = dict(zip(frames.tolist(), range(frames.size)))
+        self.peak_offsets = np.load(os.path.join(store_path, 'peak_offsets.npy'))
+        self.mz_offsets = np.load(os.path.join(store_path, 'mz_offsets.npy'))
+        self.frame_mobility = np.load(os.path.join(store_path, 'frame_mobility.npy'))
+        self.mobility_offsets = np.load(os.path.join(store_path, 'mobility_offsets.npy'))
+        self.mobility_ook0 = np.load(os.path.join(store_path, 'mobility_ook0.npy'))
+        self.mobility_scannums = np.load(os.path.join(store_path, 'mobility_scannums.npy'))
+
+        self.columns = {}
+        for column, column_info in self.info['columns'].items():
+            if column_info['length'] == 0:
+                self.columns[column] = np.zeros(0, dtype=column_info['dtype'])
+            else:
+                self.columns[column] = np.memmap(os.path.join(store_path, column + '.bin'),
+                                                 dtype=column_info['dtype'],
+                                                 mode='r',
+                                                 shape=(column_info['length'],))
+
+
+# frame source that reads peaks and calibration from a PeakStore w/o a TDF-SDK handle
+class PeakStoreFrameSource(object):
+    def __init__(self, peak_store):
+        self.peak_store = peak_store
+        self.source_file = peak_store.source_file
+        self.mobility_calibrations = {}
+
+    # get the MobilityCalibration lookup table for a frame from the stored calibration arrays
+    def get_mobility_calibration(self, frame, num_scans, tims_calibration):
+        mobility = int(self.peak_store.frame_mobility[self.peak_store.frame_index[frame]])
+        if mobility not in self.mobility_calibrations:
+            begin = self.peak_store.mobility_offsets[mobility]
+            end = self.peak_store.mobility_offsets[mobility + 1]
+            self.mobility_calibrations[mobility] = MobilityCalibration(self.peak_store.mobility_ook0[begin:end],
+                                                                       self.peak_store.mobility_scannums[begin:end])
+        return self.mobility_calibrations[mobility]
+
+    # get the TOF index range [tof_begin, tof_end] covering mz +/- mz_tol for each feature in the current frame
+    # only TOF indices w/ peaks in the frame are stored, which is sufficient to select the same peaks as the TDF-SDK
+    def get_tof_ranges(self, frame, features):
+        i = self.peak_store.frame_index[frame]
+        begin = self.peak_store.mz_offsets[i]
+        end = self.peak_store.mz_offsets[i + 1]
+        mz_tof_indices = np.asarray(self.peak_store.columns['mz_tof_indices'][begin:end]).astype(np.int64)
+        mz_values = np.asarray(self.peak_store.columns['mz_values'][begin:end])
+        if mz_tof_indices.size == 0:
+            return [(0, -1)] * len(features)
+        # first stored TOF index with m/z >= mz - mz_tol and last stored TOF index with m/z <= mz + mz_tol
+        lower = np.searchsorted(mz_values, [feature['mz'] - feature['mz_tol'] for feature in features], side='left')
+        upper = np.searchsorted(mz_values, [feature['mz'] + feature['mz_tol'] for feature in features],
+                                side='right') - 1
+        tof_begin = np.where(lower < mz_tof_indices.size,
+                             mz_tof_indices[np.minimum(lower, mz_tof_indices.size - 1)],
+                             mz_tof_indices[-1] + 1)
+        tof_end = np.where(upper >= 0, mz_tof_indices[np.maximum(upper, 0)], -1)
+        return list(zip(tof_begin.tolist(), tof_end.tolist()))
+
+    # get the m/z value of each TOF index in a frame
+    # only TOF indices w/ peaks in the frame are stored, so tof_indices must be TOF indices of peaks in the frame
+    def index_to_mz(self, frame, tof_indices):
+        i = self.peak_store.frame_index[frame]
+        begin = self.peak_store.mz_offsets[i]
+        end = self.peak_store.mz_offsets[i + 1]
+        positions = np.searchsorted(self.peak_store.columns['mz_tof_indices'][begin:end], tof_indices)
+        return np.asarray(self.peak_store.columns['mz_values'][begin:end])[positions]
+
+    # peaks are memory-mapped, so nothing is read ahead
+    def prefetch(self, frames):
+        pass
+
+    # read scans [scan_begin, scan_end) from a frame as flat TOF index and intensity arrays
+    # peaks from the Nth scan read are found in tof_indices[scan_offsets[N]:scan_offsets[N + 1]]
+    def read_scans(self, frame, scan_begin, scan_end):
+        i = self.peak_store.frame_index[frame]
+        begin = self.peak_store.peak_offsets[i]
+        end = self.peak_store.peak_offsets[i + 1]
+        scans = self.peak_store.columns['scans'][begin:end]
+        scan_offsets = np.searchsorted(scans, np.arange(scan_begin, scan_end + 1), side='left').astype(np.int64)
+        tof_indices = np.asarray(self.peak_store.columns['tof_indices'][begin + scan_offsets[0]:
+                                                                        begin + scan_offsets[-1]]).astype(np.int64)
+        intensities = np.asarray(self.peak_store.columns['intensities'][begin + scan_offsets[0]:
+                                                                        begin + scan_offsets[-1]]).astype(np.int64)
+        return scan_offsets - scan_offsets[0], tof_indices, intensities
+
+
+def run():
+    # Parse arguments
+    args = get_args()
+
+    # Set output directory to default if not specified.
+    if args['outdir'] == '':
+        args['outdir'] = os.path.split(args['input'])[0]
+
+    if args['outfile'] == '':
+        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + '.peaks'
+
+    # Load TDF data; pyTDFSDK is only imported here so that peak stores can be queried w/o it
+    # functions for initializing TDF-SDK are found in the pyTDFSDK package
+    from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
+    from pyTDFSDK.classes import TdfData
+    dll = init_tdf_sdk_api()
+    tdf_data = TdfData(args['input'], dll)
+
+    export_peak_store(dll, tdf_data, os.path.join(args['outdir'], args['outfile']))
+
+
+if __name__ == "__main__":
+    run()
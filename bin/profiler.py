@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import contextlib
+
+
+# per-stage instrumentation of the extraction loop
+# stages are timed w/ "with get_profiler().stage(name):" and record their cumulative time and number of calls; counts
+# such as the number of peaks and bytes decoded are recorded per frame between start_frame() and end_frame()
+# when profiling is off, the active profiler is a NullProfiler whose methods do nothing
+class Profiler(object):
+    enabled = True
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.frames = []
+        self.frame_counts = {}
+
+    # time a stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    # add time spent in a stage
+    def add_time(self, name, seconds, calls=1):
+        if name not in self.stages:
+            self.stages[name] = {'seconds': 0.0, 'calls': 0}
+        self.stages[name]['seconds'] += seconds
+        self.stages[name]['calls'] += calls
+
+    # add to a count for the current frame (e.g. peaks or bytes decoded)
+    def count(self, name, value):
+        self.frame_counts[name] = self.frame_counts.get(name, 0) + int(value)
+
+    # start timing a frame; returns the value to pass to end_frame()
+    def start_frame(self):
+        self.frame_counts = {}
+        return time.perf_counter()
+
+    # record the time and counts of a frame
+    def end_frame(self, frame, start):
+        frame_stats = {'Frame': int(frame), 'seconds': time.perf_counter() - start}
+        frame_stats.update(self.frame_counts)
+        self.frames.append(frame_stats)
+        self.frame_counts = {}
+
+    # get and reset the stages and frames recorded so far, e.g. to send them from a worker process to the main process
+    def pop(self):
+        profile = {'stages': self.stages, 'frames': self.frames}
+        self.stages = {}
+        self.frames = []
+        return profile
+
+    # add stages and frames recorded by another profiler (e.g. in a worker process)
+    def merge(self, profile):
+        if profile is None:
+            return
+        for name, stage in profile['stages'].items():
+            self.add_time(name, stage['seconds'], stage['calls'])
+        self.frames += profile['frames']
+
+    # get the profiling report
+    # stage times are summed over all processes, so they can add up to more than the wall time if jobs > 1
+    def get_report(self):
+        wall_seconds = time.perf_counter() - self.start_time
+        frames = sorted(self.frames, key=lambda i: i['Frame'])
+        count_names = sorted(set([name for i in frames for name in i.keys() if name not in ['Frame', 'seconds']]))
+        return {'wall_seconds': wall_seconds,
+                'stages': {name: {'seconds': stage['seconds'],
+                                  'calls': stage['calls'],
+                                  'percent_of_wall': 100 * stage['seconds'] / wall_seconds if wall_seconds else 0.0}
+                           for name, stage in sorted(self.stages.items(), key=lambda i: -i[1]['seconds'])},
+                'frames': {'count': len(frames),
+                           'seconds': sum([i['seconds'] for i in frames]),
+                           'totals': {name: sum([i.get(name, 0) for i in frames]) for name in count_names},
+                           'per_frame': frames}}
+
+    # write the profiling report to a JSON file and print a short summary
+    def write_report(self, path):
+        report = self.get_report()
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+        print('Profile (' + str(round(report['wall_seconds'], 3)) + ' s wall time):')
+        for name, stage in report['stages'].items():
+            print('    ' + name.ljust(24) + str(round(stage['seconds'], 3)).rjust(10) + ' s' +
+                  str(stage['calls']).rjust(10) + ' calls' + str(round(stage['percent_of_wall'], 1)).rjust(8) + ' %')
+        num_frames = report['frames']['count']
+        if num_frames:
+            print('    ' + str(num_frames) + ' frame(s) processed; ' +
+                  ', '.join([str(value) + ' ' + name + ' (' + str(round(value / num_frames, 1)) + ' per frame)'
+                             for name, value in report['frames']['totals'].items()]))
+        print('Profile report written to ' + path)
+
+
+# profiler used when profiling is off; every method does nothing
+class NullProfiler(object):
+    enabled = False
+    null_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def add_time(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def start_frame(self):
+        return 0
+
+    def end_frame(self, frame, start):
+        pass
+
+    def pop(self):
+        return None
+
+    def merge(self, profile):
+        pass
+
+
+# profiler used by the extraction engine in this process
+active_profiler = {'profiler': NullProfiler()}
+
+
+# get the profiler used by the extraction engine in this process
+def get_profiler():
+    return active_profiler['profiler']
+
+
+# set the profiler used by the extraction engine in this process
+def set_profiler(profiler):
+    active_profiler['profiler'] = profiler
+
+
+# get the default path of the profiling report for an output file
+def get_profile_path(outfile):
+    return os.path.splitext(outfile)[0] + '_profile.json'
@@ -1,7 +1,10 @@
-# functions for initializing TDF-SDK are found in the pyTDFSDK package
-from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
-from pyTDFSDK.classes import TdfData
-from pyTDFSDK.tims import tims_scannum_to_oneoverk0, tims_oneoverk0_to_scannum, tims_index_to_mz, tims_read_scans_v2
+from bin.extract import (get_feature_list, write_feature_intensities, open_run, get_frame_metadata,
+                         set_frame_reader)
+from bin.tdf_bin import FRAME_READERS
+from bin.profiler import Profiler, get_profiler, set_profiler, get_profile_path
+from bin.writer import OUTPUT_FORMATS, FeatureIntensityWriter
+from bin.feature_profiles import FeatureProfileWriter, get_feature_profiles_path
+from bin.watch import watch_feature_intensities
 
 import os
 import platform
@@ -15,15 +18,16 @@ import argparse
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input',
-                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file.',
+                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file, or a peak '
+                             'store exported from it w/ export_peak_store.',
                         required=True,
                         type=str)
     parser.add_argument('--outdir',
-                        help='Path to folder in which to write output CSV file. Default = same as input path.',
+                        help='Path to folder in which to write output file. Default = same as input path.',
                         default='',
                         type=str)
     parser.add_argument('--outfile',
-                        help='User defined filename for output CSV file.',
+                        help='User defined filename for output file.',
                         default='',
                         type=str)
     parser.add_argument('--mz',
@@ -46,6 +50,59 @@ def get_args():
                         nargs='+',
                         default=0.05,
                         type=float)
+    parser.add_argument('--output_format',
+                        help='Output file format: "csv", "parquet", or "feather". Parquet and Feather output require '
+                             'pyarrow. Default = csv.',
+                        default='csv',
+                        choices=['csv', 'parquet', 'feather'],
+                        type=str)
+    parser.add_argument('--layout',
+                        help='Output table layout: "long" (one row per feature per spot) or "wide" (one row per spot '
+                             'w/ one column per feature). Default = long.',
+                        default='long',
+                        choices=['long', 'wide'],
+                        type=str)
+    parser.add_argument('--jobs',
+                        help='Number of worker processes used to extract feature intensities. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--watch',
+                        help='Process an AutoXecute run while it is being acquired. New frames are extracted and '
+                             'appended to the output file as they are committed until the acquisition is closed. '
+                             'Long layout rows are written in frame order.',
+                        action='store_true')
+    parser.add_argument('--poll_interval',
+                        help='Number of seconds between checks for new frames in watch mode. Default = 10.',
+                        default=10,
+                        type=float)
+    parser.add_argument('--watch_timeout',
+                        help='Stop watching if no new frames are committed for this many seconds. 0 = wait '
+                             'indefinitely. Default = 1800.',
+                        default=1800,
+                        type=float)
+    parser.add_argument('--reader',
+                        help='Frame reader used to read peaks from a .d file: "sdk" (read through the TDF-SDK) or '
+                             '"numpy" (analysis.tdf_bin is decompressed and decoded w/ NumPy; requires zstandard). '
+                             'm/z and 1/K0 calibration are read through the TDF-SDK w/ either reader. Default = sdk.',
+                        default='sdk',
+                        choices=FRAME_READERS,
+                        type=str)
+    parser.add_argument('--decode_threads',
+                        help='Number of threads used to decompress and decode frames ahead of extraction w/ the numpy '
+                             'frame reader. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--feature_profiles',
+                        help='Also write the 1/K0 mobilogram and m/z profile of each feature in each spot, accumulated '
+                             'in the same pass as the feature intensities, to a compressed .npz file next to the '
+                             'output file w/ a "_feature_profiles.npz" suffix. Intensities for narrower 1/K0 or m/z '
+                             'tolerances can be computed from this file w/ get_profile_intensities.',
+                        action='store_true')
+    parser.add_argument('--profile',
+                        help='Record the time spent in and number of calls to each stage of the extraction loop and '
+                             'the number of peaks and bytes decoded per frame. A JSON report is written next to the '
+                             'output file w/ a "_profile.json" suffix and a summary is printed at the end of the run.',
+                        action='store_true')
     arguments = parser.parse_args()
     return vars(arguments)
 
@@ -53,13 +110,17 @@ def get_args():
 def run():
     # Parse arguments
     args = get_args()
+    if args['profile']:
+        set_profiler(Profiler())
+    set_frame_reader(args['reader'], args['decode_threads'])
 
     # Set output directory to default if not specified.
     if args['outdir'] == '':
         args['outdir'] = os.path.split(args['input'])[0]
 
     if args['outfile'] == '':
-        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + '.csv'
+        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + \
+                          OUTPUT_FORMATS[args['output_format']]
 
     # Check to make sure number of m/z and 1/K0 values match.
     # Also make sure an equal number of m/z and 1/K0 tolerance values are present if more than one tolerance given.
@@ -83,66 +144,41 @@ def run():
             args['mz_tol'] = args['mz_tol'] * len(args['mz'])
             args['ook0_tol'] = args['ook0_tol'] * len(args['ook0'])
 
-    # Load TDF data
-    dll = init_tdf_sdk_api()
-    tdf_data = TdfData(args['input'], dll)
-
-    list_of_scan_dicts = []
-
-    for mz, mz_tol, ook0, ook0_tol in zip(args['mz'], args['mz_tol'], args['ook0'], args['ook0_tol']):
-        # Each frame == one spectrum from a MALDI spot
-        # MaldiFrameInfo table in analysis.tdf SQL database tells which frame is associated with each spot
-        for frame in range(1, tdf_data.analysis['MaldiFrameInfo'].shape[0] + 1):
-            scan_dict = {}
-            frames_dict = tdf_data.analysis['Frames'][tdf_data.analysis['Frames']['Id'] ==
-                                                      frame].to_dict(orient='records')[0]
-            maldiframeinfo_dict = tdf_data.analysis['MaldiFrameInfo'][tdf_data.analysis['MaldiFrameInfo']['Frame'] ==
-                                                                      frame].to_dict(orient='records')[0]
-            scan_dict['Frame'] = int(frames_dict['Id'])
-            scan_dict['Spot'] = maldiframeinfo_dict['SpotName']
-            scan_dict['mz'] = mz
-            scan_dict['mz_tolerance'] = mz_tol
-            scan_dict['ook0'] = ook0
-            scan_dict['ook0_tol'] = ook0_tol
-            scan_dict['intensity'] = 0
-
-            # Get 1/K0 values from scan numbers in run
-            ook0_array = tims_scannum_to_oneoverk0(dll, tdf_data.handle, frame, range(0, frames_dict['NumScans']+1))
-            # Get 1/K0 values within tolerance
-            ook0_within_tolerance = [i for i in ook0_array
-                                     if ook0 + ook0_tol >= i >= ook0 - ook0_tol]
-            # Get scan numbers for ook0 values within tolerance
-            ook0_within_tolerance_scannums = tims_oneoverk0_to_scannum(dll,
-                                                                       tdf_data.handle,
-                                                                       frame,
-                                                                       ook0_within_tolerance)
-            ook0_within_tolerance_scannums = [int(i) for i in ook0_within_tolerance_scannums]
-
-            # Read scans from current frame
-            # each frame has N scans where each scan corresponds to a 1/K0 value
-            list_of_scans = tims_read_scans_v2(dll,
-                                               tdf_data.handle,
-                                               frame,
-                                               min(ook0_within_tolerance_scannums),
-                                               max(ook0_within_tolerance_scannums))
-            scan_begin = 0
-            scan_end = max(ook0_within_tolerance_scannums) - min(ook0_within_tolerance_scannums)
-            for scan_num in range(scan_begin, scan_end):
-                if list_of_scans[scan_num][0].size != 0 \
-                        and list_of_scans[scan_num][1].size != 0 \
-                        and list_of_scans[scan_num][0].size == list_of_scans[scan_num][1].size:
-                    mz_array = tims_index_to_mz(dll, tdf_data.handle, frame, list_of_scans[scan_num][0]).tolist()
-                    intensity_array = list_of_scans[scan_num][1].tolist()
-                    # Get indices of m/z values within tolerance
-                    indices = [mz_array.index(i) for i in mz_array
-                               if mz + mz_tol >= i >= mz - mz_tol]
-                    # Sum intensities if m/z value was found within tolerance of feature of interest
-                    # this summed intensity is the intensity of mz +/- mz_tol at ook0 +/- ook0_tol
-                    scan_dict['intensity'] += sum([intensity_array[i] for i in indices])
-            list_of_scan_dicts.append(scan_dict)
+    features = get_feature_list(args['mz'], args['mz_tol'], args['ook0'], args['ook0_tol'])
+    outfile = os.path.join(args['outdir'], args['outfile'])
+
+    if args['watch'] and args['feature_profiles']:
+        raise Exception('--feature_profiles cannot be used w/ --watch.')
+
+    if args['watch']:
+        # the run is (re)opened by watch_feature_intensities as new frames are committed
+        writer = FeatureIntensityWriter(outfile,
+                                        features,
+                                        None,
+                                        args['output_format'],
+                                        args['layout'],
+                                        frame_order=True)
+        watch_feature_intensities(args['input'],
+                                  features,
+                                  writer,
+                                  args['jobs'],
+                                  args['poll_interval'],
+                                  args['watch_timeout'])
+    else:
+        # Load TDF data, or a peak store exported from it
+        dll, tdf_data = open_run(args['input'])
+
+        frame_metadata = get_frame_metadata(tdf_data)
+        writer = FeatureIntensityWriter(outfile, features, frame_metadata, args['output_format'], args['layout'])
+        if args['feature_profiles']:
+            feature_profiles = FeatureProfileWriter(get_feature_profiles_path(outfile), features, frame_metadata)
+        else:
+            feature_profiles = None
+        write_feature_intensities(dll, tdf_data, features, writer, frame_metadata, args['jobs'],
+                                  feature_profiles=feature_profiles)
 
-    results = pd.DataFrame(list_of_scan_dicts)
-    results.to_csv(os.path.join(args['outdir'], args['outfile']), index=False)
+    if args['profile']:
+        get_profiler().write_report(get_profile_path(outfile))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,13 @@
-# functions for initializing TDF-SDK are found in the pyTDFSDK package
-from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
-from pyTDFSDK.classes import TdfData
-from pyTDFSDK.tims import tims_scannum_to_oneoverk0, tims_oneoverk0_to_scannum, tims_index_to_mz, tims_read_scans_v2
+from bin.cache import ResultCache
+from bin.extract import (get_feature_list_from_df, write_feature_intensities, open_run, get_frame_metadata,
+                         set_frame_reader)
+from bin.tdf_bin import FRAME_READERS
+from bin.profiler import Profiler, get_profiler, set_profiler, get_profile_path
+from bin.writer import OUTPUT_FORMATS, FeatureIntensityWriter
+from bin.feature_profiles import FeatureProfileWriter, get_feature_profiles_path
+from bin.watch import watch_feature_intensities
+from bin.shard import (parse_shard, get_checkpoint_dir, ShardCheckpoint, write_shard_checkpoint,
+                       read_shard_checkpoints, write_merged_intensities)
 
 import os
 import platform
@@ -15,21 +21,104 @@ import argparse
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input',
-                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file.',
+                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file, or a peak '
+                             'store exported from it w/ export_peak_store.',
                         required=True,
                         type=str)
     parser.add_argument('--outdir',
-                        help='Path to folder in which to write output CSV file. Default = same as input path.',
+                        help='Path to folder in which to write output file. Default = same as input path.',
                         default='',
                         type=str)
     parser.add_argument('--outfile',
-                        help='User defined filename for output CSV file.',
+                        help='User defined filename for output file.',
                         default='',
                         type=str)
     parser.add_argument('--feature_list',
                         help='CSV file w/ columns for "mz", "mz_tol", "ook0", and "ook0_tol" to define features.',
                         required=True,
                         type=str)
+    parser.add_argument('--output_format',
+                        help='Output file format: "csv", "parquet", or "feather". Parquet and Feather output require '
+                             'pyarrow. Default = csv.',
+                        default='csv',
+                        choices=['csv', 'parquet', 'feather'],
+                        type=str)
+    parser.add_argument('--layout',
+                        help='Output table layout: "long" (one row per feature per spot) or "wide" (one row per spot '
+                             'w/ one column per feature). Default = long.',
+                        default='long',
+                        choices=['long', 'wide'],
+                        type=str)
+    parser.add_argument('--jobs',
+                        help='Number of worker processes used to extract feature intensities. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--cache_dir',
+                        help='Path to folder used to cache feature intensities between runs. Only features that are '
+                             'not already cached for the input run are extracted. Caching is disabled if not '
+                             'specified. Cannot be used w/ --watch.',
+                        default='',
+                        type=str)
+    parser.add_argument('--cache_size',
+                        help='Maximum size of the feature intensity cache in MB. The least recently used entries are '
+                             'removed when the cache grows beyond this size. Default = 1024 MB.',
+                        default=1024,
+                        type=float)
+    parser.add_argument('--watch',
+                        help='Process an AutoXecute run while it is being acquired. New frames are extracted and '
+                             'appended to the output file as they are committed until the acquisition is closed. '
+                             'Long layout rows are written in frame order.',
+                        action='store_true')
+    parser.add_argument('--poll_interval',
+                        help='Number of seconds between checks for new frames in watch mode. Default = 10.',
+                        default=10,
+                        type=float)
+    parser.add_argument('--watch_timeout',
+                        help='Stop watching if no new frames are committed for this many seconds. 0 = wait '
+                             'indefinitely. Default = 1800.',
+                        default=1800,
+                        type=float)
+    parser.add_argument('--shard',
+                        help='Only process shard i of N of the run, given as "i/N" (e.g. 1/4). Frames are split '
+                             'deterministically between shards, and completed frames are checkpointed to '
+                             '--checkpoint_dir so that a restarted shard skips them. Once every shard is complete, '
+                             'combine them into the output file w/ --merge_shards N.',
+                        default='',
+                        type=str)
+    parser.add_argument('--checkpoint_dir',
+                        help='Path to folder in which shard checkpoints are written. If specified w/o --shard, the '
+                             'whole run is processed as a single resumable shard and the output file is written once '
+                             'it is complete. Default = output file name w/ a "_checkpoints" suffix.',
+                        default='',
+                        type=str)
+    parser.add_argument('--merge_shards',
+                        help='Combine the checkpoints of N complete shards from --checkpoint_dir into the output file '
+                             'instead of extracting feature intensities.',
+                        default=0,
+                        type=int)
+    parser.add_argument('--reader',
+                        help='Frame reader used to read peaks from a .d file: "sdk" (read through the TDF-SDK) or '
+                             '"numpy" (analysis.tdf_bin is decompressed and decoded w/ NumPy; requires zstandard). '
+                             'm/z and 1/K0 calibration are read through the TDF-SDK w/ either reader. Default = sdk.',
+                        default='sdk',
+                        choices=FRAME_READERS,
+                        type=str)
+    parser.add_argument('--decode_threads',
+                        help='Number of threads used to decompress and decode frames ahead of extraction w/ the numpy '
+                             'frame reader. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--feature_profiles',
+                        help='Also write the 1/K0 mobilogram and m/z profile of each feature in each spot, accumulated '
+                             'in the same pass as the feature intensities, to a compressed .npz file next to the '
+                             'output file w/ a "_feature_profiles.npz" suffix. Intensities for narrower 1/K0 or m/z '
+                             'tolerances can be computed from this file w/ get_profile_intensities.',
+                        action='store_true')
+    parser.add_argument('--profile',
+                        help='Record the time spent in and number of calls to each stage of the extraction loop and '
+                             'the number of peaks and bytes decoded per frame. A JSON report is written next to the '
+                             'output file w/ a "_profile.json" suffix and a summary is printed at the end of the run.',
+                        action='store_true')
     arguments = parser.parse_args()
     return vars(arguments)
 
@@ -37,80 +126,105 @@ def get_args():
 def run():
     # Parse arguments
     args = get_args()
+    if args['profile']:
+        set_profiler(Profiler())
+    set_frame_reader(args['reader'], args['decode_threads'])
 
     # Set output directory to default if not specified.
     if args['outdir'] == '':
         args['outdir'] = os.path.split(args['input'])[0]
 
     if args['outfile'] == '':
-        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + '.csv'
+        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + \
+                          OUTPUT_FORMATS[args['output_format']]
 
     feature_df = pd.read_csv(args['feature_list'])
 
-    # Load TDF data
-    dll = init_tdf_sdk_api()
-    tdf_data = TdfData(args['input'], dll)
-
-    list_of_scan_dicts = []
-
-    for index, row in feature_df.iterrows():
-        mz = row['mz']
-        mz_tol = row['mz_tol']
-        ook0 = row['ook0']
-        ook0_tol = row['ook0_tol']
-        # Each frame == one spectrum from a MALDI spot
-        # MaldiFrameInfo table in analysis.tdf SQL database tells which frame is associated with each spot
-        for frame in range(1, tdf_data.analysis['MaldiFrameInfo'].shape[0] + 1):
-            scan_dict = {}
-            frames_dict = tdf_data.analysis['Frames'][tdf_data.analysis['Frames']['Id'] ==
-                                                      frame].to_dict(orient='records')[0]
-            maldiframeinfo_dict = tdf_data.analysis['MaldiFrameInfo'][tdf_data.analysis['MaldiFrameInfo']['Frame'] ==
-                                                                      frame].to_dict(orient='records')[0]
-            scan_dict['Frame'] = int(frames_dict['Id'])
-            scan_dict['Spot'] = maldiframeinfo_dict['SpotName']
-            scan_dict['mz'] = mz
-            scan_dict['mz_tolerance'] = mz_tol
-            scan_dict['ook0'] = ook0
-            scan_dict['ook0_tol'] = ook0_tol
-            scan_dict['intensity'] = 0
-
-            # Get 1/K0 values from scan numbers in run
-            ook0_array = tims_scannum_to_oneoverk0(dll, tdf_data.handle, frame, range(0, frames_dict['NumScans']+1))
-            # Get 1/K0 values within tolerance
-            ook0_within_tolerance = [i for i in ook0_array
-                                     if ook0 + ook0_tol >= i >= ook0 - ook0_tol]
-            # Get scan numbers for ook0 values within tolerance
-            ook0_within_tolerance_scannums = tims_oneoverk0_to_scannum(dll,
-                                                                       tdf_data.handle,
-                                                                       frame,
-                                                                       ook0_within_tolerance)
-            ook0_within_tolerance_scannums = [int(i) for i in ook0_within_tolerance_scannums]
-
-            # Read scans from current frame
-            # each frame has N scans where each scan corresponds to a 1/K0 value
-            list_of_scans = tims_read_scans_v2(dll,
-                                               tdf_data.handle,
-                                               frame,
-                                               min(ook0_within_tolerance_scannums),
-                                               max(ook0_within_tolerance_scannums))
-            scan_begin = 0
-            scan_end = max(ook0_within_tolerance_scannums) - min(ook0_within_tolerance_scannums)
-            for scan_num in range(scan_begin, scan_end):
-                if list_of_scans[scan_num][0].size != 0 \
-                        and list_of_scans[scan_num][1].size != 0 \
-                        and list_of_scans[scan_num][0].size == list_of_scans[scan_num][1].size:
-                    mz_array = tims_index_to_mz(dll, tdf_data.handle, frame, list_of_scans[scan_num][0]).tolist()
-                    intensity_array = list_of_scans[scan_num][1].tolist()
-                    # Get indices of m/z values within tolerance
-                    indices = [mz_array.index(i) for i in mz_array
-                               if mz + mz_tol >= i >= mz - mz_tol]
-                    # Sum intensities if m/z value was found within tolerance of feature of interest
-                    # this summed intensity is the intensity of mz +/- mz_tol at ook0 +/- ook0_tol
-                    scan_dict['intensity'] += sum([intensity_array[i] for i in indices])
-            list_of_scan_dicts.append(scan_dict)
-
-    results = pd.DataFrame(list_of_scan_dicts)
-    results.to_csv(os.path.join(args['outdir'], args['outfile']), index=False)
+    features = get_feature_list_from_df(feature_df)
+    outfile = os.path.join(args['outdir'], args['outfile'])
+
+    if args['watch'] and args['cache_dir'] != '':
+        # frames are extracted as they are committed, so a run being acquired is never cached
+        raise Exception('--cache_dir cannot be used w/ --watch.')
+    sharded = args['shard'] != '' or args['checkpoint_dir'] != '' or args['merge_shards'] > 0
+    if args['feature_profiles'] and (args['watch'] or sharded):
+        raise Exception('--feature_profiles cannot be used w/ --watch, --shard, --checkpoint_dir, or --merge_shards.')
+    if sharded:
+        if args['watch']:
+            raise Exception('--watch cannot be used w/ --shard, --checkpoint_dir, or --merge_shards.')
+        if args['cache_dir'] != '':
+            raise Exception('--cache_dir cannot be used w/ --shard, --checkpoint_dir, or --merge_shards.')
+        if args['shard'] != '' and args['merge_shards'] > 0:
+            raise Exception('--shard and --merge_shards cannot be used together.')
+        if args['checkpoint_dir'] == '':
+            args['checkpoint_dir'] = get_checkpoint_dir(outfile)
+
+    if args['watch']:
+        # the run is (re)opened by watch_feature_intensities as new frames are committed
+        writer = FeatureIntensityWriter(outfile,
+                                        features,
+                                        None,
+                                        args['output_format'],
+                                        args['layout'],
+                                        frame_order=True)
+        watch_feature_intensities(args['input'],
+                                  features,
+                                  writer,
+                                  args['jobs'],
+                                  args['poll_interval'],
+                                  args['watch_timeout'])
+    elif not sharded:
+        # Load TDF data, or a peak store exported from it
+        dll, tdf_data = open_run(args['input'])
+
+        frame_metadata = get_frame_metadata(tdf_data)
+        if args['cache_dir'] != '':
+            cache = ResultCache(args['cache_dir'], int(args['cache_size'] * 1024 * 1024))
+        else:
+            cache = None
+        writer = FeatureIntensityWriter(outfile, features, frame_metadata, args['output_format'], args['layout'])
+        if args['feature_profiles']:
+            feature_profiles = FeatureProfileWriter(get_feature_profiles_path(outfile), features, frame_metadata)
+        else:
+            feature_profiles = None
+        write_feature_intensities(dll, tdf_data, features, writer, frame_metadata, args['jobs'], cache,
+                                  feature_profiles)
+    else:
+        # Load TDF data, or a peak store exported from it
+        dll, tdf_data = open_run(args['input'])
+
+        frame_metadata = get_frame_metadata(tdf_data)
+        if args['merge_shards'] > 0:
+            shard_count = args['merge_shards']
+        else:
+            shard_index, shard_count = parse_shard(args['shard']) if args['shard'] != '' else (1, 1)
+            checkpoint = ShardCheckpoint(args['checkpoint_dir'],
+                                         args['input'],
+                                         features,
+                                         frame_metadata.frames,
+                                         shard_index,
+                                         shard_count)
+            write_shard_checkpoint(dll, tdf_data, features, checkpoint, frame_metadata, args['jobs'])
+        # a single shard is written to the output file as soon as it is complete
+        if shard_count == 1 or args['merge_shards'] > 0:
+            intensities = read_shard_checkpoints(args['checkpoint_dir'],
+                                                 args['input'],
+                                                 features,
+                                                 frame_metadata.frames,
+                                                 shard_count)
+            writer = FeatureIntensityWriter(outfile, features, frame_metadata, args['output_format'], args['layout'])
+            write_merged_intensities(frame_metadata.frames, intensities, writer)
+        else:
+            print('Shard ' + args['shard'] + ' complete. Once all shards are complete, combine them w/ '
+                  '--merge_shards ' + str(shard_count) + '.')
+
+    if args['profile']:
+        if args['shard'] != '':
+            # each shard writes its own report
+            get_profiler().write_report(get_profile_path(os.path.splitext(outfile)[0] + '_shard_' +
+                                                         args['shard'].replace('/', '_of_')))
+        else:
+            get_profiler().write_report(get_profile_path(outfile))
 
 
 if __name__ == "__main__":
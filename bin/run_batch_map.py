@@ -1,7 +1,10 @@
-# functions for initializing TDF-SDK are found in the pyTDFSDK package
-from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
-from pyTDFSDK.classes import TdfData
-from pyTDFSDK.tims import tims_scannum_to_oneoverk0, tims_oneoverk0_to_scannum, tims_index_to_mz, tims_read_scans_v2
+from bin.cache import ResultCache
+from bin.extract import (get_feature_list_from_df, extract_feature_intensities, open_run, get_frame_metadata,
+                         set_frame_reader)
+from bin.tdf_bin import FRAME_READERS
+from bin.profiler import Profiler, get_profiler, set_profiler, get_profile_path
+from bin.feature_map import IMAGE_FORMATS, read_intensity_tables, get_ratio_table, write_heatmaps
+from bin.run_plates import get_run_name
 
 import os
 import platform
@@ -9,15 +12,25 @@ import sqlite3
 import numpy as np
 import pandas as pd
 import argparse
-import seaborn as sns
-import matplotlib.pyplot as plt
+
 
 # arguments to run in the command line
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input',
-                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file.',
-                        required=True,
+                        help='File path for Bruker .d file from MALDI AutoXecute run containing TDF file, or a peak '
+                             'store exported from it w/ export_peak_store. Not required if --intensity_table is '
+                             'specified.',
+                        default='',
+                        type=str)
+    parser.add_argument('--intensity_table',
+                        help='One or more long layout feature intensity tables (CSV, Parquet, or Feather) previously '
+                             'written by get_batch_feature_intensities, get_feature_map, or '
+                             'get_plate_feature_intensities. Ratios and heatmaps are calculated from these tables '
+                             'instead of extracting feature intensities from --input. Tables w/ a "Run" column are '
+                             'split into one plate per run; other tables are treated as one plate each.',
+                        default=[],
+                        nargs='+',
                         type=str)
     parser.add_argument('--outdir',
                         help='Path to folder in which to write output CSV file. Default = same as input path.',
@@ -28,8 +41,9 @@ def get_args():
                         default='',
                         type=str)
     parser.add_argument('--feature_list',
-                        help='CSV file w/ columns for "mz", "mz_tol", "ook0", and "ook0_tol" to define features.',
-                        required=True,
+                        help='CSV file w/ columns for "mz", "mz_tol", "ook0", and "ook0_tol" to define features. Not '
+                             'required if --intensity_table is specified.',
+                        default='',
                         type=str)
     parser.add_argument('--numerator_ook0',
                         help='User defined ook0 value to be used as the numerator in ratio calculation.',
@@ -40,9 +54,57 @@ def get_args():
                         required=True,
                         type=float)
     parser.add_argument('--IS_mz',
-                        help='User defined m/z value for the feature to be used as the internal standard for intensity normalization.',
+                        help='User defined m/z value for the feature to be used as the internal standard for intensity '
+                             'normalization.',
                         required=True,
                         type=float)
+    parser.add_argument('--ook0_match_tol',
+                        help='Features whose 1/K0 value is within this tolerance of --numerator_ook0 or '
+                             '--denominator_ook0 are used as the numerator or denominator. Default = 0.0005.',
+                        default=0.0005,
+                        type=float)
+    parser.add_argument('--mz_match_tol',
+                        help='Features whose m/z value is within this tolerance of --IS_mz are used as the internal '
+                             'standard. Default = 0.0005.',
+                        default=0.0005,
+                        type=float)
+    parser.add_argument('--image_format',
+                        help='Heatmap image file format: "png", "pdf", or "svg". Default = png.',
+                        default='png',
+                        choices=IMAGE_FORMATS,
+                        type=str)
+    parser.add_argument('--jobs',
+                        help='Number of worker processes used to extract feature intensities. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--cache_dir',
+                        help='Path to folder used to cache feature intensities between runs. Only features that are '
+                             'not already cached for the input run are extracted. Caching is disabled if not '
+                             'specified.',
+                        default='',
+                        type=str)
+    parser.add_argument('--cache_size',
+                        help='Maximum size of the feature intensity cache in MB. The least recently used entries are '
+                             'removed when the cache grows beyond this size. Default = 1024 MB.',
+                        default=1024,
+                        type=float)
+    parser.add_argument('--reader',
+                        help='Frame reader used to read peaks from a .d file: "sdk" (read through the TDF-SDK) or '
+                             '"numpy" (analysis.tdf_bin is decompressed and decoded w/ NumPy; requires zstandard). '
+                             'm/z and 1/K0 calibration are read through the TDF-SDK w/ either reader. Default = sdk.',
+                        default='sdk',
+                        choices=FRAME_READERS,
+                        type=str)
+    parser.add_argument('--decode_threads',
+                        help='Number of threads used to decompress and decode frames ahead of extraction w/ the numpy '
+                             'frame reader. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--profile',
+                        help='Record the time spent in and number of calls to each stage of the extraction loop and '
+                             'the number of peaks and bytes decoded per frame. A JSON report is written next to the '
+                             'output file w/ a "_profile.json" suffix and a summary is printed at the end of the run.',
+                        action='store_true')
     arguments = parser.parse_args()
     return vars(arguments)
 
@@ -50,126 +112,77 @@ def get_args():
 def run():
     # Parse arguments
     args = get_args()
+    if args['profile']:
+        set_profiler(Profiler())
+    set_frame_reader(args['reader'], args['decode_threads'])
+
+    if args['input'] == '' and not args['intensity_table']:
+        raise Exception('Either --input or --intensity_table must be specified.')
+    if args['input'] != '' and args['intensity_table']:
+        raise Exception('Only one of --input and --intensity_table can be specified.')
 
     # Set output directory to default if not specified.
     if args['outdir'] == '':
-        args['outdir'] = os.path.split(args['input'])[0]
-
-    if args['outfile'] == '':
-        args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + '.csv'
-
-    feature_df = pd.read_csv(args['feature_list'])
-
-    # Load TDF data
-    dll = init_tdf_sdk_api()
-    tdf_data = TdfData(args['input'], dll)
-
-    list_of_scan_dicts = []
-
-    for index, row in feature_df.iterrows():
-        mz = row['mz']
-        mz_tol = row['mz_tol']
-        ook0 = row['ook0']
-        ook0_tol = row['ook0_tol']
-
-        # Each frame == one spectrum from a MALDI spot
-        # MaldiFrameInfo table in analysis.tdf SQL database tells which frame is associated with each spot
-        for frame in range(1, tdf_data.analysis['MaldiFrameInfo'].shape[0] + 1):
-            scan_dict = {}
-            frames_dict = tdf_data.analysis['Frames'][tdf_data.analysis['Frames']['Id'] ==
-                                                      frame].to_dict(orient='records')[0]
-            maldiframeinfo_dict = tdf_data.analysis['MaldiFrameInfo'][tdf_data.analysis['MaldiFrameInfo']['Frame'] ==
-                                                                      frame].to_dict(orient='records')[0]
-            scan_dict['Frame'] = int(frames_dict['Id'])
-            scan_dict['Spot'] = maldiframeinfo_dict['SpotName']
-            scan_dict['mz'] = mz
-            scan_dict['mz_tolerance'] = mz_tol
-            scan_dict['ook0'] = ook0
-            scan_dict['ook0_tol'] = ook0_tol
-            scan_dict['intensity'] = 0
-            
-            # Get 1/K0 values from scan numbers in run
-            ook0_array = tims_scannum_to_oneoverk0(dll, tdf_data.handle, frame, range(0, frames_dict['NumScans']+1))
-            # Get 1/K0 values within tolerance
-            ook0_within_tolerance = [i for i in ook0_array
-                                     if ook0 + ook0_tol >= i >= ook0 - ook0_tol]
-            # Get scan numbers for ook0 values within tolerance
-            ook0_within_tolerance_scannums = tims_oneoverk0_to_scannum(dll,
-                                                                       tdf_data.handle,
-                                                                       frame,
-                                                                       ook0_within_tolerance)
-            ook0_within_tolerance_scannums = [int(i) for i in ook0_within_tolerance_scannums]
-
-            # Read scans from current frame
-            # each frame has N scans where each scan corresponds to a 1/K0 value
-            list_of_scans = tims_read_scans_v2(dll,
-                                               tdf_data.handle,
-                                               frame,
-                                               min(ook0_within_tolerance_scannums),
-                                               max(ook0_within_tolerance_scannums))
-            scan_begin = 0
-            scan_end = max(ook0_within_tolerance_scannums) - min(ook0_within_tolerance_scannums)
-            for scan_num in range(scan_begin, scan_end):
-                if list_of_scans[scan_num][0].size != 0 \
-                        and list_of_scans[scan_num][1].size != 0 \
-                        and list_of_scans[scan_num][0].size == list_of_scans[scan_num][1].size:
-                    mz_array = tims_index_to_mz(dll, tdf_data.handle, frame, list_of_scans[scan_num][0]).tolist()
-                    intensity_array = list_of_scans[scan_num][1].tolist()
-                    # Get indices of m/z values within tolerance
-                    indices = [mz_array.index(i) for i in mz_array
-                               if mz + mz_tol >= i >= mz - mz_tol]
-                    # Sum intensities if m/z value was found within tolerance of feature of interest
-                    # this summed intensity is the intensity of mz +/- mz_tol at ook0 +/- ook0_tol
-                    scan_dict['intensity'] += sum([intensity_array[i] for i in indices])
-            list_of_scan_dicts.append(scan_dict)
-
-    results = pd.DataFrame(list_of_scan_dicts)
-    results.to_csv(os.path.join(args['outdir'], args['outfile']), index=False)
-
-    # Display the resulting DataFrame with the modified columns
-    print(results)
-    
-    # Split the 'Spot' column into two new columns 'index' and 'integer'
-    results[['index', 'integer']] = results['Spot'].str.extract('([A-Za-z]+)(\d+)', expand=True)
-
-    # Group by 'Frame', 'Spot', 'index' and 'integer', and calculate sum of intensities for numerator, denominator, and internal standard if provided 
-    group_columns = ['Frame', 'Spot', 'index', 'integer']
-    results['numerator_intensity'] = results[results['ook0'] == args['numerator_ook0']].groupby(group_columns, as_index=False)['intensity'].transform('sum')
-    results['denominator_intensity'] = results[results['ook0'] == args['denominator_ook0']].groupby(group_columns, as_index=False)['intensity'].transform('sum')
-    results['IS_intensity'] = results[results['mz'] == args['IS_mz']].groupby(group_columns, as_index=False)['intensity'].transform('sum')
-    
-    #Group by 'Frame', 'Spot', 'index' and 'integer'
-    grouped_results = results.groupby(group_columns, as_index=False)[['numerator_intensity', 'denominator_intensity','IS_intensity']].sum()
-    grouped_results.to_csv(os.path.join(args['outdir'], 'modified_outfile.csv'), index=False)
-
-    # Calculate the ratio based on 'numerator_intensity' and 'denominator_intensity'
-    grouped_results['ratio'] = grouped_results['numerator_intensity'] / grouped_results['denominator_intensity']
-
-    #normalize to internal standard
-    grouped_results['n_ratio'] = (grouped_results['ratio'] / grouped_results['IS_intensity'])
-
-    # Save the result to a new CSV file
-    grouped_results.to_csv(os.path.join(args['outdir'], 'modified_outfile.csv'), index=False)
-
+        args['outdir'] = os.path.split(args['input'] if args['input'] != '' else args['intensity_table'][0])[0]
+
+    if args['intensity_table']:
+        # Ratios and heatmaps are calculated from previously extracted feature intensities
+        with get_profiler().stage('read'):
+            results = read_intensity_tables(args['intensity_table'])
+        profile_path = get_profile_path(os.path.join(args['outdir'], 'modified_outfile.csv'))
+    else:
+        if args['feature_list'] == '':
+            raise Exception('--feature_list must be specified when feature intensities are extracted from --input.')
+        if args['outfile'] == '':
+            args['outfile'] = os.path.splitext(os.path.split(args['input'])[-1])[0] + '.csv'
+
+        feature_df = pd.read_csv(args['feature_list'])
+
+        # Load TDF data, or a peak store exported from it
+        dll, tdf_data = open_run(args['input'])
+
+        features = get_feature_list_from_df(feature_df)
+        frame_metadata = get_frame_metadata(tdf_data)
+        if args['cache_dir'] != '':
+            cache = ResultCache(args['cache_dir'], int(args['cache_size'] * 1024 * 1024))
+        else:
+            cache = None
+        list_of_scan_dicts = extract_feature_intensities(dll, tdf_data, features, frame_metadata, args['jobs'],
+                                                         cache)
+
+        with get_profiler().stage('write'):
+            results = pd.DataFrame(list_of_scan_dicts)
+            results.to_csv(os.path.join(args['outdir'], args['outfile']), index=False)
+        # Display the resulting DataFrame
+        print(results)
+        results.insert(0, 'Run', get_run_name(args['input']))
+        profile_path = get_profile_path(os.path.join(args['outdir'], args['outfile']))
+
+    with get_profiler().stage('ratios'):
+        # Sum intensities of the numerator, denominator, and internal standard features in each spot and calculate
+        # the normalized ratios
+        ratio_table = get_ratio_table(results,
+                                      args['numerator_ook0'],
+                                      args['denominator_ook0'],
+                                      args['IS_mz'],
+                                      args['ook0_match_tol'],
+                                      args['mz_match_tol'])
+        # the "Run" column is only written if there is more than one plate
+        if ratio_table['Run'].nunique() > 1:
+            modified_results = ratio_table
+        else:
+            modified_results = ratio_table.drop(columns=['Run'])
+        modified_results.to_csv(os.path.join(args['outdir'], 'modified_outfile.csv'), index=False)
     # Display the resulting DataFrame with the modified columns
-    print(grouped_results)
-
-    # Group by 'index' and 'integer', then aggregate using the mean of 'ratio'
-    heatmap_data = grouped_results[grouped_results['n_ratio'] != '-'].groupby(['index', 'integer'])['n_ratio'].mean().unstack()
+    print(modified_results)
 
-    # Convert the data type of 'ratio' to float
-    heatmap_data = heatmap_data.astype(float)
+    with get_profiler().stage('heatmap'):
+        # Heatmaps are saved to files w/o a GUI so that batch runs never block
+        write_heatmaps(ratio_table, args['outdir'], args['image_format'])
 
-    # Save the result to a new CSV file
-    heatmap_data.to_csv(os.path.join(args['outdir'], 'heatmap_data.csv'), index=False)
+    if args['profile']:
+        get_profiler().write_report(profile_path)
 
-    # Create a heatmap of the calculated ratios using seaborn
-    plt.figure(figsize=(10, 8))
-    sns.heatmap(heatmap_data, annot=False, cmap='viridis', fmt=".2f", cbar_kws={'label': 'Normalized Ratio'})
-    plt.title('Heatmap of Mean Ratio Values')
-    plt.xlabel('Integer')
-    plt.ylabel('Index')
-    plt.show()
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,206 @@
+from bin.extract import (get_feature_list_from_df, extract_feature_intensities, open_run, close_run, get_frame_metadata,
+                         set_frame_reader)
+from bin.peak_store import is_peak_store
+from bin.tdf_bin import FRAME_READERS
+
+import os
+import glob
+import time
+import traceback
+import pandas as pd
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input',
+                        help='One or more Bruker .d files from MALDI AutoXecute runs or peak stores exported from them '
+                             'w/ export_peak_store, directories containing .d files or peak stores, or glob patterns '
+                             'matching .d files or peak stores.',
+                        required=True,
+                        nargs='+',
+                        type=str)
+    parser.add_argument('--outdir',
+                        help='Path to folder in which to write output CSV files.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--outfile',
+                        help='User defined filename for the combined output CSV file. Per-plate CSV files are named '
+                             'after each ".d" directory or peak store, prefixed w/ its parent folders if several runs '
+                             'share a name.',
+                        default='combined.csv',
+                        type=str)
+    parser.add_argument('--feature_list',
+                        help='CSV file w/ columns for "mz", "mz_tol", "ook0", and "ook0_tol" to define features.',
+                        required=True,
+                        type=str)
+    parser.add_argument('--jobs',
+                        help='Number of plates to process in parallel. Default = 1.',
+                        default=1,
+                        type=int)
+    parser.add_argument('--reader',
+                        help='Frame reader used to read peaks from a .d file: "sdk" (read through the TDF-SDK) or '
+                             '"numpy" (analysis.tdf_bin is decompressed and decoded w/ NumPy; requires zstandard). '
+                             'm/z and 1/K0 calibration are read through the TDF-SDK w/ either reader. Default = sdk.',
+                        default='sdk',
+                        choices=FRAME_READERS,
+                        type=str)
+    parser.add_argument('--decode_threads',
+                        help='Number of threads used to decompress and decode frames ahead of extraction w/ the numpy '
+                             'frame reader. Default = 1.',
+                        default=1,
+                        type=int)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# check whether a path is a .d run or a peak store exported from one
+def is_run(path):
+    return os.path.isdir(path) and (path.rstrip('/\\').endswith('.d') or is_peak_store(path))
+
+
+# get a sorted list of unique .d runs and peak stores from .d or peak store paths, directories containing them, and glob
+# patterns
+def get_input_runs(inputs):
+    runs = []
+    for path in inputs:
+        if is_run(path):
+            runs.append(path)
+        elif os.path.isdir(path):
+            runs += sorted(glob.glob(os.path.join(path, '*')))
+        else:
+            runs += sorted(glob.glob(path))
+    runs = [os.path.normpath(i) for i in runs if is_run(i)]
+    return list(dict.fromkeys(runs))
+
+
+# get the run name used for per-plate output files and the "Run" column of the combined table
+def get_run_name(input_path):
+    return os.path.splitext(os.path.split(os.path.normpath(input_path))[-1])[0]
+
+
+# get a unique run name for each run
+# runs w/ the same ".d" directory name (e.g. from different folders) are named after as many of their parent folders as
+# needed to tell them apart (e.g. plate_1_p and plate_2_p), so per-plate output files and runs in the combined table
+# never collide
+def get_run_names(runs):
+    run_names = [get_run_name(i) for i in runs]
+    path_parts = [os.path.abspath(i).split(os.sep) for i in runs]
+    for run_name in set([i for i in run_names if run_names.count(i) > 1]):
+        duplicates = [i for i, name in enumerate(run_names) if name == run_name]
+        for depth in range(2, max([len(path_parts[i]) for i in duplicates]) + 1):
+            names = ['_'.join([j for j in path_parts[i][-depth:-1] if j] + [run_name]) for i in duplicates]
+            if len(set(names)) == len(names):
+                break
+        for i, name in zip(duplicates, names):
+            run_names[i] = name
+    if len(set(run_names)) != len(run_names):
+        raise Exception('Runs could not be given unique names: ' +
+                        ', '.join(sorted(set([i for i in run_names if run_names.count(i) > 1]))))
+    return run_names
+
+
+# get the initial status dict used to report the outcome of processing a plate
+def get_plate_status(input_path, run_name):
+    return {'Run': run_name,
+            'Input': input_path,
+            'Status': 'failed',
+            'Frames': 0,
+            'Seconds': 0.0,
+            'Error': ''}
+
+
+# get a one line description of an exception for the status report
+def get_error_message(e):
+    return ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+
+# set the frame reader of each worker process (see set_frame_reader())
+def init_worker(reader='sdk', threads=1):
+    set_frame_reader(reader, threads)
+
+
+# extract feature intensities from a single plate and write the per-plate CSV file
+# failures are reported in the returned status dict rather than raised so that the rest of the batch continues
+def process_plate(input_path, run_name, features, outdir):
+    status = get_plate_status(input_path, run_name)
+    start_time = time.perf_counter()
+    try:
+        # Load TDF data, or a peak store exported from it
+        dll, tdf_data = open_run(input_path)
+        try:
+            frame_metadata = get_frame_metadata(tdf_data)
+            list_of_scan_dicts = extract_feature_intensities(dll, tdf_data, features, frame_metadata)
+        finally:
+            # release the TDF-SDK handle so long batches do not accumulate open runs
+            close_run(dll, tdf_data)
+        results = pd.DataFrame(list_of_scan_dicts)
+        results.to_csv(os.path.join(outdir, status['Run'] + '.csv'), index=False)
+        status['Status'] = 'ok'
+        status['Frames'] = len(frame_metadata)
+    except Exception as e:
+        status['Error'] = get_error_message(e)
+    status['Seconds'] = round(time.perf_counter() - start_time, 3)
+    return status
+
+
+def run():
+    # Parse arguments
+    args = get_args()
+    set_frame_reader(args['reader'], args['decode_threads'])
+
+    runs = get_input_runs(args['input'])
+    if not runs:
+        raise Exception('No .d runs or peak stores found in input: ' + ' '.join(args['input']))
+    run_names = get_run_names(runs)
+    if not os.path.isdir(args['outdir']):
+        os.makedirs(args['outdir'])
+
+    feature_df = pd.read_csv(args['feature_list'])
+    features = get_feature_list_from_df(feature_df)
+
+    # Plates are opened w/ open_run() so that the TDF-SDK is only loaded for .d runs
+    list_of_statuses = []
+    if args['jobs'] > 1 and len(runs) > 1:
+        with ProcessPoolExecutor(max_workers=min(args['jobs'], len(runs)),
+                                 initializer=init_worker,
+                                 initargs=(args['reader'], args['decode_threads'])) as executor:
+            futures = [executor.submit(process_plate, input_path, run_name, features, args['outdir'])
+                       for input_path, run_name in zip(runs, run_names)]
+            for input_path, run_name, future in zip(runs, run_names, futures):
+                try:
+                    status = future.result()
+                except Exception as e:
+                    status = get_plate_status(input_path, run_name)
+                    status['Error'] = get_error_message(e)
+                print(status['Run'] + ': ' + status['Status'] + ' (' + str(status['Seconds']) + ' s)')
+                list_of_statuses.append(status)
+    else:
+        for input_path, run_name in zip(runs, run_names):
+            status = process_plate(input_path, run_name, features, args['outdir'])
+            print(status['Run'] + ': ' + status['Status'] + ' (' + str(status['Seconds']) + ' s)')
+            list_of_statuses.append(status)
+
+    # Combine per-plate outputs into one long table tagged w/ the run name
+    list_of_results = []
+    for status in list_of_statuses:
+        if status['Status'] == 'ok':
+            results = pd.read_csv(os.path.join(args['outdir'], status['Run'] + '.csv'))
+            results.insert(0, 'Run', status['Run'])
+            list_of_results.append(results)
+    if list_of_results:
+        pd.concat(list_of_results, ignore_index=True).to_csv(os.path.join(args['outdir'], args['outfile']),
+                                                             index=False)
+
+    # Report per-plate timing and failures
+    summary = pd.DataFrame(list_of_statuses)
+    summary.to_csv(os.path.join(args['outdir'], os.path.splitext(args['outfile'])[0] + '_summary.csv'), index=False)
+    print(summary[['Run', 'Status', 'Frames', 'Seconds', 'Error']].to_string(index=False))
+    failed = summary[summary['Status'] != 'ok'].shape[0]
+    print(str(len(runs) - failed) + ' of ' + str(len(runs)) + ' plates processed successfully.')
+
+
+if __name__ == "__main__":
+    run()
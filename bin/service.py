@@ -0,0 +1,325 @@
+from bin.extract import (get_feature_list, get_frames_intensities, get_frame_metadata, get_frame_source,
+                         get_list_of_scan_dicts, set_frame_reader)
+from bin.tdf_bin import FRAME_READERS
+from bin.peak_store import is_peak_store, PeakStore
+from bin.tdf_source import check_tdf_sdk
+
+import os
+import json
+import time
+import threading
+import argparse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# maximum size of a query body in bytes
+MAX_QUERY_SIZE = 64 * 1024 * 1024
+
+
+# arguments to run in the command line
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',
+                        help='Address the service listens on. Default = 127.0.0.1 (local connections only).',
+                        default='127.0.0.1',
+                        type=str)
+    parser.add_argument('--port',
+                        help='Port the service listens on. Default = 8765.',
+                        default=8765,
+                        type=int)
+    parser.add_argument('--max_runs',
+                        help='Maximum number of .d runs or peak stores kept open. The least recently queried run is '
+                             'closed when another run is opened. Default = 8.',
+                        default=8,
+                        type=int)
+    parser.add_argument('--reader',
+                        help='Frame reader used to read peaks from a .d file: "sdk" (read through the TDF-SDK) or '
+                             '"numpy" (analysis.tdf_bin is decompressed and decoded w/ NumPy; requires zstandard). '
+                             'm/z and 1/K0 calibration are read through the TDF-SDK w/ either reader. Default = sdk.',
+                        default='sdk',
+                        choices=FRAME_READERS,
+                        type=str)
+    parser.add_argument('--decode_threads',
+                        help='Number of threads used to decompress and decode frames ahead of extraction w/ the numpy '
+                             'frame reader. Default = 1.',
+                        default=1,
+                        type=int)
+    arguments = parser.parse_args()
+    return vars(arguments)
+
+
+# get the modification time and size of the files a run is read from, used to detect runs that changed on disk (e.g.
+# while being acquired) since they were opened
+def get_run_state(input_path):
+    if is_peak_store(input_path):
+        paths = [os.path.join(input_path, 'peak_store.json')]
+    else:
+        paths = [os.path.join(input_path, 'analysis.tdf'), os.path.join(input_path, 'analysis.tdf_bin')]
+    return tuple([(os.stat(i).st_mtime_ns, os.stat(i).st_size) for i in paths])
+
+
+# a .d run or peak store kept open by the service w/ its frame metadata and frame source
+# queries on the same run are serialized w/ the run's lock since a TDF-SDK handle is not shared between threads
+class PooledRun(object):
+    def __init__(self, input_path, dll):
+        self.input_path = input_path
+        self.state = get_run_state(input_path)
+        self.dll = dll
+        if is_peak_store(input_path):
+            self.tdf_data = PeakStore(input_path)
+        else:
+            # functions for initializing TDF-SDK are found in the pyTDFSDK package
+            from pyTDFSDK.classes import TdfData
+            self.tdf_data = TdfData(input_path, dll)
+        self.frame_metadata = get_frame_metadata(self.tdf_data)
+        self.frame_source = get_frame_source(dll, self.tdf_data)
+        self.frames_by_spot = {spot_name: frame for frame, spot_name in self.frame_metadata.spot_name.items()
+                               if frame in self.frame_metadata.num_scans}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.num_queries = 0
+        self.last_query_time = time.time()
+
+    # close the TDF-SDK handle once no query is using it
+    def close(self):
+        with self.lock:
+            if not isinstance(self.tdf_data, PeakStore):
+                from pyTDFSDK.tims import tims_close
+                tims_close(self.dll, self.tdf_data.handle)
+            self.closed = True
+
+    # get the status dict reported by the service for this run
+    def get_status(self):
+        return {'input': self.input_path,
+                'frames': len(self.frame_metadata),
+                'queries': self.num_queries,
+                'last_query_time': self.last_query_time}
+
+
+# LRU pool of open runs
+# the TDF-SDK is loaded once when the first .d run is opened; runs are reopened if they changed on disk since they were
+# opened, and the least recently queried run is closed once more than max_runs runs are open
+# runs are opened outside of the pool lock so that opening a run does not block queries on runs that are already open;
+# queries on a run that is being opened wait for it instead of opening it again
+class RunPool(object):
+    def __init__(self, max_runs=8):
+        self.max_runs = max(1, max_runs)
+        self.runs = OrderedDict()
+        self.opening = {}
+        self.lock = threading.Lock()
+        self.dll_lock = threading.Lock()
+        self.dll = None
+
+    # get the TDF-SDK, loading it the first time a .d run is opened
+    def get_dll(self):
+        with self.dll_lock:
+            if self.dll is None:
+                # pyTDFSDK is only imported once a .d run is queried so that peak stores can be served w/o it
+                check_tdf_sdk()
+                from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
+                self.dll = init_tdf_sdk_api()
+            return self.dll
+
+    # get the open run for a .d run or peak store, opening it if needed
+    def get_run(self, input_path):
+        input_path = os.path.abspath(input_path)
+        if not os.path.isdir(input_path):
+            raise Exception('Input not found: ' + input_path)
+        while True:
+            closed_runs = []
+            opening = False
+            with self.lock:
+                pooled_run = self.runs.get(input_path)
+                if pooled_run is not None and pooled_run.state != get_run_state(input_path):
+                    closed_runs.append(self.runs.pop(input_path))
+                    pooled_run = None
+                if pooled_run is not None:
+                    self.runs.move_to_end(input_path)
+                elif input_path in self.opening:
+                    # another query is already opening this run
+                    opened = self.opening[input_path]
+                else:
+                    opened = threading.Event()
+                    self.opening[input_path] = opened
+                    opening = True
+            # runs are closed outside of the pool lock so that queries on other runs are not blocked
+            for closed_run in closed_runs:
+                closed_run.close()
+            if pooled_run is not None:
+                return pooled_run
+            if opening:
+                return self.open_run(input_path, opened)
+            # look the run up again once it is open (or open it if the query opening it failed)
+            opened.wait()
+
+    # open a run outside of the pool lock and add it to the pool, closing the least recently queried runs if more
+    # than max_runs runs are open
+    # opened is set once the run has been added to the pool or could not be opened
+    def open_run(self, input_path, opened):
+        try:
+            pooled_run = PooledRun(input_path, self.get_dll() if not is_peak_store(input_path) else None)
+            closed_runs = []
+            with self.lock:
+                self.runs[input_path] = pooled_run
+                self.runs.move_to_end(input_path)
+                while len(self.runs) > self.max_runs:
+                    closed_runs.append(self.runs.popitem(last=False)[1])
+        finally:
+            with self.lock:
+                self.opening.pop(input_path, None)
+            opened.set()
+        for closed_run in closed_runs:
+            closed_run.close()
+        return pooled_run
+
+    # get the status dict of each open run, most recently queried first
+    def get_status(self):
+        with self.lock:
+            return [pooled_run.get_status() for pooled_run in reversed(self.runs.values())]
+
+    # close every open run
+    def close(self):
+        with self.lock:
+            closed_runs = list(self.runs.values())
+            self.runs = OrderedDict()
+        for closed_run in closed_runs:
+            closed_run.close()
+
+
+# get the frames selected by a query: all MALDI frames, or only the frames listed in "frames" and/or the spots listed
+# in "spots", in frame ID order
+def get_query_frames(pooled_run, query):
+    if 'frames' not in query and 'spots' not in query:
+        return pooled_run.frame_metadata.frames
+    # JSON types are checked so that e.g. "spots": "A1" is not read one character at a time and frame IDs are never
+    # truncated; empty lists are rejected so that an empty selection is never mistaken for spots w/o signal
+    if 'frames' in query and (not isinstance(query['frames'], list) or not query['frames'] or
+                              any([isinstance(i, bool) or not isinstance(i, int) for i in query['frames']])):
+        raise Exception('"frames" must be a non-empty list of integer frame IDs.')
+    if 'spots' in query and (not isinstance(query['spots'], list) or not query['spots'] or
+                             any([not isinstance(i, str) for i in query['spots']])):
+        raise Exception('"spots" must be a non-empty list of spot names.')
+    frames = set()
+    for frame in query.get('frames', []):
+        if frame not in pooled_run.frame_metadata.spot_name or frame not in pooled_run.frame_metadata.num_scans:
+            raise Exception('Frame ' + str(frame) + ' is not a MALDI frame in ' + pooled_run.input_path)
+        frames.add(frame)
+    for spot_name in query.get('spots', []):
+        if spot_name not in pooled_run.frames_by_spot:
+            raise Exception('Spot ' + str(spot_name) + ' not found in ' + pooled_run.input_path)
+        frames.add(pooled_run.frames_by_spot[spot_name])
+    return sorted(frames)
+
+
+# get the feature list of a query from its "features" list of dicts w/ "mz", "mz_tol", "ook0", and "ook0_tol" keys
+def get_query_features(query):
+    if not query.get('features') or not isinstance(query['features'], list):
+        raise Exception('Query must include a "features" list w/ "mz", "mz_tol", "ook0", and "ook0_tol" values.')
+    try:
+        return get_feature_list([float(i['mz']) for i in query['features']],
+                                [float(i['mz_tol']) for i in query['features']],
+                                [float(i['ook0']) for i in query['features']],
+                                [float(i['ook0_tol']) for i in query['features']])
+    except (KeyError, TypeError, ValueError):
+        raise Exception('Each feature must have numeric "mz", "mz_tol", "ook0", and "ook0_tol" values.')
+
+
+# extract the summed intensity of each queried feature from each queried frame of a run
+# rows are returned in the same order and w/ the same columns as the long layout output of get_feature_intensities
+def query_feature_intensities(run_pool, query):
+    start_time = time.perf_counter()
+    if not isinstance(query.get('input'), str):
+        raise Exception('Query must include the "input" path of a .d run or peak store.')
+    features = get_query_features(query)
+    while True:
+        pooled_run = run_pool.get_run(query['input'])
+        frames = get_query_frames(pooled_run, query)
+        with pooled_run.lock:
+            # the run may have been closed by another query between get_run() and acquiring its lock
+            if pooled_run.closed:
+                continue
+            frame_intensities = get_frames_intensities(pooled_run.frame_source,
+                                                       frames,
+                                                       pooled_run.frame_metadata,
+                                                       features)
+            pooled_run.num_queries += 1
+            pooled_run.last_query_time = time.time()
+        break
+    feature_intensities = [[intensities[i] for intensities in frame_intensities] for i in range(len(features))]
+    return {'input': pooled_run.input_path,
+            'rows': get_list_of_scan_dicts(frames, pooled_run.frame_metadata, features, feature_intensities),
+            'seconds': time.perf_counter() - start_time}
+
+
+# HTTP request handler for the feature intensity service
+#     GET /status: list the open runs
+#     POST /intensities: extract feature intensities; the body is a JSON query w/ "input", "features", and optional
+#                        "frames" and/or "spots" lists
+# errors are returned as JSON w/ an "error" message
+# connections are kept alive between queries so that clients do not pay for a new connection on every query
+class FeatureIntensityRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status_code, response):
+        body = json.dumps(response).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self.send_json(200, {'runs': self.server.run_pool.get_status()})
+        else:
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/intensities':
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_QUERY_SIZE:
+                # the query body is not read, so the connection cannot be reused
+                self.close_connection = True
+                raise Exception('Query is larger than ' + str(MAX_QUERY_SIZE) + ' bytes.')
+            try:
+                query = json.loads(self.rfile.read(length))
+            except ValueError:
+                raise Exception('Query must be a JSON object.')
+            if not isinstance(query, dict):
+                raise Exception('Query must be a JSON object.')
+            self.send_json(200, query_feature_intensities(self.server.run_pool, query))
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+
+
+# HTTP server that keeps the TDF-SDK loaded and a RunPool of open runs between queries
+class FeatureIntensityServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, max_runs=8):
+        super().__init__(server_address, FeatureIntensityRequestHandler)
+        self.run_pool = RunPool(max_runs)
+
+
+def run():
+    # Parse arguments
+    args = get_args()
+    set_frame_reader(args['reader'], args['decode_threads'])
+
+    server = FeatureIntensityServer((args['host'], args['port']), args['max_runs'])
+    print('Serving feature intensities on http://' + args['host'] + ':' + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.run_pool.close()
+
+
+if __name__ == "__main__":
+    run()
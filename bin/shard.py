@@ -0,0 +1,167 @@
+from bin.cache import get_run_fingerprint, get_feature_key
+from bin.extract import FRAME_CHUNK_SIZE, get_frame_source, iter_frame_intensities
+from bin.profiler import get_profiler
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+# file that describes the state of a shard checkpoint
+CHECKPOINT_MANIFEST = 'manifest.json'
+
+
+# parse a shard specification "i/N" into the 1-based shard index i and the number of shards N
+def parse_shard(shard):
+    try:
+        shard_index, shard_count = [int(i) for i in shard.split('/')]
+    except ValueError:
+        raise Exception('Shard must be given as "i/N" (e.g. 1/4), not ' + shard)
+    if shard_count < 1 or not 1 <= shard_index <= shard_count:
+        raise Exception('Shard index must be between 1 and the number of shards, not ' + shard)
+    return shard_index, shard_count
+
+
+# get the frames processed by a shard
+# frames are assigned round robin in frame ID order so that every shard gets spots from across the whole plate
+def get_shard_frames(frames, shard_index, shard_count):
+    return list(frames)[shard_index - 1::shard_count]
+
+
+# get the default checkpoint folder for an output file
+def get_checkpoint_dir(outfile):
+    return os.path.splitext(outfile)[0] + '_checkpoints'
+
+
+# get the checkpoint folder of a shard
+def get_shard_dir(checkpoint_dir, shard_index, shard_count):
+    return os.path.join(checkpoint_dir, 'shard_' + str(shard_index) + '_of_' + str(shard_count))
+
+
+# get a key identifying a feature list; checkpoints are only reused for exactly the same features in the same order
+def get_features_key(features):
+    return hashlib.sha256('|'.join([get_feature_key(i) for i in features]).encode()).hexdigest()
+
+
+# write a JSON file so that an interrupted write never leaves a partial file behind
+def write_json(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=4)
+    os.replace(temp_path, path)
+
+
+# checkpoint of the frames completed by one shard of a run
+# each chunk of completed frames is saved to its own .npz file in <checkpoint_dir>/shard_<i>_of_<N> and recorded in
+# the shard's manifest, so a restarted shard only extracts the frames that are not in the manifest yet
+# checkpoints are tied to the run's content fingerprint (not its path, so shards can run on different machines), the
+# feature list, and the shard; a checkpoint written for anything else raises an exception instead of being reused
+# each shard must only be run by one process at a time
+class ShardCheckpoint(object):
+    def __init__(self, checkpoint_dir, input_path, features, frames, shard_index=1, shard_count=1):
+        self.shard_dir = get_shard_dir(checkpoint_dir, shard_index, shard_count)
+        self.num_features = len(features)
+        self.manifest_path = os.path.join(self.shard_dir, CHECKPOINT_MANIFEST)
+        identity = {'fingerprint': get_run_fingerprint(input_path),
+                    'features': get_features_key(features),
+                    'shard': shard_index,
+                    'shards': shard_count,
+                    'frames': [int(i) for i in get_shard_frames(frames, shard_index, shard_count)]}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                self.manifest = json.load(manifest_file)
+            if any([self.manifest.get(key) != value for key, value in identity.items()]):
+                raise Exception('Checkpoint ' + self.shard_dir + ' was written for a different run, feature list, or '
+                                'shard. Remove it or use a different checkpoint folder.')
+        else:
+            if not os.path.isdir(self.shard_dir):
+                os.makedirs(self.shard_dir)
+            self.manifest = dict(identity, input=os.path.abspath(input_path), chunks=[], complete=False)
+            write_json(self.manifest_path, self.manifest)
+        self.completed_frames = set([frame for chunk in self.manifest['chunks'] for frame in chunk['frames']])
+
+    # get the frames of this shard that have not been checkpointed yet, in frame ID order
+    def get_remaining_frames(self):
+        return [i for i in self.manifest['frames'] if i not in self.completed_frames]
+
+    # save a chunk of completed frames and record it in the manifest
+    # frame_intensities[k][i] is the intensity of the ith feature in frames[k]
+    def write(self, frames, frame_intensities):
+        if not frames:
+            return
+        chunk_file = 'chunk_' + str(len(self.manifest['chunks'])) + '.npz'
+        temp_path = os.path.join(self.shard_dir, chunk_file + '.tmp.npz')
+        np.savez(temp_path,
+                 frames=np.array(frames, dtype=np.int64),
+                 intensities=np.array(frame_intensities, dtype=np.int64).reshape(len(frames), self.num_features))
+        os.replace(temp_path, os.path.join(self.shard_dir, chunk_file))
+        # the manifest is only updated once the chunk is on disk
+        self.manifest['chunks'].append({'file': chunk_file, 'frames': [int(i) for i in frames]})
+        self.completed_frames.update(self.manifest['chunks'][-1]['frames'])
+        write_json(self.manifest_path, self.manifest)
+
+    # mark the shard as complete once every frame has been checkpointed
+    def mark_complete(self):
+        if self.get_remaining_frames():
+            raise Exception('Shard ' + self.shard_dir + ' has frames that have not been checkpointed.')
+        self.manifest['complete'] = True
+        write_json(self.manifest_path, self.manifest)
+
+    # yield the frames and per-frame feature intensities of each checkpointed chunk
+    def iter_chunks(self):
+        for chunk in self.manifest['chunks']:
+            with np.load(os.path.join(self.shard_dir, chunk['file'])) as chunk_data:
+                yield chunk_data['frames'].tolist(), chunk_data['intensities']
+
+
+# extract the summed intensity of each feature from the frames of a shard that have not been checkpointed yet,
+# checkpointing each chunk of frames as it completes
+def write_shard_checkpoint(dll, tdf_data, features, checkpoint, frame_metadata, jobs=1):
+    frame_source = get_frame_source(dll, tdf_data)
+    remaining_frames = checkpoint.get_remaining_frames()
+    if len(remaining_frames) < len(checkpoint.manifest['frames']):
+        print('Resuming from checkpoint: ' + str(len(checkpoint.manifest['frames']) - len(remaining_frames)) +
+              ' of ' + str(len(checkpoint.manifest['frames'])) + ' frame(s) already completed.')
+    for frame_chunk, chunk_intensities in iter_frame_intensities(frame_source,
+                                                                 remaining_frames,
+                                                                 frame_metadata,
+                                                                 features,
+                                                                 jobs):
+        with get_profiler().stage('checkpoint'):
+            checkpoint.write(frame_chunk, chunk_intensities)
+    checkpoint.mark_complete()
+
+
+# combine the checkpoints of all shards of a run into an array of the summed intensity of each feature (columns) in
+# each frame of the run (rows, in frame ID order)
+# every shard must be complete
+def read_shard_checkpoints(checkpoint_dir, input_path, features, frames, shard_count):
+    frame_positions = dict(zip(frames, range(len(frames))))
+    intensities = np.zeros((len(frames), len(features)), dtype=np.int64)
+    for shard_index in range(1, shard_count + 1):
+        if not os.path.isfile(os.path.join(get_shard_dir(checkpoint_dir, shard_index, shard_count),
+                                           CHECKPOINT_MANIFEST)):
+            raise Exception('Shard ' + str(shard_index) + '/' + str(shard_count) + ' has not been started; no '
+                            'checkpoint found in ' + checkpoint_dir)
+        checkpoint = ShardCheckpoint(checkpoint_dir, input_path, features, frames, shard_index, shard_count)
+        if not checkpoint.manifest['complete']:
+            raise Exception('Shard ' + str(shard_index) + '/' + str(shard_count) + ' is not complete: ' +
+                            str(len(checkpoint.get_remaining_frames())) + ' frame(s) remaining.')
+        for chunk_frames, chunk_intensities in checkpoint.iter_chunks():
+            intensities[[frame_positions[i] for i in chunk_frames]] = chunk_intensities
+    return intensities
+
+
+# write the combined intensities of all shards from read_shard_checkpoints() to a FeatureIntensityWriter
+# rows are written in the same order as an unsharded run
+def write_merged_intensities(frames, intensities, writer):
+    with get_profiler().stage('write'):
+        try:
+            for begin in range(0, len(frames), FRAME_CHUNK_SIZE):
+                writer.write(frames[begin:begin + FRAME_CHUNK_SIZE],
+                             intensities[begin:begin + FRAME_CHUNK_SIZE].tolist())
+            writer.close()
+        finally:
+            # the temporary file w/ the spilled intensities is removed if writing fails or is interrupted
+            writer.abort()
@@ -0,0 +1,148 @@
+from bin.tdf_source import TdfFrameSource
+
+import os
+import sqlite3
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# zstandard is only required to decode analysis.tdf_bin w/o the TDF-SDK
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# frame readers used to read peaks from a .d run
+#     sdk: peaks are read through the TDF-SDK w/ tims_read_scans_v2
+#     numpy: frame blobs are read from analysis.tdf_bin and decoded w/ NumPy
+FRAME_READERS = ['sdk', 'numpy']
+# timsControl compression type of analysis.tdf_bin that can be decoded w/ NumPy (zstd compressed frames)
+TDF_BIN_COMPRESSION_TYPE = 2
+# number of frames decoded ahead of the extraction loop by each decode thread
+PREFETCH_FRAMES_PER_THREAD = 2
+
+
+# check that zstandard is installed before frames are decoded w/ NumPy
+def check_tdf_bin_reader():
+    if zstandard is None:
+        raise Exception('zstandard is required to decode analysis.tdf_bin w/ the numpy frame reader. Install it w/ '
+                        '"pip install zstandard".')
+
+
+# get the TimsCompressionType of a .d run from the GlobalMetadata table in analysis.tdf
+def get_compression_type(input_path):
+    conn = sqlite3.connect('file:' + os.path.abspath(os.path.join(input_path, 'analysis.tdf')) + '?mode=ro',
+                           uri=True)
+    try:
+        compression_type = conn.execute("SELECT Value FROM GlobalMetadata WHERE Key = 'TimsCompressionType'").fetchone()
+    finally:
+        conn.close()
+    return int(compression_type[0]) if compression_type is not None else None
+
+
+# decode a frame blob from analysis.tdf_bin into flat TOF index and intensity arrays
+# the blob is a uint32 blob size and uint32 number of scans followed by a zstd compressed, byte shuffled uint32 array:
+# the number of scans, twice the peak count of each scan except the last, then interleaved TOF index deltas (w/ TOF
+# indices stored 1-based and restarting at 0 in each scan) and intensities
+# peaks from the Nth scan are found in tof_indices[scan_offsets[N]:scan_offsets[N + 1]]
+def decode_frame_blob(blob, num_scans):
+    scan_offsets = np.zeros(num_scans + 1, dtype=np.int64)
+    if len(blob) <= 8:
+        return scan_offsets, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    blob_num_scans = int(np.frombuffer(blob[4:8], dtype=np.uint32)[0])
+    data = np.frombuffer(zstandard.ZstdDecompressor().decompressobj().decompress(blob[8:]), dtype=np.uint8)
+    data = np.ascontiguousarray(data.reshape(4, -1).T).view(np.uint32).ravel()
+    peak_data = data[blob_num_scans:]
+
+    scan_counts = np.zeros(max(num_scans, blob_num_scans), dtype=np.int64)
+    if blob_num_scans > 0:
+        scan_counts[:blob_num_scans - 1] = data[1:blob_num_scans] // 2
+        scan_counts[blob_num_scans - 1] = peak_data.size // 2 - scan_counts[:blob_num_scans - 1].sum()
+    scan_offsets = np.zeros(scan_counts.size + 1, dtype=np.int64)
+    scan_offsets[1:] = np.cumsum(scan_counts)
+
+    # TOF indices are the cumulative sum of the deltas within each scan
+    cumulative = np.cumsum(peak_data[0::2], dtype=np.int64)
+    scan_starts = np.repeat(scan_offsets[:-1], scan_counts)
+    tof_indices = cumulative - np.concatenate(([0], cumulative))[scan_starts] - 1
+    return scan_offsets[:num_scans + 1], tof_indices, peak_data[1::2].astype(np.int64)
+
+
+# reads frame blobs from analysis.tdf_bin w/o the TDF-SDK
+# frame offsets are taken from the TimsId column of the Frames table in analysis.tdf, and analysis.tdf_bin is
+# memory-mapped so frames can be read from several threads at once
+class TdfBinReader(object):
+    def __init__(self, tdf_data):
+        check_tdf_bin_reader()
+        compression_type = get_compression_type(tdf_data.source_file)
+        if compression_type != TDF_BIN_COMPRESSION_TYPE:
+            raise Exception('The numpy frame reader only supports TimsCompressionType ' +
+                            str(TDF_BIN_COMPRESSION_TYPE) + '; ' + tdf_data.source_file + ' has TimsCompressionType ' +
+                            str(compression_type) + '. Use the sdk frame reader instead.')
+        frames_df = tdf_data.analysis['Frames']
+        frame_ids = [int(i) for i in frames_df['Id'].tolist()]
+        self.offsets = dict(zip(frame_ids, [int(i) for i in frames_df['TimsId'].tolist()]))
+        self.num_scans = dict(zip(frame_ids, [int(i) for i in frames_df['NumScans'].tolist()]))
+        tdf_bin_path = os.path.join(tdf_data.source_file, 'analysis.tdf_bin')
+        if os.path.getsize(tdf_bin_path) == 0:
+            self.tdf_bin = np.zeros(0, dtype=np.uint8)
+        else:
+            self.tdf_bin = np.memmap(tdf_bin_path, dtype=np.uint8, mode='r')
+
+    # read and decode a frame
+    def read_frame(self, frame):
+        offset = self.offsets[frame]
+        blob_size = int(self.tdf_bin[offset:offset + 4].view(np.uint32)[0])
+        return decode_frame_blob(self.tdf_bin[offset:offset + blob_size], self.num_scans[frame])
+
+
+# frame source that decodes peaks from analysis.tdf_bin w/ NumPy instead of reading them through the TDF-SDK
+# m/z and 1/K0 calibration are still provided by the TDF-SDK
+# if threads > 1, frames passed to prefetch() are decompressed and decoded ahead of the extraction loop in a pool of
+# threads (zstd decompression releases the GIL)
+class TdfBinFrameSource(TdfFrameSource):
+    def __init__(self, dll, tdf_data, threads=1):
+        super().__init__(dll, tdf_data)
+        self.reader = TdfBinReader(tdf_data)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.pending_frames = deque()
+        self.decoded_frames = OrderedDict()
+
+    # queue frames to be decoded in the order they will be read
+    def prefetch(self, frames):
+        if self.executor is None:
+            return
+        self.pending_frames.extend(frames)
+        self.submit_frames()
+
+    # start decoding queued frames, keeping up to PREFETCH_FRAMES_PER_THREAD frames per thread in flight
+    def submit_frames(self):
+        while self.pending_frames and len(self.decoded_frames) < self.threads * PREFETCH_FRAMES_PER_THREAD:
+            frame = self.pending_frames.popleft()
+            self.decoded_frames[frame] = self.executor.submit(self.reader.read_frame, frame)
+
+    # get a decoded frame, waiting for it if it was prefetched
+    def get_decoded_frame(self, frame):
+        if frame in self.decoded_frames or frame in self.pending_frames:
+            while True:
+                self.submit_frames()
+                prefetched_frame, decoded_frame = self.decoded_frames.popitem(last=False)
+                # frames prefetched before this one were not read (e.g. no feature was within the frame's 1/K0 range)
+                if prefetched_frame != frame:
+                    decoded_frame.cancel()
+                    continue
+                self.submit_frames()
+                return decoded_frame.result()
+        return self.reader.read_frame(frame)
+
+    # read scans [scan_begin, scan_end) from a frame as flat TOF index and intensity arrays
+    # peaks from the Nth scan read are found in tof_indices[scan_offsets[N]:scan_offsets[N + 1]]
+    def read_scans(self, frame, scan_begin, scan_end):
+        frame_offsets, tof_indices, intensities = self.get_decoded_frame(frame)
+        # scans past the last scan of the frame have no peaks
+        scan_offsets = frame_offsets[np.minimum(np.arange(scan_begin, scan_end + 1), frame_offsets.size - 1)]
+        return (scan_offsets - scan_offsets[0],
+                tof_indices[scan_offsets[0]:scan_offsets[-1]],
+                intensities[scan_offsets[0]:scan_offsets[-1]])
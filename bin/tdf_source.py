@@ -0,0 +1,135 @@
+import numpy as np
+
+# functions for initializing TDF-SDK are found in the pyTDFSDK package
+# pyTDFSDK is only required to read .d runs; peak stores can be queried w/o it
+try:
+    import pyTDFSDK
+    from pyTDFSDK.tims import (tims_scannum_to_oneoverk0, tims_oneoverk0_to_scannum, tims_index_to_mz,
+                               tims_mz_to_index, tims_read_scans_v2)
+except ImportError:
+    pyTDFSDK = None
+
+
+# check that pyTDFSDK is installed before a .d run is read through the TDF-SDK
+def check_tdf_sdk():
+    if pyTDFSDK is None:
+        raise Exception('pyTDFSDK is required to read .d runs through the TDF-SDK. Install it w/ '
+                        '"pip install -r requirements.txt", or query a peak store exported w/ export_peak_store.')
+
+
+# scan number <-> 1/K0 lookup table for a single TIMS calibration
+# most AutoXecute frames share one calibration, so the table only needs to be built once per calibration per run
+class MobilityCalibration(object):
+    def __init__(self, ook0_array, scannum_array):
+        # 1/K0 value of each scan number and the scan number the TDF-SDK maps it back to, in scan order
+        self.scan_ook0 = np.asarray(ook0_array)
+        self.scan_scannums = np.asarray(scannum_array)
+        # 1/K0 decreases as scan number increases; sort once so windows can be found w/ a binary search
+        order = np.argsort(ook0_array, kind='stable')
+        self.ook0_array = np.asarray(ook0_array)[order]
+        self.scannum_array = np.asarray(scannum_array)[order]
+
+    # get the scan range [scan_begin, scan_end) covering ook0 +/- ook0_tol for each of an array of 1/K0 windows
+    # returns arrays of scan_begin and scan_end and whether any scan is within tolerance of each window
+    def get_scan_ranges(self, ook0, ook0_tol):
+        begin = np.searchsorted(self.ook0_array, ook0 - ook0_tol, side='left')
+        end = np.searchsorted(self.ook0_array, ook0 + ook0_tol, side='right')
+        valid = begin < end
+        scan_begin = np.zeros(valid.size, dtype=np.int64)
+        scan_end = np.zeros(valid.size, dtype=np.int64)
+        if valid.any():
+            # min and max scan number within tolerance of each window; a sentinel is appended so that end can be used
+            # as a reduceat index when a window extends to the last scan
+            scannum_array = np.append(self.scannum_array, 0).astype(np.int64)
+            bounds = np.column_stack((begin[valid], end[valid])).ravel()
+            scan_begin[valid] = np.minimum.reduceat(scannum_array, bounds)[::2]
+            scan_end[valid] = np.maximum.reduceat(scannum_array, bounds)[::2]
+        return scan_begin, scan_end, valid
+
+
+# frame source that reads peaks and calibration from a .d run through the TDF-SDK
+# the extraction engine only uses get_mobility_calibration(), get_tof_ranges(), prefetch(), and read_scans(), so other
+# sources (e.g. a PeakStore or analysis.tdf_bin decoded w/ NumPy) can be used in place of this one
+class TdfFrameSource(object):
+    def __init__(self, dll, tdf_data):
+        check_tdf_sdk()
+        self.dll = dll
+        self.tdf_data = tdf_data
+        self.source_file = tdf_data.source_file
+        self.mobility_calibrations = {}
+
+    # get the 1/K0 value of each scan in a frame and the scan number the TDF-SDK maps that 1/K0 value back to
+    def get_mobility_arrays(self, frame, num_scans):
+        # Get 1/K0 values from scan numbers in run
+        ook0_array = np.asarray(tims_scannum_to_oneoverk0(self.dll,
+                                                          self.tdf_data.handle,
+                                                          frame,
+                                                          range(0, num_scans + 1)))
+        # Get scan numbers back from the 1/K0 values; the round trip is kept so scan ranges match the SDK exactly
+        scannum_array = np.asarray(tims_oneoverk0_to_scannum(self.dll,
+                                                             self.tdf_data.handle,
+                                                             frame,
+                                                             ook0_array)).astype(np.int64)
+        return ook0_array, scannum_array
+
+    # get the MobilityCalibration lookup table for a frame, cached by TIMS calibration ID and number of scans
+    def get_mobility_calibration(self, frame, num_scans, tims_calibration):
+        key = (tims_calibration, num_scans)
+        if key not in self.mobility_calibrations:
+            self.mobility_calibrations[key] = MobilityCalibration(*self.get_mobility_arrays(frame, num_scans))
+        return self.mobility_calibrations[key]
+
+    # get the TOF index range [tof_begin, tof_end] covering mz +/- mz_tol for each feature in the current frame
+    def get_tof_ranges(self, frame, features):
+        lower_mz = [feature['mz'] - feature['mz_tol'] for feature in features]
+        upper_mz = [feature['mz'] + feature['mz_tol'] for feature in features]
+        # m/z increases monotonically with TOF index, so each m/z window maps to a contiguous TOF index range
+        lower_index = np.floor(tims_mz_to_index(self.dll, self.tdf_data.handle, frame, lower_mz)).astype(np.int64)
+        upper_index = np.floor(tims_mz_to_index(self.dll, self.tdf_data.handle, frame, upper_mz)).astype(np.int64)
+        # tims_mz_to_index is not exact at the window edges, so check the neighbouring TOF indices of each edge against
+        # the m/z window in a single tims_index_to_mz call
+        offsets = np.arange(-1, 3)
+        lower_candidates = np.maximum(lower_index[:, np.newaxis] + offsets, 0)
+        upper_candidates = np.maximum(upper_index[:, np.newaxis] + offsets, 0)
+        candidate_mz = self.index_to_mz(frame, np.concatenate((lower_candidates.ravel(), upper_candidates.ravel())))
+        lower_candidate_mz = candidate_mz[:lower_candidates.size].reshape(lower_candidates.shape)
+        upper_candidate_mz = candidate_mz[lower_candidates.size:].reshape(upper_candidates.shape)
+
+        rows = np.arange(len(features))
+        # first TOF index with m/z >= mz - mz_tol
+        within_lower = lower_candidate_mz >= np.asarray(lower_mz)[:, np.newaxis]
+        tof_begin = np.where(within_lower.any(axis=1),
+                             lower_candidates[rows, np.argmax(within_lower, axis=1)],
+                             lower_candidates[:, -1] + 1)
+        # last TOF index with m/z <= mz + mz_tol
+        within_upper = upper_candidate_mz <= np.asarray(upper_mz)[:, np.newaxis]
+        tof_end = np.where(within_upper.any(axis=1),
+                           upper_candidates[rows, offsets.size - 1 - np.argmax(within_upper[:, ::-1], axis=1)],
+                           upper_candidates[:, 0] - 1)
+        return list(zip(tof_begin.tolist(), tof_end.tolist()))
+
+    # get the m/z value of each TOF index in a frame
+    def index_to_mz(self, frame, tof_indices):
+        return np.asarray(tims_index_to_mz(self.dll,
+                                           self.tdf_data.handle,
+                                           frame,
+                                           np.asarray(tof_indices).astype(np.uint32)))
+
+    # frames are read through the TDF-SDK when read_scans() is called, so nothing is read ahead
+    def prefetch(self, frames):
+        pass
+
+    # read scans [scan_begin, scan_end) from a frame as flat TOF index and intensity arrays
+    # peaks from the Nth scan read are found in tof_indices[scan_offsets[N]:scan_offsets[N + 1]]
+    def read_scans(self, frame, scan_begin, scan_end):
+        # each frame has N scans where each scan corresponds to a 1/K0 value
+        list_of_scans = tims_read_scans_v2(self.dll, self.tdf_data.handle, frame, scan_begin, scan_end)
+        list_of_scans = [scan if scan[0].size == scan[1].size else (scan[0][:0], scan[1][:0])
+                         for scan in list_of_scans]
+        scan_offsets = np.zeros(len(list_of_scans) + 1, dtype=np.int64)
+        scan_offsets[1:] = np.cumsum([scan[0].size for scan in list_of_scans])
+        if scan_offsets[-1] == 0:
+            return scan_offsets, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        tof_indices = np.concatenate([scan[0] for scan in list_of_scans]).astype(np.int64)
+        intensities = np.concatenate([scan[1] for scan in list_of_scans]).astype(np.int64)
+        return scan_offsets, tof_indices, intensities
@@ -0,0 +1,85 @@
+from bin.extract import open_run, get_frame_metadata, get_frame_source, iter_frame_intensities
+from bin.peak_store import is_peak_store
+from bin.tdf_source import check_tdf_sdk
+
+import os
+import time
+import sqlite3
+import pandas as pd
+
+
+# read the number of committed MALDI frames and whether the acquisition has finished from analysis.tdf
+# analysis.tdf is opened read-only so that timsControl can keep writing to it while it is polled
+def get_acquisition_state(input_path):
+    conn = sqlite3.connect('file:' + os.path.abspath(os.path.join(input_path, 'analysis.tdf')) + '?mode=ro',
+                           uri=True)
+    try:
+        num_frames = conn.execute('SELECT COUNT(DISTINCT Frame) FROM MaldiFrameInfo '
+                                  'WHERE Frame IN (SELECT Id FROM Frames)').fetchone()[0]
+        closed = conn.execute("SELECT Value FROM GlobalMetadata WHERE Key = 'ClosedProperly'").fetchone()
+    finally:
+        conn.close()
+    closed = closed is not None and str(closed[0]) == '1'
+    return num_frames, closed
+
+
+# extract feature intensities from a MALDI AutoXecute run while it is being acquired
+# analysis.tdf is polled every poll_interval seconds for newly committed frames; only new frames are extracted and
+# appended to the writer, which must have been created w/ frame_order=True
+# watching stops once the acquisition is closed or no new frames have been committed for timeout seconds (0 = wait
+# indefinitely)
+def watch_feature_intensities(input_path, features, writer, jobs=1, poll_interval=10, timeout=1800):
+    if is_peak_store(input_path):
+        raise Exception('Watch mode requires a .d file; peak stores cannot be acquired into.')
+    check_tdf_sdk()
+    # functions for initializing TDF-SDK are found in the pyTDFSDK package
+    from pyTDFSDK.tims import tims_close
+    processed_frames = set()
+    num_processed_frames = 0
+    last_new_frame_time = time.time()
+    dll = None
+    tdf_data = None
+    try:
+        while True:
+            # the closed flag is read together w/ the frame count so that frames committed before the acquisition
+            # was closed are always extracted before watching stops
+            try:
+                num_frames, closed = get_acquisition_state(input_path)
+            except (sqlite3.DatabaseError, pd.errors.DatabaseError):
+                # analysis.tdf may be locked or not yet created while timsControl is writing to it
+                num_frames, closed = num_processed_frames, False
+
+            if num_frames > num_processed_frames:
+                # reopen the run so that the TDF-SDK and the analysis tables include the newly committed frames
+                if tdf_data is not None:
+                    tims_close(dll, tdf_data.handle)
+                dll, tdf_data = open_run(input_path)
+                frame_metadata = get_frame_metadata(tdf_data)
+                writer.frame_metadata = frame_metadata
+                new_frames = [i for i in frame_metadata.frames if i not in processed_frames]
+                frame_source = get_frame_source(dll, tdf_data)
+                for frame_chunk, chunk_intensities in iter_frame_intensities(frame_source,
+                                                                             new_frames,
+                                                                             frame_metadata,
+                                                                             features,
+                                                                             jobs):
+                    writer.write(frame_chunk, chunk_intensities)
+                processed_frames.update(new_frames)
+                num_processed_frames = len(processed_frames)
+                if new_frames:
+                    last_new_frame_time = time.time()
+                print('Processed ' + str(len(new_frames)) + ' new frame(s); ' + str(num_processed_frames) +
+                      ' frame(s) processed.')
+
+            if closed and num_frames <= num_processed_frames:
+                print('Acquisition closed; ' + str(num_processed_frames) + ' frame(s) processed.')
+                break
+            if timeout > 0 and time.time() - last_new_frame_time > timeout:
+                print('No new frames committed in ' + str(timeout) + ' s; ' + str(num_processed_frames) +
+                      ' frame(s) processed.')
+                break
+            time.sleep(poll_interval)
+    finally:
+        if tdf_data is not None:
+            tims_close(dll, tdf_data.handle)
+        writer.close()
@@ -0,0 +1,168 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+# pyarrow is only required to write Parquet and Feather output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# supported output formats and their file extensions
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+# supported table layouts
+#     long: one row per feature per spot, w/ all spots for the first feature followed by all spots for the second
+#           feature, etc.
+#     wide: one row per spot w/ one intensity column per feature
+LAYOUTS = ['long', 'wide']
+# number of rows written at once when writing the long layout
+LONG_ROW_GROUP_SIZE = 65536
+
+
+# get the wide layout column name for a feature
+def get_feature_column_name(feature):
+    return '_'.join([str(float(feature[i])) for i in ['mz', 'mz_tol', 'ook0', 'ook0_tol']])
+
+
+# streaming writer for feature intensity tables in CSV, Parquet, or Feather format
+# write() is called w/ each chunk of completed frames; rows are flushed to disk as row groups instead of being kept in
+# memory until the end of the run
+# in the long layout, rows are grouped by feature, so intensities are spilled to a temporary memory-mapped array as
+# frames complete and written out feature by feature in close(); if frame_order is True, long layout rows are instead
+# written frame by frame as frames complete (e.g. when the set of frames is not known in advance)
+class FeatureIntensityWriter(object):
+    # frame_metadata may be None if frame_order is True and is set before the first call to write()
+    def __init__(self, path, features, frame_metadata, output_format='csv', layout='long', frame_order=False):
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception('Output format must be one of: ' + ', '.join(OUTPUT_FORMATS.keys()))
+        if layout not in LAYOUTS:
+            raise Exception('Layout must be one of: ' + ', '.join(LAYOUTS))
+        if output_format != 'csv' and pa is None:
+            raise Exception('pyarrow is required to write ' + output_format + ' output. Install it w/ '
+                            '"pip install pyarrow".')
+        self.path = path
+        self.features = features
+        self.frame_metadata = frame_metadata
+        self.output_format = output_format
+        self.layout = layout
+        self.frame_order = frame_order
+        self.arrow_writer = None
+        self.schema = None
+        self.header_written = False
+
+        self.spill_path = None
+        self.spill = None
+        self.frame_positions = {}
+        if self.layout == 'long' and not self.frame_order and self.features and self.frame_metadata.frames:
+            self.frame_positions = dict(zip(frame_metadata.frames, range(len(frame_metadata.frames))))
+            spill_file, self.spill_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(path)))
+            os.close(spill_file)
+            self.spill = np.lib.format.open_memmap(self.spill_path,
+                                                   mode='w+',
+                                                   dtype=np.int64,
+                                                   shape=(len(self.frame_metadata.frames), len(self.features)))
+
+    # append a DataFrame to the output file as a single row group
+    def write_df(self, df):
+        if self.output_format == 'csv':
+            df.to_csv(self.path, mode='a' if self.header_written else 'w', header=not self.header_written, index=False)
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.arrow_writer is None:
+                if self.output_format == 'parquet':
+                    self.arrow_writer = pq.ParquetWriter(self.path, table.schema)
+                else:
+                    self.arrow_writer = pa.ipc.new_file(self.path, table.schema)
+                self.schema = table.schema
+            self.arrow_writer.write_table(table.cast(self.schema))
+        self.header_written = True
+
+    # get the columns of the output table
+    def get_columns(self):
+        if self.layout == 'wide':
+            return ['Frame', 'Spot'] + [get_feature_column_name(i) for i in self.features]
+        return ['Frame', 'Spot', 'mz', 'mz_tolerance', 'ook0', 'ook0_tol', 'intensity']
+
+    # write the summed intensity of every feature for a chunk of completed frames
+    # frame_intensities[k][i] is the intensity of the ith feature in frames[k]
+    def write(self, frames, frame_intensities):
+        if not frames:
+            return
+        if self.layout == 'wide':
+            wide_df = pd.DataFrame(np.array(frame_intensities, dtype=np.int64).reshape(len(frames), len(self.features)),
+                                   columns=[get_feature_column_name(i) for i in self.features])
+            wide_df.insert(0, 'Frame', frames)
+            wide_df.insert(1, 'Spot', [self.frame_metadata.spot_name[i] for i in frames])
+            self.write_df(wide_df)
+        elif self.frame_order:
+            num_features = len(self.features)
+            if num_features == 0:
+                return
+            self.write_df(pd.DataFrame({
+                'Frame': np.repeat(np.array(frames, dtype=np.int64), num_features),
+                'Spot': np.repeat(np.array([self.frame_metadata.spot_name[i] for i in frames], dtype=object),
+                                  num_features),
+                'mz': np.tile(np.array([i['mz'] for i in self.features], dtype=np.float64), len(frames)),
+                'mz_tolerance': np.tile(np.array([i['mz_tol'] for i in self.features], dtype=np.float64),
+                                        len(frames)),
+                'ook0': np.tile(np.array([i['ook0'] for i in self.features], dtype=np.float64), len(frames)),
+                'ook0_tol': np.tile(np.array([i['ook0_tol'] for i in self.features], dtype=np.float64), len(frames)),
+                'intensity': np.array(frame_intensities, dtype=np.int64).ravel()}))
+        elif self.spill is not None:
+            for frame, intensities in zip(frames, frame_intensities):
+                self.spill[self.frame_positions[frame]] = intensities
+
+    # remove the temporary file w/ the spilled intensities
+    def remove_spill(self):
+        if self.spill is not None:
+            del self.spill
+            self.spill = None
+            os.remove(self.spill_path)
+
+    # close the output file and remove the spilled intensities w/o writing the long layout, e.g. if extraction failed
+    # does nothing if the writer was already closed
+    def abort(self):
+        try:
+            if self.arrow_writer is not None:
+                self.arrow_writer.close()
+                self.arrow_writer = None
+        finally:
+            self.remove_spill()
+
+    # write the long layout from the spilled intensities, flush any remaining rows, and close the output file
+    def close(self):
+        if self.layout == 'long' and self.spill is not None:
+            frames = np.array(self.frame_metadata.frames, dtype=np.int64)
+            spots = np.array([self.frame_metadata.spot_name[i] for i in self.frame_metadata.frames], dtype=object)
+            # each row group holds all frames for one or more features, or part of the frames for a single feature
+            # if a feature has more than LONG_ROW_GROUP_SIZE frames
+            features_per_group = max(1, LONG_ROW_GROUP_SIZE // frames.size)
+            frames_per_group = min(frames.size, LONG_ROW_GROUP_SIZE)
+            for feature_begin in range(0, len(self.features), features_per_group):
+                feature_end = min(feature_begin + features_per_group, len(self.features))
+                features = self.features[feature_begin:feature_end]
+                for frame_begin in range(0, frames.size, frames_per_group):
+                    frame_end = min(frame_begin + frames_per_group, frames.size)
+                    num_frames = frame_end - frame_begin
+                    intensities = np.asarray(self.spill[frame_begin:frame_end, feature_begin:feature_end])
+                    self.write_df(pd.DataFrame({
+                        'Frame': np.tile(frames[frame_begin:frame_end], len(features)),
+                        'Spot': np.tile(spots[frame_begin:frame_end], len(features)),
+                        'mz': np.repeat(np.array([i['mz'] for i in features], dtype=np.float64), num_frames),
+                        'mz_tolerance': np.repeat(np.array([i['mz_tol'] for i in features], dtype=np.float64),
+                                                  num_frames),
+                        'ook0': np.repeat(np.array([i['ook0'] for i in features], dtype=np.float64), num_frames),
+                        'ook0_tol': np.repeat(np.array([i['ook0_tol'] for i in features], dtype=np.float64),
+                                              num_frames),
+                        'intensity': intensities.T.ravel()}))
+            self.remove_spill()
+        if not self.header_written:
+            # no rows were written; write an empty table w/ the output columns
+            self.write_df(pd.DataFrame(columns=self.get_columns()))
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+            self.arrow_writer = None
@@ -19,6 +19,12 @@ setup(
     packages=['bin'],
     entry_points={'console_scripts': ['get_feature_intensities=bin.run:run',
                                       'get_batch_feature_intensities=bin.run_batch:run',
-                                      'get_feature_map=bin.run_batch_map:run']},
-    install_requires=install_requires
+                                      'get_feature_map=bin.run_batch_map:run',
+                                      'get_plate_feature_intensities=bin.run_plates:run',
+                                      'invalidate_feature_cache=bin.cache:run',
+                                      'export_peak_store=bin.peak_store:run',
+                                      'serve_feature_intensities=bin.service:run',
+                                      'get_profile_intensities=bin.feature_profiles:run']},
+    install_requires=install_requires,
+    extras_require={'arrow': ['pyarrow'], 'tdf_bin': ['zstandard'], 'benchmarks': ['zstandard']}
 )